@@ -112,9 +112,15 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     # Declare member variables (selected at certain steps and then from then on for the workflow)
     self.lastAddedFolder = 0
     self.opticalDensityCurve = None
+    self.registrationProgressDialog = None
+    self.registrationCancelRequested = False
+    self.lineProfileLogic = LineProfileLogic()
+    self.lineProfileLogic.reuseProfileBuffer = True # Profiles are only kept in the array nodes
+    self.lineProfileObservedRulerNode = None # Ruler observed for live line profile updates
 
     # Constants
     self.maxNumberOfCalibrationFilms = 10
+    self.lineProfileLiveUpdateIntervalMs = 33 # Live line profile updates are coalesced to about 30 per second
 
     # Set observations
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
@@ -183,6 +189,7 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step3_loadCalibrationButton.disconnect('clicked()', self.onLoadCalibrationFunctionFromFileButton)
     self.step3_applyCalibrationCollapsibleButton.disconnect('contentsCollapsed(bool)', self.onStep3_ApplyCalibrationCollapsed)
     self.step4_performRegistrationButton.disconnect('clicked()', self.onPerformRegistrationButtonClicked)
+    self.step4_useBrainsFitRegistrationCheckBox.disconnect('toggled(bool)', self.onUseBrainsFitRegistrationToggled)
     self.step4_registrationCollapsibleButton.disconnect('contentsCollapsed(bool)', self.onStep4_RegistrationCollapsed)
     self.step4_rotateCcwButton.disconnect('clicked()', self.onStep4_RotateCcw90)
     self.step4_rotateCcwAction_5Degrees.disconnect('triggered()', self.onStep4_RotateCcw5)
@@ -201,6 +208,12 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.stepT1_createLineProfileButton.disconnect('clicked(bool)', self.onCreateLineProfileButton)
     self.stepT1_inputRulerSelector.disconnect("currentNodeChanged(vtkMRMLNode*)", self.onSelectLineProfileParameters)
     self.stepT1_exportLineProfilesToCSV.disconnect('clicked()', self.onExportLineProfiles)
+    self.stepT1_liveUpdateCheckBox.disconnect('toggled(bool)', self.onLineProfileLiveUpdateToggled)
+    self.stepT1_liveUpdateTimer.disconnect('timeout()', self.onLineProfileLiveUpdateTimeout)
+    self.stepT1_liveUpdateTimer.stop()
+    if self.lineProfileObservedRulerNode is not None:
+      self.removeObserver(self.lineProfileObservedRulerNode, vtk.vtkCommand.ModifiedEvent, self.onLineProfileRulerModified)
+      self.lineProfileObservedRulerNode = None
 
     # Remove scene observations
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
@@ -686,6 +699,12 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step4_registrationLabel2.wordWrap = True
     self.step4_registrationCollapsibleButtonLayout.addWidget(self.step4_registrationLabel2)
 
+    # Registration engine
+    self.step4_useBrainsFitRegistrationCheckBox = qt.QCheckBox("Use BRAINSFit registration")
+    self.step4_useBrainsFitRegistrationCheckBox.checked = self.logic.useBrainsFitRegistration
+    self.step4_useBrainsFitRegistrationCheckBox.setToolTip('Register film and plan dose slice padded to multiple slices with BRAINSFit.\nIf unchecked, a faster in-plane registration is performed directly on the film and the plan dose slice.')
+    self.step4_registrationCollapsibleButtonLayout.addWidget(self.step4_useBrainsFitRegistrationCheckBox)
+
     # Perform registration button
     self.step4_performRegistrationButton = qt.QPushButton("Perform registration")
     self.step4_performRegistrationButton.toolTip = "Fine-tune film to plan dose slice registration after manual coarse alignment\n "
@@ -718,6 +737,7 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
 
     # Connections
     self.step4_performRegistrationButton.connect('clicked()', self.onPerformRegistrationButtonClicked)
+    self.step4_useBrainsFitRegistrationCheckBox.connect('toggled(bool)', self.onUseBrainsFitRegistrationToggled)
     self.step4_registrationCollapsibleButton.connect('contentsCollapsed(bool)', self.onStep4_RegistrationCollapsed)
     self.step4_rotateCcwButton.connect('clicked()', self.onStep4_RotateCcw90)
     self.step4_rotateCcwAction_5Degrees.connect('triggered()', self.onStep4_RotateCcw5)
@@ -785,6 +805,14 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
 
     self.step5_doseComparisonCollapsibleButtonLayout.addRow(self.step5_doseDifferenceToleranceLayout)
 
+    # Dose difference normalization
+    self.step5_normalizationModeComboBox = qt.QComboBox()
+    self.step5_normalizationModeComboBox.addItem(GLOBAL_NORMALIZATION)
+    self.step5_normalizationModeComboBox.addItem(LOCAL_NORMALIZATION)
+    self.step5_normalizationModeComboBox.addItem(HYBRID_NORMALIZATION)
+    self.step5_normalizationModeComboBox.setToolTip('Global: dose difference criteria is relative to the dose selected above.\nLocal: relative to the plan dose at each pixel.\nHybrid: relative to the plan dose at each pixel, but at least to ' + str(self.logic.gammaHybridMinimumDosePercent) + '% of the dose selected above.\nLocal and hybrid normalization are only available with the built-in gamma engine.')
+    self.step5_doseComparisonCollapsibleButtonLayout.addRow('Dose difference normalization: ', self.step5_normalizationModeComboBox)
+
     # Analysis threshold
     self.step5_analysisThresholdLayout = qt.QHBoxLayout(self.step5_doseComparisonCollapsibleButton)
     self.step5_analysisThresholdLabelBefore = qt.QLabel('Do not calculate gamma values for voxels below ')
@@ -805,11 +833,23 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step5_useLinearInterpolationCheckBox.setToolTip('Flag determining whether linear interpolation is used when resampling the compare dose volume to reference grid. Nearest neighbour is used if unchecked.')
     self.step5_doseComparisonCollapsibleButtonLayout.addRow('Use linear interpolation: ', self.step5_useLinearInterpolationCheckBox)
 
+    # Accelerated gamma search
+    self.step5_useEarlyTerminationCheckBox = qt.QCheckBox()
+    self.step5_useEarlyTerminationCheckBox.checked = self.logic.gammaUseEarlyTermination
+    self.step5_useEarlyTerminationCheckBox.setToolTip('Stop the gamma search for each pixel when it passes or when farther points cannot lower its gamma. Much faster for large distance tolerances and upper bounds. Pass fraction and gamma of failing pixels are unchanged, gamma of passing pixels is only known to be at most 1. Only used by the built-in gamma engine.')
+    self.step5_doseComparisonCollapsibleButtonLayout.addRow('Accelerated gamma search: ', self.step5_useEarlyTerminationCheckBox)
+
     # Maximum gamma
     self.step5_maximumGammaSpinBox = qt.QDoubleSpinBox()
     self.step5_maximumGammaSpinBox.setValue(2.0)
     self.step5_doseComparisonCollapsibleButtonLayout.addRow('Upper bound for gamma calculation: ', self.step5_maximumGammaSpinBox)
 
+    # Use built-in gamma engine
+    self.step5_useBuiltInGammaEngineCheckBox = qt.QCheckBox()
+    self.step5_useBuiltInGammaEngineCheckBox.checked = self.logic.useBuiltInGammaEngine
+    self.step5_useBuiltInGammaEngineCheckBox.setToolTip('Compute gamma on the plan dose slice with the built-in 2D engine. The Dose Comparison module of SlicerRT is used if unchecked.')
+    self.step5_doseComparisonCollapsibleButtonLayout.addRow('Use built-in gamma engine: ', self.step5_useBuiltInGammaEngineCheckBox)
+
     # Gamma volume selector
     self.step5_gammaVolumeSelectorLayout = qt.QHBoxLayout(self.step5_doseComparisonCollapsibleButton)
     self.step5_gammaVolumeSelector = slicer.qMRMLNodeComboBox()
@@ -894,6 +934,17 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.stepT1_createLineProfileButton.toolTip = "Compute and show line profile"
     self.stepT1_createLineProfileButton.enabled = False
     self.stepT1_lineProfileCollapsibleButtonLayout.addRow(self.stepT1_createLineProfileButton)
+
+    # Live update checkbox
+    self.stepT1_liveUpdateCheckBox = qt.QCheckBox()
+    self.stepT1_liveUpdateCheckBox.checked = False
+    self.stepT1_liveUpdateCheckBox.setToolTip("Update the line profiles while the input ruler is moved")
+    self.stepT1_lineProfileCollapsibleButtonLayout.addRow("Live update: ", self.stepT1_liveUpdateCheckBox)
+
+    # Ruler modified events are coalesced, the profiles are updated when the timer fires
+    self.stepT1_liveUpdateTimer = qt.QTimer()
+    self.stepT1_liveUpdateTimer.setSingleShot(True)
+    self.stepT1_liveUpdateTimer.setInterval(self.lineProfileLiveUpdateIntervalMs)
     self.onSelectLineProfileParameters()
 
     # Export line profiles to CSV button
@@ -911,6 +962,8 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.stepT1_createLineProfileButton.connect('clicked(bool)', self.onCreateLineProfileButton)
     self.stepT1_inputRulerSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectLineProfileParameters)
     self.stepT1_exportLineProfilesToCSV.connect('clicked()', self.onExportLineProfiles)
+    self.stepT1_liveUpdateCheckBox.connect('toggled(bool)', self.onLineProfileLiveUpdateToggled)
+    self.stepT1_liveUpdateTimer.connect('timeout()', self.onLineProfileLiveUpdateTimeout)
 
   #
   # -----------------------
@@ -1387,7 +1440,10 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
 
   #------------------------------------------------------------------------------
   def loadCalibrationFunctionFromFile(self, filePath):
-    self.logic.loadCalibrationFunctionFromFile(filePath)
+    message = self.logic.loadCalibrationFunctionFromFile(filePath)
+    if message != '':
+      qt.QMessageBox.critical(None, 'Error', message)
+      return
 
     # Display coefficients (rounded to five digits, but the member variable has full accuracy)
     aText = str(round(self.logic.calibrationCoefficients[0],5))
@@ -1444,11 +1500,13 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
   #------------------------------------------------------------------------------
   def onStep4_RegistrationCollapsed(self, collapsed):
     if not collapsed:
-      # Pre-process volumes for registration (cropping, padding), 
-      # pre-align film and plan dose slice for scan setup alignment
+      # Pre-process volumes for registration (cropping, padding),
+      # pre-align film and plan dose slice for scan setup alignment.
+      # Nothing is computed again if the film, the plan dose and the film geometry have not changed
       message = self.logic.initializeFilmToPlanDoseRegistration()
 
-      if self.logic.paddedCalibratedExperimentalFilmVolumeNode is None or self.logic.paddedPlanDoseSliceVolumeNode is None:
+      [registrationFilmVolumeNode, registrationPlanDoseVolumeNode] = self.logic.getRegistrationVolumeNodes()
+      if registrationFilmVolumeNode is None or registrationPlanDoseVolumeNode is None:
         message = 'Failed to prepare calibrated experimental film and/or plan dose slice for registration\n\n' + message
       if message != '':
         qt.QMessageBox.critical(None, 'Error when initializing registration', message)
@@ -1458,8 +1516,8 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
       # Show film and plan dose slice
       appLogic = slicer.app.applicationLogic()
       selectionNode = appLogic.GetSelectionNode()
-      selectionNode.SetActiveVolumeID(self.logic.paddedCalibratedExperimentalFilmVolumeNode.GetID())
-      selectionNode.SetSecondaryVolumeID(self.logic.paddedPlanDoseSliceVolumeNode.GetID())
+      selectionNode.SetActiveVolumeID(registrationFilmVolumeNode.GetID())
+      selectionNode.SetSecondaryVolumeID(registrationPlanDoseVolumeNode.GetID())
       appLogic.PropagateVolumeSelection()
       # Make foreground volume semi-transparent
       layoutManager = slicer.app.layoutManager()
@@ -1496,23 +1554,59 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
   def onStep4_FlipVertical(self):
     self.logic.flipCalibratedExperimentalFilm(False)
 
+  #------------------------------------------------------------------------------
+  def onUseBrainsFitRegistrationToggled(self, checked):
+    self.logic.useBrainsFitRegistration = checked
+
   #------------------------------------------------------------------------------
   def onPerformRegistrationButtonClicked(self):
-    qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.BusyCursor))
+    self.step4_performRegistrationButton.enabled = False
+    self.registrationCancelRequested = False
+
+    # Create progress dialog. Registration runs in the background, so the application stays responsive
+    self.registrationProgressDialog = qt.QProgressDialog(self.parent)
+    self.registrationProgressDialog.setModal(True)
+    self.registrationProgressDialog.setMinimumDuration(150)
+    self.registrationProgressDialog.labelText = "Registering experimental film to plan dose..."
+    self.registrationProgressDialog.connect('canceled()', self.onRegistrationCancelRequested)
+    self.registrationProgressDialog.show()
+    slicer.app.processEvents()
 
     # Perform registration
-    message = self.logic.registerExperimentalFilmToPlanDose()
+    message = self.logic.startExperimentalFilmToPlanDoseRegistration(self.onRegistrationCompleted, self.onRegistrationProgressUpdated)
     if message != "":
-      qt.QMessageBox.critical(None, 'Error when performing calibration', message)
-      logging.error(message)
+      self.onRegistrationCompleted(message)
 
-    qt.QApplication.restoreOverrideCursor()
+  #------------------------------------------------------------------------------
+  def onRegistrationProgressUpdated(self, progressPercent):
+    if self.registrationProgressDialog:
+      self.registrationProgressDialog.value = progressPercent
+
+  #------------------------------------------------------------------------------
+  def onRegistrationCancelRequested(self):
+    self.registrationCancelRequested = True
+    self.logic.cancelExperimentalFilmToPlanDoseRegistration()
+
+  #------------------------------------------------------------------------------
+  def onRegistrationCompleted(self, message):
+    if self.registrationProgressDialog:
+      self.registrationProgressDialog.disconnect('canceled()', self.onRegistrationCancelRequested)
+      self.registrationProgressDialog.hide()
+      self.registrationProgressDialog = None
+    self.step4_performRegistrationButton.enabled = True
+
+    if message != "":
+      if not self.registrationCancelRequested:
+        qt.QMessageBox.critical(None, 'Error when performing registration', message)
+      logging.error(message)
+      return
 
     # Show registered images
+    [registrationFilmVolumeNode, registrationPlanDoseVolumeNode] = self.logic.getRegistrationVolumeNodes()
     appLogic = slicer.app.applicationLogic()
     selectionNode = appLogic.GetSelectionNode()
-    selectionNode.SetActiveVolumeID(self.logic.paddedCalibratedExperimentalFilmVolumeNode.GetID())
-    selectionNode.SetSecondaryVolumeID(self.logic.paddedPlanDoseSliceVolumeNode.GetID())
+    selectionNode.SetActiveVolumeID(registrationFilmVolumeNode.GetID())
+    selectionNode.SetSecondaryVolumeID(registrationPlanDoseVolumeNode.GetID())
     appLogic.PropagateVolumeSelection()
 
     # Disable pre-alignment controls, because they cannot be used after registration
@@ -1612,8 +1706,6 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
   #------------------------------------------------------------------------------
   def onGammaDoseComparison(self):
     try:
-      slicer.modules.dosecomparison
-
       if self.step5_gammaVolumeSelector.currentNode() is None:
         qt.QMessageBox.warning(None, 'Warning', 'Gamma volume not selected. If there is no suitable output gamma volume, create one.')
         return
@@ -1621,49 +1713,44 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
         self.logic.gammaVolumeNode = self.step5_gammaVolumeSelector.currentNode()
 
       # Set up gamma computation parameters
-      gammaParameterSetNode = slicer.vtkMRMLDoseComparisonNode()
-      slicer.mrmlScene.AddNode(gammaParameterSetNode)
-      gammaParameterSetNode.SetAndObserveReferenceDoseVolumeNode(self.logic.croppedPlanDoseSliceVolumeNode)
-      gammaParameterSetNode.SetAndObserveCompareDoseVolumeNode(self.logic.calibratedExperimentalFilmVolumeNode)
-      gammaParameterSetNode.SetAndObserveMaskSegmentationNode(self.logic.maskSegmentationNode)
-      if self.logic.maskSegmentID is not None and self.logic.maskSegmentID != '':
-        gammaParameterSetNode.SetMaskSegmentID(self.logic.maskSegmentID)
-      else:
-        gammaParameterSetNode.SetMaskSegmentID(None)
-      gammaParameterSetNode.SetAndObserveGammaVolumeNode(self.logic.gammaVolumeNode)
-      gammaParameterSetNode.SetDtaDistanceToleranceMm(self.step5_dtaDistanceToleranceMmSpinBox.value)
-      gammaParameterSetNode.SetDoseDifferenceTolerancePercent(self.step5_doseDifferenceTolerancePercentSpinBox.value)
-      gammaParameterSetNode.SetUseMaximumDose(self.step5_referenceDoseUseMaximumDoseRadioButton.isChecked())
-      gammaParameterSetNode.SetUseLinearInterpolation(self.step5_useLinearInterpolationCheckBox.isChecked())
-      gammaParameterSetNode.SetReferenceDoseGy(self.step5_referenceDoseCustomValueCGySpinBox.value / 100.0)
-      gammaParameterSetNode.SetAnalysisThresholdPercent(self.step5_analysisThresholdPercentSpinBox.value)
-      gammaParameterSetNode.SetDoseThresholdOnReferenceOnly(True)
-      gammaParameterSetNode.SetMaximumGamma(self.step5_maximumGammaSpinBox.value)
-
-      # Create progress bar
-      from vtkSlicerRtCommonPython import SlicerRtCommon
-      doseComparisonLogic = slicer.modules.dosecomparison.logic()
-      self.addObserver(doseComparisonLogic, SlicerRtCommon.ProgressUpdated, self.onGammaProgressUpdated)
-      self.gammaProgressDialog = qt.QProgressDialog(self.parent)
-      self.gammaProgressDialog.setModal(True)
-      self.gammaProgressDialog.setMinimumDuration(150)
-      self.gammaProgressDialog.labelText = "Computing gamma dose difference..."
-      self.gammaProgressDialog.show()
-      slicer.app.processEvents()
+      self.logic.useBuiltInGammaEngine = self.step5_useBuiltInGammaEngineCheckBox.isChecked()
+      self.logic.gammaDtaDistanceToleranceMm = self.step5_dtaDistanceToleranceMmSpinBox.value
+      self.logic.gammaDoseDifferenceTolerancePercent = self.step5_doseDifferenceTolerancePercentSpinBox.value
+      self.logic.gammaUseMaximumDose = self.step5_referenceDoseUseMaximumDoseRadioButton.isChecked()
+      self.logic.gammaUseLinearInterpolation = self.step5_useLinearInterpolationCheckBox.isChecked()
+      self.logic.gammaUseEarlyTermination = self.step5_useEarlyTerminationCheckBox.isChecked()
+      self.logic.gammaNormalizationMode = self.step5_normalizationModeComboBox.currentText
+      self.logic.gammaReferenceDoseGy = self.step5_referenceDoseCustomValueCGySpinBox.value / 100.0
+      self.logic.gammaAnalysisThresholdPercent = self.step5_analysisThresholdPercentSpinBox.value
+      self.logic.gammaMaximumGamma = self.step5_maximumGammaSpinBox.value
+
+      # Create progress bar (only the dose comparison module reports progress)
+      doseComparisonLogic = None
+      if not self.logic.useBuiltInGammaEngine:
+        from vtkSlicerRtCommonPython import SlicerRtCommon
+        doseComparisonLogic = slicer.modules.dosecomparison.logic()
+        self.addObserver(doseComparisonLogic, SlicerRtCommon.ProgressUpdated, self.onGammaProgressUpdated)
+        self.gammaProgressDialog = qt.QProgressDialog(self.parent)
+        self.gammaProgressDialog.setModal(True)
+        self.gammaProgressDialog.setMinimumDuration(150)
+        self.gammaProgressDialog.labelText = "Computing gamma dose difference..."
+        self.gammaProgressDialog.show()
+        slicer.app.processEvents()
 
       # Perform gamma comparison
       qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.BusyCursor))
-      errorMessage = doseComparisonLogic.ComputeGammaDoseDifference(gammaParameterSetNode)
+      errorMessage = self.logic.computeGammaDoseComparison()
 
-      self.gammaProgressDialog.hide()
-      self.gammaProgressDialog = None
-      self.removeObserver(doseComparisonLogic, SlicerRtCommon.ProgressUpdated, self.onGammaProgressUpdated)
+      if doseComparisonLogic is not None:
+        self.gammaProgressDialog.hide()
+        self.gammaProgressDialog = None
+        self.removeObserver(doseComparisonLogic, SlicerRtCommon.ProgressUpdated, self.onGammaProgressUpdated)
       qt.QApplication.restoreOverrideCursor()
 
-      if gammaParameterSetNode.GetResultsValid():
-        self.step5_gammaStatusLabel.setText('Gamma dose comparison succeeded\nPass fraction: {0:.2f}%'.format(gammaParameterSetNode.GetPassFractionPercent()))
+      if errorMessage == '':
+        self.step5_gammaStatusLabel.setText('Gamma dose comparison succeeded\nPass fraction: {0:.2f}%'.format(self.logic.gammaPassFractionPercent))
         self.step5_showGammaReportButton.enabled = True
-        self.gammaReport = gammaParameterSetNode.GetReportString()
+        self.gammaReport = self.logic.gammaReport
       else:
         self.step5_gammaStatusLabel.setText(errorMessage)
         self.step5_showGammaReportButton.enabled = False
@@ -1695,6 +1782,7 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
       gammaDisplayNode = self.logic.gammaVolumeNode.GetDisplayNode()
       gammaDisplayNode.AutoWindowLevelOff()
       gammaDisplayNode.SetWindowLevelMinMax(0, maximumGamma)
+      # Pixels that were not evaluated (negative gamma) are hidden by the threshold
       gammaDisplayNode.ApplyThresholdOn()
       gammaDisplayNode.AutoThresholdOff()
       gammaDisplayNode.SetLowerThreshold(0.001)
@@ -1762,23 +1850,64 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
       self.gammaLineProfileArrayNode = slicer.vtkMRMLDoubleArrayNode()
       slicer.mrmlScene.AddNode(self.gammaLineProfileArrayNode)
 
-    lineProfileLogic = LineProfileLogic()
+    lineProfileLogic = self.lineProfileLogic
     lineResolutionMm = float(self.stepT1_lineResolutionMmSliderWidget.value)
     selectedRuler = self.stepT1_inputRulerSelector.currentNode()
     rulerLengthMm = lineProfileLogic.computeRulerLength(selectedRuler)
     numberOfLineSamples = int( (rulerLengthMm / lineResolutionMm) + 0.5 )
+    # Only the samples inside the mask structure are shown if a mask is selected (the rasterized mask is cached)
+    [rulerStartPointRas, rulerEndPointRas] = lineProfileLogic.getRulerEndPointsRas(selectedRuler)
+    sampleMask = self.logic.getLineProfileSampleMask(rulerStartPointRas, rulerEndPointRas, numberOfLineSamples)
 
     # Get number of samples based on selected sampling density
+    # Profiles of the plan dose, calibrated film and gamma are sampled together along the ruler
+    volumes = []
+    outputArrays = []
     if self.logic.croppedPlanDoseSliceVolumeNode:
-      lineProfileLogic.run(self.logic.croppedPlanDoseSliceVolumeNode, selectedRuler, self.planDoseLineProfileArrayNode, numberOfLineSamples)
+      volumes.append(self.logic.croppedPlanDoseSliceVolumeNode)
+      outputArrays.append(self.planDoseLineProfileArrayNode)
     if self.logic.calibratedExperimentalFilmVolumeNode:
-      lineProfileLogic.run(self.logic.calibratedExperimentalFilmVolumeNode, selectedRuler, self.calibratedExperimentalFilmLineProfileArrayNode, numberOfLineSamples)
+      volumes.append(self.logic.calibratedExperimentalFilmVolumeNode)
+      outputArrays.append(self.calibratedExperimentalFilmLineProfileArrayNode)
     if self.logic.gammaVolumeNode:
-      lineProfileLogic.run(self.logic.gammaVolumeNode, selectedRuler, self.gammaLineProfileArrayNode, numberOfLineSamples)
+      volumes.append(self.logic.gammaVolumeNode)
+      outputArrays.append(self.gammaLineProfileArrayNode)
+    # Gamma samples of pixels that are not evaluated are left out of the gamma profile
+    lineProfileLogic.computeProfiles([selectedRuler], volumes, numberOfLineSamples, [sampleMask], [outputArrays], [self.logic.gammaVolumeNode])
 
   #------------------------------------------------------------------------------
   def onSelectLineProfileParameters(self):
     self.stepT1_createLineProfileButton.enabled = self.logic.croppedPlanDoseSliceVolumeNode and self.logic.calibratedExperimentalFilmVolumeNode and self.stepT1_inputRulerSelector.currentNode()
+    self.updateLineProfileRulerObservation()
+
+  #------------------------------------------------------------------------------
+  def updateLineProfileRulerObservation(self):
+    # Observe the selected ruler if live update is enabled
+    rulerNode = self.stepT1_inputRulerSelector.currentNode() if self.stepT1_liveUpdateCheckBox.checked else None
+    if rulerNode == self.lineProfileObservedRulerNode:
+      return
+    if self.lineProfileObservedRulerNode is not None:
+      self.removeObserver(self.lineProfileObservedRulerNode, vtk.vtkCommand.ModifiedEvent, self.onLineProfileRulerModified)
+    self.lineProfileObservedRulerNode = rulerNode
+    if rulerNode is not None:
+      self.addObserver(rulerNode, vtk.vtkCommand.ModifiedEvent, self.onLineProfileRulerModified)
+
+  #------------------------------------------------------------------------------
+  def onLineProfileLiveUpdateToggled(self, checked):
+    self.updateLineProfileRulerObservation()
+    if checked and self.stepT1_createLineProfileButton.enabled:
+      self.onCreateLineProfileButton()
+
+  #------------------------------------------------------------------------------
+  def onLineProfileRulerModified(self, caller, event):
+    # Events arriving while the timer is running are covered by the update at timeout
+    if not self.stepT1_liveUpdateTimer.isActive():
+      self.stepT1_liveUpdateTimer.start()
+
+  #------------------------------------------------------------------------------
+  def onLineProfileLiveUpdateTimeout(self):
+    if self.stepT1_liveUpdateCheckBox.checked and self.stepT1_createLineProfileButton.enabled:
+      self.onCreateLineProfileButton()
 
   #------------------------------------------------------------------------------
   def onExportLineProfiles(self):
@@ -1801,10 +1930,12 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
 
       planDoseLineProfileArray = self.planDoseLineProfileArrayNode.GetArray()
       calibratedDoseLineProfileArray = self.calibratedExperimentalFilmLineProfileArrayNode.GetArray()
-      gammaLineProfileArray = None
+      gammaSamplesByDistance = None
       if hasattr(self, 'gammaLineProfileArrayNode'):
         data = [['PlanDose','CalibratedExperimentalFilmDose','Gamma']]
+        # Gamma profile has no samples where gamma is not evaluated, so its samples are matched by distance (empty if missing)
         gammaLineProfileArray = self.gammaLineProfileArrayNode.GetArray()
+        gammaSamplesByDistance = dict([gammaLineProfileArray.GetTuple(index)[0:2] for index in xrange(gammaLineProfileArray.GetNumberOfTuples())])
       else:
         data = [['PlanDose','CalibratedExperimentalFilmDose']]
 
@@ -1812,8 +1943,8 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
       for index in xrange(numOfSamples):
         planDoseSample = planDoseLineProfileArray.GetTuple(index)[1]
         calibratedDoseSample = calibratedDoseLineProfileArray.GetTuple(index)[1]
-        if gammaLineProfileArray:
-          gammaSample = gammaLineProfileArray.GetTuple(index)[1]
+        if gammaSamplesByDistance is not None:
+          gammaSample = gammaSamplesByDistance.get(planDoseLineProfileArray.GetTuple(index)[0], '')
           samples = [planDoseSample, calibratedDoseSample, gammaSample]
         else:
           samples = [planDoseSample, calibratedDoseSample]
@@ -1984,12 +2115,27 @@ class FilmDosimetryAnalysisTest(ScriptedLoadableModuleTest):
 # Main
 #
 if __name__ == "__main__":
-  #TODO: access and parse command line arguments
-  #   Example: SlicerRt/src/BatchProcessing
-  #   Ideally handle --xml
-
   import sys
+  import argparse
   logging.debug( sys.argv )
 
+  parser = argparse.ArgumentParser(description='Film dosimetry analysis')
+  parser.add_argument('--batch', dest='jobManifestFilePath', default=None,
+    help='Process the jobs of a JSON or CSV job manifest without user interface, then exit')
+  parser.add_argument('--output-directory', dest='outputDirectory', default=None,
+    help='Directory of the batch results (default: directory of the job manifest)')
+  parser.add_argument('--processes', dest='numberOfProcesses', type=int, default=1,
+    help='Number of jobs processed in parallel worker processes (0: number of processors)')
+  parser.add_argument('--results-file', dest='resultsFilePath', default=None,
+    help='Batch results file (default: time stamped file in the output directory)')
+  [args, unknownArgs] = parser.parse_known_args(sys.argv[1:])
+
+  if args.jobManifestFilePath is not None:
+    batchProcessingLogic = BatchProcessingLogic()
+    numberOfProcesses = args.numberOfProcesses if args.numberOfProcesses > 0 else None
+    results = batchProcessingLogic.runJobManifest(args.jobManifestFilePath, args.outputDirectory, numberOfProcesses, args.resultsFilePath)
+    succeeded = results is not None and all(result['status'] == '' for result in results)
+    sys.exit(0 if succeeded else 1)
+
   mainFrame = qt.QFrame()
   slicelet = FilmDosimetryAnalysisSlicelet(mainFrame)
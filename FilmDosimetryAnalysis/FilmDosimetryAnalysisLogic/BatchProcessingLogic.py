@@ -0,0 +1,450 @@
+from __main__ import vtk, qt, ctk, slicer
+from FilmDosimetryAnalysisLogic import *
+import os
+import re
+import sys
+import time
+import csv
+import json
+import logging
+import shutil
+import subprocess
+import tempfile
+import multiprocessing
+
+#
+# BatchProcessingLogic
+#
+class BatchProcessingLogic:
+  """ Headless film dosimetry analysis of a batch of films.
+      Each job of the job manifest is processed with FilmDosimetryAnalysisLogic (calibration, cropping,
+      registration, gamma) without widgets or message boxes, and the results and timings are written to files.
+  """
+
+  def __init__(self):
+    self.jobColumnNames = ['name', 'film', 'floodField', 'floodFieldValue', 'calibrationFunction', 'planDose',
+      'orientation', 'slicePosition', 'pixelSpacing', 'calibrationCoefficients', 'dtaDistanceToleranceMm', 'doseDifferenceTolerancePercent', 'analysisThresholdPercent']
+    self.resultColumnNames = ['name', 'status', 'passFractionPercent', 'loadingSeconds', 'calibrationSeconds',
+      'registrationInitializationSeconds', 'registrationSeconds', 'gammaSeconds', 'totalSeconds']
+    self.resultsFileNamePostfix = 'FilmDosimetryBatchResults.csv'
+    self.validJobNamePattern = r'^[A-Za-z0-9_\-][A-Za-z0-9_\-. ]*$' # Job names are used in output file names, so they cannot contain path separators
+    self.clearSceneAfterJobs = True # Remove the nodes of a job from the scene when it is done, so that memory use does not grow
+    self.jobTimeoutSeconds = None # Worker processes running longer than this are terminated and their job fails (no limit if None)
+    self.workerPollIntervalSeconds = 0.2
+
+    self.throughputFilmsPerHour = None
+
+  #------------------------------------------------------------------------------
+  def readJobManifest(self, manifestFilePath):
+    # Jobs of a JSON manifest (list of job objects, or an object with a 'jobs' list) or a CSV manifest
+    # (header row with the job column names). Returns the list of job dictionaries, None if the manifest cannot be read
+    try:
+      if os.path.splitext(manifestFilePath)[1].lower() == '.csv':
+        with open(manifestFilePath, 'r') as manifestFile:
+          jobs = [dict((key.strip(), value.strip()) for key, value in row.items() if key is not None and value is not None and value.strip() != '')
+            for row in csv.DictReader(manifestFile)]
+      else:
+        with open(manifestFilePath, 'r') as manifestFile:
+          jobs = json.load(manifestFile)
+        if isinstance(jobs, dict):
+          jobs = jobs.get('jobs', [])
+    except (IOError, ValueError) as e:
+      logging.error("Failed to read job manifest " + manifestFilePath + ": " + str(e))
+      return None
+
+    for jobIndex, job in enumerate(jobs):
+      if 'name' not in job:
+        job['name'] = 'Job' + str(jobIndex+1)
+      unknownColumnNames = [key for key in job.keys() if key not in self.jobColumnNames]
+      if len(unknownColumnNames) > 0:
+        logging.warning("Unknown job parameters are ignored in job " + str(job['name']) + ": " + ', '.join(unknownColumnNames))
+
+    message = self.validateJobNames(jobs)
+    if message != '':
+      logging.error("Invalid job manifest " + manifestFilePath + ": " + message)
+      return None
+    return jobs
+
+  #------------------------------------------------------------------------------
+  def validateJobNames(self, jobs):
+    # Output files of the jobs are named after the jobs, so names need to be valid file names and unique
+    # (also when case is ignored, as on Windows and macOS file systems, and jobs running in parallel would overwrite
+    # each other's files otherwise). Returns error message
+    jobNames = set()
+    for job in jobs:
+      jobName = str(job['name'])
+      if re.match(self.validJobNamePattern, jobName) is None:
+        return "Job name '" + jobName + "' is not a valid file name (letters, digits, spaces, '_', '-' and '.' can be used)"
+      if jobName.lower() in jobNames:
+        return "Job name '" + jobName + "' is used by more than one job"
+      jobNames.add(jobName.lower())
+    return ''
+
+  #------------------------------------------------------------------------------
+  def runJobManifest(self, manifestFilePath, outputDirectory=None, numberOfProcesses=1, resultsFilePath=None):
+    # Run the jobs of a manifest. Results are written to outputDirectory (directory of the manifest if None)
+    jobs = self.readJobManifest(manifestFilePath)
+    if jobs is None:
+      return None
+    if outputDirectory is None:
+      outputDirectory = os.path.dirname(os.path.abspath(manifestFilePath))
+    return self.runJobs(jobs, outputDirectory, numberOfProcesses, resultsFilePath)
+
+  #------------------------------------------------------------------------------
+  def runJobs(self, jobs, outputDirectory, numberOfProcesses=1, resultsFilePath=None):
+    # Run jobs one after the other, or in parallel worker processes if numberOfProcesses > 1 (number of processors
+    # if None). A failing job does not stop the batch, its error message is in its result.
+    # Returns the results (dictionaries with resultColumnNames keys) in job order
+    if not os.access(outputDirectory, os.F_OK):
+      os.makedirs(outputDirectory)
+    if numberOfProcesses is None:
+      numberOfProcesses = multiprocessing.cpu_count()
+
+    startTime = time.time()
+    if numberOfProcesses > 1 and len(jobs) > 1:
+      results = self.runJobsInWorkerProcesses(jobs, outputDirectory, numberOfProcesses)
+    else:
+      results = []
+      for job in jobs:
+        logging.info("Processing film dosimetry job " + str(job['name']))
+        result = self.runJob(job, outputDirectory)
+        self.logJobResult(result)
+        results.append(result)
+
+    totalSeconds = time.time() - startTime
+    self.throughputFilmsPerHour = len(jobs) * 3600.0 / totalSeconds if totalSeconds > 0 else None
+    self.writeResults(results, outputDirectory, resultsFilePath)
+    numberOfFailedJobs = len([result for result in results if result['status'] != ''])
+    logging.info("Processed {0} films ({1} failed) in {2:.1f}s, throughput: {3:.1f} films per hour".format(
+      len(jobs), numberOfFailedJobs, totalSeconds, self.throughputFilmsPerHour or 0.0))
+    return results
+
+  #------------------------------------------------------------------------------
+  def logJobResult(self, result):
+    if result['status'] == '':
+      logging.info("Job {0} finished in {1:.1f}s, gamma pass fraction {2:.2f}%".format(result['name'], result['totalSeconds'], result['passFractionPercent']))
+    else:
+      logging.error("Job " + str(result['name']) + " failed: " + result['status'])
+
+  #------------------------------------------------------------------------------
+  def runJobsInWorkerProcesses(self, jobs, outputDirectory, numberOfProcesses):
+    # Each job runs in a separate headless Slicer process, so that errors and even crashes only affect that job.
+    # At most numberOfProcesses jobs run at the same time. Returns the results in job order
+    workDirectory = tempfile.mkdtemp(prefix='FilmDosimetryBatch_')
+    runningWorkers = {}
+    try:
+      jobs = self.prepareSharedJobInputs(jobs, workDirectory)
+      results = [None] * len(jobs)
+      pendingJobIndices = list(range(len(jobs)))
+      runningWorkers = {} # Job index -> [process, start time, results file path, log file]
+      while len(pendingJobIndices) > 0 or len(runningWorkers) > 0:
+        while len(pendingJobIndices) > 0 and len(runningWorkers) < numberOfProcesses:
+          jobIndex = pendingJobIndices.pop(0)
+          logging.info("Starting worker process for film dosimetry job " + str(jobs[jobIndex]['name']))
+          try:
+            runningWorkers[jobIndex] = self.startWorkerProcess(jobs[jobIndex], jobIndex, outputDirectory, workDirectory)
+          except (IOError, OSError) as e:
+            # Only this job fails (e.g. its log file cannot be created)
+            results[jobIndex] = self.createFailedJobResult(jobs[jobIndex], "Failed to start worker process: " + str(e), 0.0)
+            self.logJobResult(results[jobIndex])
+        if len(runningWorkers) == 0:
+          continue
+        time.sleep(self.workerPollIntervalSeconds)
+
+        for jobIndex in list(runningWorkers.keys()):
+          [process, workerStartTime, workerResultsFilePath, logFile] = runningWorkers[jobIndex]
+          timedOut = False
+          if process.poll() is None:
+            if self.jobTimeoutSeconds is None or time.time() - workerStartTime < self.jobTimeoutSeconds:
+              continue
+            process.kill()
+            process.wait()
+            timedOut = True
+          logFile.close()
+          del runningWorkers[jobIndex]
+          results[jobIndex] = self.getWorkerResult(jobs[jobIndex], process.returncode, timedOut, workerResultsFilePath, time.time() - workerStartTime)
+          self.logJobResult(results[jobIndex])
+    finally:
+      # Worker processes still running when the batch is interrupted are terminated, so that they do not
+      # outlive the batch and use the work directory after it is removed
+      for [process, workerStartTime, workerResultsFilePath, logFile] in runningWorkers.values():
+        if process.poll() is None:
+          process.kill()
+          process.wait()
+        logFile.close()
+      shutil.rmtree(workDirectory, ignore_errors=True)
+    return results
+
+  #------------------------------------------------------------------------------
+  def prepareSharedJobInputs(self, jobs, workDirectory):
+    # Plan doses used by the jobs are imported once: DICOM RT doses are converted to uncompressed NRRD files in the
+    # work directory, which the worker processes read through the file cache shared by all processes, instead of each
+    # worker importing DICOM again. Calibration coefficients are passed to the workers in the job manifest.
+    sharedPlanDoseFilePaths = {}
+    sharedCalibrationCoefficients = {}
+    preparedJobs = []
+    for job in jobs:
+      job = dict(job)
+      planDoseFilePath = job.get('planDose')
+      if planDoseFilePath is not None and os.path.splitext(planDoseFilePath)[1].lower() == '.dcm':
+        if planDoseFilePath not in sharedPlanDoseFilePaths:
+          sharedPlanDoseFilePaths[planDoseFilePath] = self.exportPlanDoseVolume(planDoseFilePath, workDirectory, len(sharedPlanDoseFilePaths))
+        if sharedPlanDoseFilePaths[planDoseFilePath] is not None:
+          job['planDose'] = sharedPlanDoseFilePaths[planDoseFilePath]
+      calibrationFunctionFilePath = job.get('calibrationFunction')
+      if calibrationFunctionFilePath is not None:
+        if calibrationFunctionFilePath not in sharedCalibrationCoefficients:
+          sharedCalibrationCoefficients[calibrationFunctionFilePath] = self.readCalibrationCoefficients(calibrationFunctionFilePath)
+        if sharedCalibrationCoefficients[calibrationFunctionFilePath] is not None:
+          job['calibrationCoefficients'] = sharedCalibrationCoefficients[calibrationFunctionFilePath]
+      preparedJobs.append(job)
+    if self.clearSceneAfterJobs:
+      slicer.mrmlScene.Clear(0)
+    return preparedJobs
+
+  #------------------------------------------------------------------------------
+  def exportPlanDoseVolume(self, planDoseFilePath, workDirectory, planDoseIndex):
+    # Save plan dose as uncompressed NRRD file. Returns file path, None if the plan dose cannot be loaded
+    # (then the worker reports the loading error)
+    planDoseVolumeNode = self.loadPlanDoseVolume(planDoseFilePath)
+    if planDoseVolumeNode is None:
+      return None
+    exportedFilePath = os.path.join(workDirectory, 'PlanDose' + str(planDoseIndex) + '.nrrd')
+    if not slicer.util.saveNode(planDoseVolumeNode, exportedFilePath, {'useCompression': 0}):
+      return None
+    return exportedFilePath
+
+  #------------------------------------------------------------------------------
+  def readCalibrationCoefficients(self, calibrationFunctionFilePath):
+    # Calibration coefficients from calibration function file, None if the file is invalid
+    logic = FilmDosimetryAnalysisLogic()
+    try:
+      if logic.loadCalibrationFunctionFromFile(calibrationFunctionFilePath) != '':
+        return None
+    except (IOError, ValueError):
+      return None
+    return list(logic.calibrationCoefficients)
+
+  #------------------------------------------------------------------------------
+  def startWorkerProcess(self, job, jobIndex, outputDirectory, workDirectory):
+    # Start headless Slicer running the module script in batch mode on a manifest containing only this job
+    jobManifestFilePath = os.path.join(workDirectory, 'Job' + str(jobIndex) + '.json')
+    with open(jobManifestFilePath, 'w') as jobManifestFile:
+      json.dump([job], jobManifestFile)
+    workerResultsFilePath = os.path.join(workDirectory, 'Job' + str(jobIndex) + '_' + self.resultsFileNamePostfix)
+    logFile = open(os.path.join(outputDirectory, str(job['name']) + '_Log.txt'), 'w')
+    command = [self.getSlicerExecutableFilePath(), '--no-splash', '--no-main-window', '--python-script', self.getModuleScriptFilePath(),
+      '--batch', jobManifestFilePath, '--output-directory', outputDirectory, '--results-file', workerResultsFilePath]
+    try:
+      process = subprocess.Popen(command, stdout=logFile, stderr=subprocess.STDOUT)
+    except:
+      logFile.close()
+      raise
+    return [process, time.time(), workerResultsFilePath, logFile]
+
+  #------------------------------------------------------------------------------
+  def getWorkerResult(self, job, returnCode, timedOut, workerResultsFilePath, elapsedSeconds):
+    # Result of a job from the results file written by its worker process
+    results = []
+    if os.path.exists(workerResultsFilePath):
+      try:
+        results = self.readResults(workerResultsFilePath)
+      except (IOError, ValueError) as e:
+        logging.error("Failed to read results of job " + str(job['name']) + ": " + str(e))
+    if len(results) == 1 and not timedOut:
+      return results[0]
+    if timedOut:
+      return self.createFailedJobResult(job, "Worker process timed out after " + str(self.jobTimeoutSeconds) + "s", elapsedSeconds)
+    return self.createFailedJobResult(job, "Worker process exited with code " + str(returnCode) + " without results", elapsedSeconds)
+
+  #------------------------------------------------------------------------------
+  def createFailedJobResult(self, job, status, elapsedSeconds):
+    result = dict((columnName, None) for columnName in self.resultColumnNames)
+    result['name'] = job['name']
+    result['status'] = status
+    result['totalSeconds'] = elapsedSeconds
+    return result
+
+  #------------------------------------------------------------------------------
+  def getSlicerExecutableFilePath(self):
+    # The launcher sets up the environment of the application, so it is preferred if available
+    launcherFilePath = getattr(slicer.app, 'launcherExecutableFilePath', '')
+    return launcherFilePath if launcherFilePath else slicer.app.applicationFilePath()
+
+  #------------------------------------------------------------------------------
+  def getModuleScriptFilePath(self):
+    moduleDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(moduleDirectory, 'FilmDosimetryAnalysis.py')
+
+  #------------------------------------------------------------------------------
+  def runJob(self, job, outputDirectory):
+    # Process one film. Returns the result dictionary, its status is empty on success, the error message otherwise
+    result = dict((columnName, None) for columnName in self.resultColumnNames)
+    result['name'] = job['name']
+    jobStartTime = time.time()
+    try:
+      result['status'] = self.processJob(job, outputDirectory, result)
+    except Exception as e:
+      # Unexpected errors (e.g. unreadable input files) only fail the current job
+      logging.exception("Unexpected error in job " + str(job['name']))
+      result['status'] = "Unexpected error: " + str(e)
+    result['totalSeconds'] = time.time() - jobStartTime
+
+    if self.clearSceneAfterJobs:
+      slicer.mrmlScene.Clear(0)
+    return result
+
+  #------------------------------------------------------------------------------
+  def processJob(self, job, outputDirectory, result):
+    # Steps of the film dosimetry workflow for one job. Step timings are stored in result. Returns error message
+    logic = FilmDosimetryAnalysisLogic()
+
+    # Load data
+    stepStartTime = time.time()
+    message = self.setJobParameters(logic, job)
+    if message != '':
+      return message
+    logic.experimentalFilmVolumeNode = self.loadVolume(job['film'])
+    if logic.experimentalFilmVolumeNode is None:
+      return "Failed to load experimental film " + job['film']
+    if 'floodField' in job:
+      logic.experimentalFloodFieldVolumeNode = self.loadVolume(job['floodField'])
+      if logic.experimentalFloodFieldVolumeNode is None:
+        return "Failed to load flood field image " + job['floodField']
+    logic.planDoseVolumeNode = self.loadPlanDoseVolume(job['planDose'])
+    if logic.planDoseVolumeNode is None:
+      return "Failed to load plan dose " + job['planDose']
+    if 'calibrationCoefficients' in job:
+      logic.calibrationCoefficients = [float(coefficient) for coefficient in job['calibrationCoefficients']]
+    else:
+      message = logic.loadCalibrationFunctionFromFile(job['calibrationFunction'])
+      if message != '':
+        return message
+    # Only the red channel of RGB scans is used
+    logic.experimentalFloodFieldVolumeNode = logic.extractRedChannel(logic.experimentalFloodFieldVolumeNode)
+    logic.experimentalFilmVolumeNode = logic.extractRedChannel(logic.experimentalFilmVolumeNode)
+    result['loadingSeconds'] = time.time() - stepStartTime
+
+    # Apply calibration
+    stepStartTime = time.time()
+    message = logic.applyCalibrationOnExperimentalFilm()
+    if message != '':
+      return message
+    result['calibrationSeconds'] = time.time() - stepStartTime
+
+    # Crop plan dose to the film slice and pre-align the film
+    stepStartTime = time.time()
+    message = logic.initializeFilmToPlanDoseRegistration()
+    if message != '':
+      return message
+    result['registrationInitializationSeconds'] = time.time() - stepStartTime
+
+    # Register film to plan dose slice
+    stepStartTime = time.time()
+    message = logic.registerExperimentalFilmToPlanDose()
+    if message != '':
+      return message
+    result['registrationSeconds'] = time.time() - stepStartTime
+
+    # Gamma dose comparison
+    stepStartTime = time.time()
+    logic.gammaVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+    logic.gammaVolumeNode.SetName(slicer.mrmlScene.GenerateUniqueName(str(job['name']) + '_Gamma'))
+    slicer.mrmlScene.AddNode(logic.gammaVolumeNode)
+    message = logic.computeGammaDoseComparison()
+    if message != '':
+      return message
+    result['gammaSeconds'] = time.time() - stepStartTime
+    result['passFractionPercent'] = logic.gammaPassFractionPercent
+
+    return self.writeJobOutputs(logic, job, outputDirectory)
+
+  #------------------------------------------------------------------------------
+  def setJobParameters(self, logic, job):
+    # Film geometry and gamma parameters of the job. Returns error message
+    for requiredColumnName in ['film', 'planDose', 'orientation', 'slicePosition', 'pixelSpacing']:
+      if requiredColumnName not in job:
+        return "Missing job parameter: " + requiredColumnName
+    if 'calibrationFunction' not in job and 'calibrationCoefficients' not in job:
+      return "Either calibration function file or calibration coefficients need to be specified"
+    if 'floodField' not in job and 'floodFieldValue' not in job:
+      return "Either flood field image or flood field value needs to be specified"
+    if job['orientation'] not in [AXIAL, CORONAL, SAGITTAL]:
+      return "Invalid film orientation: " + str(job['orientation'])
+
+    try:
+      logic.experimentalFilmSliceOrientation = job['orientation']
+      logic.experimentalFilmSlicePosition = float(job['slicePosition'])
+      logic.experimentalFilmPixelSpacing = float(job['pixelSpacing'])
+      if 'floodFieldValue' in job:
+        logic.experimentalFloodFieldValue = float(job['floodFieldValue'])
+      if 'dtaDistanceToleranceMm' in job:
+        logic.gammaDtaDistanceToleranceMm = float(job['dtaDistanceToleranceMm'])
+      if 'doseDifferenceTolerancePercent' in job:
+        logic.gammaDoseDifferenceTolerancePercent = float(job['doseDifferenceTolerancePercent'])
+      if 'analysisThresholdPercent' in job:
+        logic.gammaAnalysisThresholdPercent = float(job['analysisThresholdPercent'])
+    except ValueError as e:
+      return "Invalid numeric job parameter: " + str(e)
+    return ''
+
+  #------------------------------------------------------------------------------
+  def loadVolume(self, filePath):
+    # Volume node loaded from file, None if loading failed
+    [success, volumeNode] = slicer.util.loadVolume(filePath, returnNode=True)
+    return volumeNode if success else None
+
+  #------------------------------------------------------------------------------
+  def loadPlanDoseVolume(self, filePath):
+    # Plan dose volume loaded from a DICOM RT dose file or from any volume file format
+    if os.path.splitext(filePath)[1].lower() != '.dcm':
+      return self.loadVolume(filePath)
+
+    existingVolumeNodes = slicer.util.getNodes('vtkMRMLScalarVolumeNode*').values()
+    dicomRtPluginInstance = slicer.modules.dicomPlugins['DicomRtImportExportPlugin']()
+    loadables = dicomRtPluginInstance.examineForImport([[filePath]])
+    if len(loadables) == 0 or not dicomRtPluginInstance.load(loadables[0]):
+      return None
+    loadedVolumeNodes = [node for node in slicer.util.getNodes('vtkMRMLScalarVolumeNode*').values() if node not in existingVolumeNodes]
+    return loadedVolumeNodes[0] if len(loadedVolumeNodes) > 0 else None
+
+  #------------------------------------------------------------------------------
+  def writeJobOutputs(self, logic, job, outputDirectory):
+    # Save gamma volume and gamma report of the job. Returns error message
+    outputFilePathPrefix = os.path.join(outputDirectory, str(job['name']))
+    if not slicer.util.saveNode(logic.gammaVolumeNode, outputFilePathPrefix + '_Gamma.nrrd'):
+      return "Failed to save gamma volume to " + outputFilePathPrefix + '_Gamma.nrrd'
+    with open(outputFilePathPrefix + '_GammaReport.txt', 'w') as reportFile:
+      reportFile.write(logic.gammaReport)
+    return ''
+
+  #------------------------------------------------------------------------------
+  def writeResults(self, results, outputDirectory, resultsFilePath=None):
+    # Results and timings of all jobs in a CSV file, and the throughput in the last row.
+    # The file is created in outputDirectory with a time stamped name if resultsFilePath is None
+    from time import gmtime, strftime
+    if resultsFilePath is None:
+      resultsFilePath = os.path.join(outputDirectory, strftime("%Y%m%d_%H%M%S_", gmtime()) + self.resultsFileNamePostfix)
+    with open(resultsFilePath, 'wb' if sys.version_info[0] < 3 else 'w') as resultsFile:
+      resultsWriter = csv.writer(resultsFile)
+      resultsWriter.writerow(self.resultColumnNames)
+      for result in results:
+        resultsWriter.writerow(['' if result[columnName] is None else result[columnName] for columnName in self.resultColumnNames])
+      resultsWriter.writerow([])
+      resultsWriter.writerow(['Throughput (films per hour)', self.throughputFilmsPerHour])
+    logging.info("Batch results written to " + resultsFilePath)
+    return resultsFilePath
+
+  #------------------------------------------------------------------------------
+  def readResults(self, resultsFilePath):
+    # Job results from a results file written by writeResults
+    results = []
+    with open(resultsFilePath, 'r') as resultsFile:
+      for row in csv.reader(resultsFile):
+        if len(row) != len(self.resultColumnNames) or row == self.resultColumnNames:
+          continue
+        result = dict(zip(self.resultColumnNames, row))
+        for columnName in self.resultColumnNames[2:]:
+          result[columnName] = float(result[columnName]) if result[columnName] != '' else None
+        results.append(result)
+    return results
@@ -0,0 +1,149 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import numpy
+
+#
+# DiskCacheLogic
+#
+class DiskCacheLogic:
+  """ Persistent content-addressed cache of NumPy arrays in a directory.
+      Entries are keyed by hashes of the inputs they were computed from, stored as .npy files and loaded
+      memory-mapped. Least recently used entries are removed when the cache grows above its maximum size.
+      Several processes can use the same cache directory. Only uses NumPy, so it can be used without Slicer.
+  """
+
+  def __init__(self):
+    self.cacheDirectory = None # Caching is disabled if None
+    self.maximumSizeMb = 2048 # Least recently used entries are removed above this size
+    self.hashChunkSizeBytes = 16*1024*1024 # Arrays are hashed in chunks, so that they are not copied
+    self.staleTemporaryDirectorySeconds = 600 # Temporary directories not modified for this long are left by failed writers and are removed
+
+  #------------------------------------------------------------------------------
+  def getKey(self, keyItems):
+    # Key of an entry from the list of its inputs. Arrays are identified by their contents, numbers by their value
+    # and other items by their text
+    keyHash = hashlib.sha1()
+    for item in keyItems:
+      if isinstance(item, numpy.ndarray):
+        itemText = 'array:' + self.getArrayHash(item)
+      elif isinstance(item, (int, float, numpy.number)) and not isinstance(item, bool):
+        itemText = repr(float(item))
+      else:
+        itemText = str(item)
+      keyHash.update((itemText + '|').encode('utf-8'))
+    return keyHash.hexdigest()
+
+  #------------------------------------------------------------------------------
+  def getArrayHash(self, array):
+    # Hash of the type, shape and contents of an array
+    array = numpy.ascontiguousarray(array)
+    arrayHash = hashlib.sha1((str(array.dtype) + str(array.shape)).encode('utf-8'))
+    arrayBytes = array.reshape(-1).view(numpy.uint8)
+    for chunkStart in range(0, len(arrayBytes), self.hashChunkSizeBytes):
+      arrayHash.update(arrayBytes[chunkStart:chunkStart+self.hashChunkSizeBytes])
+    return arrayHash.hexdigest()
+
+  #------------------------------------------------------------------------------
+  def getArrays(self, key):
+    # Arrays of an entry, memory-mapped copy-on-write (modifying them does not modify the cache).
+    # Returns None if caching is disabled or the entry is not in the cache
+    if self.cacheDirectory is None or key is None:
+      return None
+    entryDirectoryPath = os.path.join(self.cacheDirectory, key)
+    if not os.path.isdir(entryDirectoryPath):
+      return None
+    try:
+      numberOfArrays = len([fileName for fileName in os.listdir(entryDirectoryPath) if fileName.endswith('.npy')])
+      arrays = [numpy.load(os.path.join(entryDirectoryPath, str(arrayIndex) + '.npy'), mmap_mode='c') for arrayIndex in range(numberOfArrays)]
+      # Modified time of the entry is the time of its last use
+      os.utime(entryDirectoryPath, None)
+    except (IOError, OSError, ValueError):
+      # Entry has just been removed by another process, or it is damaged
+      logging.debug("Failed to read disk cache entry " + entryDirectoryPath)
+      return None
+    return arrays
+
+  #------------------------------------------------------------------------------
+  def setArrays(self, key, arrays):
+    # Store arrays as an entry. The entry is written into a temporary directory that is then renamed,
+    # so other processes never read partially written entries
+    if self.cacheDirectory is None or key is None:
+      return
+    entryDirectoryPath = os.path.join(self.cacheDirectory, key)
+    if os.path.isdir(entryDirectoryPath):
+      return
+    temporaryDirectoryPath = None
+    try:
+      if not os.path.isdir(self.cacheDirectory):
+        os.makedirs(self.cacheDirectory)
+      # Temporary directories start with a dot, so they are not taken for entries
+      temporaryDirectoryPath = tempfile.mkdtemp(prefix='.', dir=self.cacheDirectory)
+      for arrayIndex in range(len(arrays)):
+        numpy.save(os.path.join(temporaryDirectoryPath, str(arrayIndex) + '.npy'), arrays[arrayIndex])
+      os.rename(temporaryDirectoryPath, entryDirectoryPath)
+    except (IOError, OSError) as e:
+      if temporaryDirectoryPath is not None:
+        shutil.rmtree(temporaryDirectoryPath, ignore_errors=True)
+      # Another process may have stored the same entry in the meantime
+      if not os.path.isdir(entryDirectoryPath):
+        logging.warning("Failed to store entry in disk cache " + str(self.cacheDirectory) + ": " + str(e))
+      return
+
+    self.removeLeastRecentlyUsedEntries()
+
+  #------------------------------------------------------------------------------
+  def removeLeastRecentlyUsedEntries(self):
+    # Remove entries, least recently used first, until the cache is not larger than maximumSizeMb.
+    # Temporary directories of entries being written are not counted, stale ones (left by processes that
+    # crashed while writing) are removed
+    entries = [] # [last use time, size, path]
+    cacheSizeBytes = 0
+    try:
+      entryNames = os.listdir(self.cacheDirectory)
+    except OSError:
+      # Cache directory removed by another process
+      return
+    for entryName in entryNames:
+      entryDirectoryPath = os.path.join(self.cacheDirectory, entryName)
+      if entryName.startswith('.'):
+        try:
+          if time.time() - os.path.getmtime(entryDirectoryPath) > self.staleTemporaryDirectorySeconds:
+            shutil.rmtree(entryDirectoryPath, ignore_errors=True)
+        except OSError:
+          # Renamed to an entry or removed by another process
+          pass
+        continue
+      try:
+        entrySizeBytes = sum([os.path.getsize(os.path.join(entryDirectoryPath, fileName)) for fileName in os.listdir(entryDirectoryPath)])
+        entryLastUseTime = os.path.getmtime(entryDirectoryPath)
+      except OSError:
+        # Removed by another process
+        continue
+      cacheSizeBytes += entrySizeBytes
+      entries.append([entryLastUseTime, entrySizeBytes, entryDirectoryPath])
+
+    entries.sort()
+    maximumSizeBytes = self.maximumSizeMb * 1024 * 1024
+    for [entryLastUseTime, entrySizeBytes, entryDirectoryPath] in entries:
+      if cacheSizeBytes <= maximumSizeBytes:
+        break
+      shutil.rmtree(entryDirectoryPath, ignore_errors=True)
+      cacheSizeBytes -= entrySizeBytes
+
+  #------------------------------------------------------------------------------
+  def getCacheSizeMb(self):
+    if self.cacheDirectory is None or not os.path.isdir(self.cacheDirectory):
+      return 0.0
+    cacheSizeBytes = 0
+    for directoryPath, directoryNames, fileNames in os.walk(self.cacheDirectory):
+      cacheSizeBytes += sum([os.path.getsize(os.path.join(directoryPath, fileName)) for fileName in fileNames])
+    return cacheSizeBytes / (1024.0 * 1024.0)
+
+  #------------------------------------------------------------------------------
+  def clear(self):
+    if self.cacheDirectory is not None:
+      shutil.rmtree(self.cacheDirectory, ignore_errors=True)
@@ -10,6 +10,10 @@ import shutil
 import ntpath
 import math
 from collections import OrderedDict
+from GammaLogic import *
+from FilmDosimetryCoreLogic import *
+from WorkflowStageLogic import *
+from DiskCacheLogic import *
 
 #
 # FilmDosimetryAnalysisLogic
@@ -30,20 +34,54 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     self.croppedPlanDoseVolumeNamePostfix = "_Slice"
     self.paddedForRegistrationVolumeNamePostfix = "_ForRegistration"
     self.numberOfSlicesToPad = 5
+    self.registrationSamplingPercentage = 0.05
+    self.registrationSamplingSeed = 1 # Fixed seed for the random metric samples so that registration is repeatable
+    self.registrationMaximumStepLength = 15 # Start with long-range translations
+    self.registrationMinimumStepLength = 0.001
+    self.registrationMaximumNumberOfIterations = 1500
+    self.registrationRelaxationFactor = 0.8 # Relax quickly
+    self.registrationGradientMagnitudeTolerance = 1e-8 # Stop on step length instead of gradient (metric gradients are small for dose images)
+    self.registrationRotationScale = 10000000 # Suppress rotation (optimizer scale of the rotation angle relative to the translations)
+    self.registrationTimeoutSeconds = 600 # BRAINSFit registration is cancelled if it does not complete in time
     self.experimentalFilmPreAlignmentTransformName = "ExperimentalFilmPreAlignmentTransform"
     self.experimentalFilmScanSetupAligmentTransformName = "ExperimentalFilmScanSetupAligmentTransform"
     self.experimentalFilmToDoseSliceInitializationTransformName = "ExperimentalFilmToDoseSliceInitializationTransform"
     self.experimentalFilmToDoseSliceTransformName = "ExperimentalFilmToDoseSliceTransform"
+    self.calibrationFunctionExponentMinimum = 1.0
+    self.calibrationFunctionExponentMaximum = 4.0
+    self.calibrationFunctionExponentSearchStep = 0.01 # Coarse search step, the exponent is then refined to the tolerance below
+    self.calibrationFunctionExponentTolerance = 1e-6
+    self.useDoseLookupTable = True # Convert unsigned integer film scans to dose using precomputed lookup tables
+    self.doseLookupTableBlockSize = 8192 # Number of pixels converted at once with logarithm tables, small enough to stay in cache
+    self.useStreamingCalibration = False # Calibrate the experimental film in row tiles, writing dose into a memory-mapped file
+    self.streamingCalibrationMaximumMemoryMb = 256 # Upper bound of the working memory used by streaming calibration
+    self.streamingCalibrationWorkingBytesPerPixel = 48 # Input tiles, optical density, masks and dose temporaries for one pixel
+    self.streamingCalibrationOutputDirectory = None # Directory of the memory-mapped dose files (unnamed temporary file if None)
+    self.streamingCalibrationStreamableFileExtensions = ['.mha', '.mhd'] # Formats read tile by tile (uncompressed MetaImage)
+    self.gammaEvaluationGridRefinementFactor = 1 # Gamma is evaluated on the plan dose slice grid subdivided by this factor
+    self.gammaNumberOfThreads = None # Number of threads of the built-in gamma engine (number of processors if None)
+    self.segmentMaskCacheMaximumNumberOfEntries = 8 # Least recently used segment masks are removed from the cache above this
+    self.useDiskCache = True # Keep dose conversion, plan dose slice and registration results on disk, so they are reused when a case is opened again
+    self.diskCacheDirectory = None # Directory of the disk cache ('FilmDosimetryAnalysis' in the application cache directory if None)
+    self.diskCacheMaximumSizeMb = 2048 # Least recently used results are removed from the disk cache above this
+    self.gammaCriteriaSweepColumnNames = ['DTA (mm)', 'Dose difference (%)', 'Analysis threshold (%)', 'Normalization', 'Evaluated pixels', 'Passing pixels', 'Pass fraction (%)']
 
     # Declare member variables (mainly for documentation)
     self.lastAddedRoiNode = None
     self.calibrationCoefficients = [0,0,0,0] # Calibration coefficients [a,b,c,n] in calibration function dose = a + b*OD + c*OD^n
     self.experimentalFloodFieldVolumeNode = None
+    self.experimentalFloodFieldValue = None # Uniform flood field pixel value. If set, it is used instead of the flood field image
     self.experimentalFilmVolumeNode = None
     self.experimentalFilmPixelSpacing = None
     self.experimentalFilmSliceOrientation = ''
     self.experimentalFilmSlicePosition = 0
     self.calculatedDoseDoubleArrayGy = None
+    self.coreLogic = FilmDosimetryCoreLogic() # Numeric computations on arrays, parameters are set from the members of this class
+    self.workflowStageLogic = WorkflowStageLogic() # Fingerprints of the stage results, so that only out of date stages are computed
+    self.diskCacheLogic = DiskCacheLogic() # Stage results stored on disk, keyed by the contents of their inputs
+    self.volumeContentHashes = {} # Hash of the voxels of each volume (by node ID), with the fingerprint of the volume it was computed for
+    self.doseConversionDiskCacheKey = None # Disk cache keys of the last completed dose conversion and plan dose slice extraction
+    self.planDoseSliceDiskCacheKey = None
     self.calibratedExperimentalFilmVolumeNode = None
     self.paddedCalibratedExperimentalFilmVolumeNode = None
     self.planDoseVolumeNode = None
@@ -53,9 +91,34 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     self.experimentalFilmScanSetupAligmentTransformNode = None
     self.experimentalFilmToDoseSliceInitializationTransformNode = None
     self.experimentalFilmToDoseSliceTransformNode = None
+    self.useBrainsFitRegistration = False # Register padded 3-D volumes with BRAINSFit instead of the in-plane 2-D registration
+    self.brainsFitCliNode = None # CLI node of the BRAINSFit registration running in the background
+    self.brainsFitCliNodeObserverTag = None
+    self.registrationTimeoutTimer = None
+    self.registrationCompletedCallback = None
+    self.registrationProgressCallback = None
+    self.brainsFitRegistrationFingerprint = None # Registration stage fingerprint of the BRAINSFit registration running in the background
+    self.brainsFitRegistrationDiskCacheKey = None
     self.maskSegmentationNode = None
     self.maskSegmentID = None
+    self.segmentMaskCache = OrderedDict() # Rasterized segment masks (bit-packed), keyed by segment and target geometry
     self.gammaVolumeNode = None
+    self.useBuiltInGammaEngine = True # Compute gamma with the NumPy engine instead of the SlicerRT dose comparison module
+    self.gammaLogic = GammaLogic()
+    self.gammaDtaDistanceToleranceMm = 3.0
+    self.gammaDoseDifferenceTolerancePercent = 3.0
+    self.gammaUseMaximumDose = True # Dose difference and threshold are relative to the maximum plan dose. Otherwise to gammaReferenceDoseGy
+    self.gammaReferenceDoseGy = 0.5
+    self.gammaAnalysisThresholdPercent = 0.0
+    self.gammaUseLinearInterpolation = True # Resample the film to the plan dose grid with linear (otherwise nearest neighbor) interpolation
+    self.gammaUseEarlyTermination = False # Accelerated search of the built-in engine (gamma of passing pixels is only known to be at most 1)
+    self.gammaMaximumGamma = 2.0
+    self.gammaNormalizationMode = GLOBAL_NORMALIZATION # Dose difference relative to the reference dose (global), or the local plan dose (local or hybrid)
+    self.gammaHybridMinimumDosePercent = 10.0 # Hybrid normalization uses at least this percentage of the reference dose
+    self.gammaPassFractionPercent = None
+    self.gammaReport = ''
+    self.gammaInputArrays = None # Input dose arrays of the built-in gamma engine, reused while gammaInputFingerprint is unchanged
+    self.gammaInputFingerprint = None
 
     self.measuredOpticalDensityToDoseMap = [] #TODO: Make it a real map (need to sort by key where it is created)
 
@@ -83,6 +146,53 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
         currentSegmentationNode.GetDisplayNode().SetVisibility2DOutline(True)
       currentSegmentationNode = slicer.mrmlScene.GetNextNodeByClass("vtkMRMLSegmentationNode")
 
+  #------------------------------------------------------------------------------
+  # Workflow stages
+
+  #------------------------------------------------------------------------------
+  def getVolumeNodeFingerprint(self, volumeNode):
+    # Identifies the contents and position of a volume without reading its voxels: modified times of the node
+    # and its image, and the parent transform matrix (modifying the parent transforms does not modify the node)
+    if volumeNode is None:
+      return [None]
+    imageData = volumeNode.GetImageData()
+    fingerprint = [volumeNode.GetID(), volumeNode.GetMTime(), imageData.GetMTime() if imageData is not None else None]
+    volumeToWorldMatrix = vtk.vtkMatrix4x4()
+    if volumeNode.GetParentTransformNode() is not None:
+      volumeNode.GetParentTransformNode().GetMatrixTransformToWorld(volumeToWorldMatrix)
+    return fingerprint + [volumeToWorldMatrix.GetElement(row, column) for row in xrange(3) for column in xrange(4)]
+
+  #------------------------------------------------------------------------------
+  def getWorkflowStageOutputFingerprint(self, outputNodes):
+    # Stage results are stored in nodes, which are only valid while they are in the scene
+    return tuple([(node.GetID(), slicer.mrmlScene.IsNodePresent(node) != 0) if node is not None else None for node in outputNodes])
+
+  #------------------------------------------------------------------------------
+  def setDiskCacheLogicParameters(self):
+    if self.useDiskCache:
+      self.diskCacheLogic.cacheDirectory = self.diskCacheDirectory if self.diskCacheDirectory is not None else os.path.join(slicer.app.cachePath, 'FilmDosimetryAnalysis')
+    else:
+      self.diskCacheLogic.cacheDirectory = None
+    self.diskCacheLogic.maximumSizeMb = self.diskCacheMaximumSizeMb
+
+  #------------------------------------------------------------------------------
+  def getDiskCacheKey(self, keyItems):
+    # Key of a stage result in the disk cache, None if the disk cache is disabled
+    self.setDiskCacheLogicParameters()
+    if self.diskCacheLogic.cacheDirectory is None:
+      return None
+    return self.diskCacheLogic.getKey(keyItems)
+
+  #------------------------------------------------------------------------------
+  def getVolumeContentHash(self, volumeNode):
+    # Hash of the voxels of a volume. Reading all voxels takes time, so the hash is only computed again if the volume changed
+    fingerprint = self.getVolumeNodeFingerprint(volumeNode)
+    if volumeNode.GetID() in self.volumeContentHashes and self.volumeContentHashes[volumeNode.GetID()][0] == fingerprint:
+      return self.volumeContentHashes[volumeNode.GetID()][1]
+    contentHash = self.diskCacheLogic.getArrayHash(self.volumeToNumpyArray3D(volumeNode))
+    self.volumeContentHashes[volumeNode.GetID()] = (fingerprint, contentHash)
+    return contentHash
+
   #------------------------------------------------------------------------------
   # Step 1
 
@@ -231,57 +341,21 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
   #------------------------------------------------------------------------------
   def findBestFittingCalibrationFunctionCoefficients(self):
-    bestN = [] # Entries are [MSE, n, coefficients]
-
-    for n in xrange(1000,4001):
-      n/=1000.0
-      coeffs = self.findCoefficientsForExponent(n)
-      MSE = self.meanSquaredError(coeffs[0],coeffs[1],coeffs[2],n)
-      bestN.append([MSE, n, coeffs])
-
-    bestN.sort(key=lambda bestNEntry: bestNEntry[0])
-    self.calibrationCoefficients = [ bestN[0][2][0], bestN[0][2][1], bestN[0][2][2], bestN[0][1] ]
-    logging.info("Optimized calibration function coefficients: A=" + str(round(self.calibrationCoefficients[0],4)) + ", B=" + str(round(self.calibrationCoefficients[1],4)) + ", C=" + str(round(self.calibrationCoefficients[2],4)) + ", N=" + str(round(self.calibrationCoefficients[3],4)) + " (mean square error: "  + str(round(bestN[0][0],4)) + ")")
+    opticalDensities, doses = self.getMeasuredOpticalDensityAndDoseArrays()
+    self.setCoreLogicParameters()
+    self.calibrationCoefficients = list(self.coreLogic.findBestFittingCalibrationFunctionCoefficients(opticalDensities, doses))
 
   #------------------------------------------------------------------------------
-  def findCoefficientsForExponent(self,n):
-    # Calculate matrix A
-    functionTermsMatrix = []
-
-    # Optical density
-    for row in xrange(len(self.measuredOpticalDensityToDoseMap)):
-      opticalDensity = self.measuredOpticalDensityToDoseMap[row][0]
-      functionTermsMatrix.append([1,opticalDensity,opticalDensity**n])
-    functionTermsMatrix = numpy.asmatrix(functionTermsMatrix)
-
-    # Calculate constant term coefficient vector
-    functionDoseTerms = []
-    for row in xrange(len(self.measuredOpticalDensityToDoseMap)):
-      functionDoseTerms += [self.measuredOpticalDensityToDoseMap[row][1]]
-    functionConstantTerms = numpy.linalg.lstsq(functionTermsMatrix,functionDoseTerms)
-    coefficients = functionConstantTerms[0].tolist()
-
-    for coefficientIndex in xrange(len(coefficients)):
-      coefficients[coefficientIndex] = coefficients[coefficientIndex]
-
-    return coefficients
-
-  #------------------------------------------------------------------------------
-  def meanSquaredError(self, a, b, c, n):
-    sumMeanSquaredError = 0.0
-    for i in xrange(len(self.measuredOpticalDensityToDoseMap)):
-      calculatedDose = self.applyCalibrationFunctionOnSingleOpticalDensityValue(self.measuredOpticalDensityToDoseMap[i][0], a, b, c, n)
-      sumMeanSquaredError += ((self.measuredOpticalDensityToDoseMap[i][1] - calculatedDose)**2)
-    return sumMeanSquaredError / float(len(self.measuredOpticalDensityToDoseMap))
+  def getMeasuredOpticalDensityAndDoseArrays(self):
+    measuredOpticalDensityToDoseArray = numpy.array(self.measuredOpticalDensityToDoseMap, dtype=numpy.float64).reshape(-1,2)
+    return measuredOpticalDensityToDoseArray[:,0], measuredOpticalDensityToDoseArray[:,1]
 
   #------------------------------------------------------------------------------
   def applyCalibrationFunctionOnSingleOpticalDensityValue(self, OD, a, b, c, n):
-    return a + b*OD + c*(OD**n)
+    return self.coreLogic.applyCalibrationFunctionOnSingleOpticalDensityValue(OD, a, b, c, n)
 
   # ---------------------------------------------------------------------------
   def performCalibration(self, floodFieldImageVolumeNode, calibrationDoseToVolumeNodeMap):
-    if not hasattr(slicer.modules, 'cropvolume'):
-      return "Crop Volume module missing!"
     if self.lastAddedRoiNode is None:
       return 'No ROI created for calibration!'
     if floodFieldImageVolumeNode is None:
@@ -289,24 +363,25 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     if len(calibrationDoseToVolumeNodeMap) < 1:
       return "Empty calibration does to film map!"
 
-    cropVolumeLogic = slicer.modules.cropvolume.logic()
+    # Fitting is skipped if the ROI, the films, their doses and the fitting parameters have not changed
+    calibrationInputs = [self.lastAddedRoiNode.GetID(), self.lastAddedRoiNode.GetMTime()] + self.getVolumeNodeFingerprint(floodFieldImageVolumeNode)
+    for calibrationDose in sorted(calibrationDoseToVolumeNodeMap):
+      calibrationInputs += [calibrationDose] + self.getVolumeNodeFingerprint(calibrationDoseToVolumeNodeMap[calibrationDose])
+    calibrationInputs += [self.calibrationFunctionExponentMinimum, self.calibrationFunctionExponentMaximum, self.calibrationFunctionExponentSearchStep, self.calibrationFunctionExponentTolerance]
+    fingerprint = self.workflowStageLogic.getStageFingerprint(CALIBRATION_STAGE, calibrationInputs)
+    if self.workflowStageLogic.isStageUpToDate(CALIBRATION_STAGE, fingerprint, tuple(self.calibrationCoefficients)):
+      return ""
+    self.workflowStageLogic.invalidateStage(CALIBRATION_STAGE)
+
+    # ROI extent in IJK is computed once for each distinct image geometry (normally all films share the same)
+    roiIjkExtentsForGeometries = {}
 
-    # Crop flood field volume by defined ROI into a cloned volume node
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    floodFieldItemID = shNode.GetItemByDataNode(floodFieldImageVolumeNode)
-    floodFieldVolumeNodeNodeCloneName = floodFieldImageVolumeNode.GetName() + '_Cropped'
-    croppedFloodFieldItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, floodFieldItemID, floodFieldVolumeNodeNodeCloneName)
-    croppedFloodFieldVolumeNode = shNode.GetItemDataNode(croppedFloodFieldItemID)
-    cropVolumeLogic.CropVoxelBased(self.lastAddedRoiNode, floodFieldImageVolumeNode, croppedFloodFieldVolumeNode)
-
-    # Measure average pixel value of the cropped flood field image
-    imageStat = vtk.vtkImageAccumulate()
-    imageStat.SetInputData(croppedFloodFieldVolumeNode.GetImageData())
-    imageStat.Update()
-    meanValueFloodField = imageStat.GetMean()[0]
-    logging.info("Calibration: Mean value for flood field image in ROI = " + str(round(meanValueFloodField,4)))
-    # Remove cropped volume
-    slicer.mrmlScene.RemoveNode(croppedFloodFieldVolumeNode)
+    # Measure average pixel value of the flood field image in the ROI
+    floodFieldRoiStatistics = self.calculateRoiStatisticsForVolume(self.lastAddedRoiNode, floodFieldImageVolumeNode, roiIjkExtentsForGeometries)
+    if floodFieldRoiStatistics is None:
+      return "Calibration ROI does not overlap the flood field image!"
+    meanValueFloodField = floodFieldRoiStatistics['mean']
+    logging.info("Calibration: Mean value for flood field image in ROI = " + str(round(meanValueFloodField,4)) + " (median = " + str(round(floodFieldRoiStatistics['median'],4)) + ", standard deviation = " + str(round(floodFieldRoiStatistics['standardDeviation'],4)) + ", number of pixels = " + str(floodFieldRoiStatistics['numberOfPixels']) + ")")
 
     calibrationValues = [] # [entered dose, measured pixel value]   #TODO: Order is just reversed compared to measuredOpticalDensityToDoseMap
     calibrationValues.append([self.floodFieldAttributeValue, meanValueFloodField])
@@ -319,38 +394,96 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       # Get current calibration image node
       currentCalibrationVolumeNode = calibrationDoseToVolumeNodeMap[currentCalibrationDose]
 
-      # Crop calibration images by last defined ROI into a cloned volume node
-      calibrationFilmItemID = shNode.GetItemByDataNode(currentCalibrationVolumeNode)
-      calibrationVolumeNodeNodeCloneName = currentCalibrationVolumeNode.GetName() + '_Cropped'
-      croppedCalibrationFilmItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, calibrationFilmItemID, calibrationVolumeNodeNodeCloneName)
-      croppedCalibrationFilmVolumeNode = shNode.GetItemDataNode(croppedCalibrationFilmItemID)
-      cropVolumeLogic.CropVoxelBased(self.lastAddedRoiNode, currentCalibrationVolumeNode, croppedCalibrationFilmVolumeNode)
-
-      # Measure average pixel value of the cropped calibration image
-      imageStat = vtk.vtkImageAccumulate()
-      imageStat.SetInputData(croppedCalibrationFilmVolumeNode.GetImageData())
-      imageStat.Update()
-      meanValue = imageStat.GetMean()[0]
+      # Measure average pixel value of the calibration image in the ROI
+      calibrationRoiStatistics = self.calculateRoiStatisticsForVolume(self.lastAddedRoiNode, currentCalibrationVolumeNode, roiIjkExtentsForGeometries)
+      if calibrationRoiStatistics is None:
+        return "Calibration ROI does not overlap the calibration image for " + str(currentCalibrationDose) + " cGy!"
+      meanValue = calibrationRoiStatistics['mean']
       calibrationValues.append([meanValue, currentCalibrationDose])
-      # Remove cropped volume
-      slicer.mrmlScene.RemoveNode(croppedCalibrationFilmVolumeNode)
 
       # Optical density calculation
-      opticalDensity = math.log10(float(meanValueFloodField)/meanValue)
-      if opticalDensity < 0.0:
-        opticalDensity = 0.0
+      opticalDensity = self.coreLogic.calculateOpticalDensity(meanValueFloodField, meanValue)
 
       # x = optical density, y = dose
       self.measuredOpticalDensityToDoseMap.append([opticalDensity, currentCalibrationDose])
-      logging.info("Calibration: Mean value for calibration image for " + str(round(currentCalibrationDose,4)) + " cGy in ROI = " + str(round(meanValue,4)) + ", OD = " + str(round(opticalDensity,4)))
+      logging.info("Calibration: Mean value for calibration image for " + str(round(currentCalibrationDose,4)) + " cGy in ROI = " + str(round(meanValue,4)) + ", OD = " + str(round(opticalDensity,4)) + " (median = " + str(round(calibrationRoiStatistics['median'],4)) + ", standard deviation = " + str(round(calibrationRoiStatistics['standardDeviation'],4)) + ", number of pixels = " + str(calibrationRoiStatistics['numberOfPixels']) + ")")
 
     self.measuredOpticalDensityToDoseMap.sort(key=lambda doseODPair: doseODPair[1])
 
     # Perform calibration of OD to dose
     self.findBestFittingCalibrationFunctionCoefficients()
 
+    self.workflowStageLogic.setStageCompleted(CALIBRATION_STAGE, fingerprint, tuple(self.calibrationCoefficients))
     return ""
 
+  #------------------------------------------------------------------------------
+  def calculateRoiStatisticsForVolume(self, roiNode, volumeNode, roiIjkExtentsForGeometries):
+    # Reuse ROI extent if it has already been computed for a volume with the same geometry
+    volumeGeometryKey = self.getVolumeGeometryKey(volumeNode)
+    if volumeGeometryKey not in roiIjkExtentsForGeometries:
+      roiIjkExtentsForGeometries[volumeGeometryKey] = self.getRoiIjkExtentInVolume(roiNode, volumeNode)
+    roiIjkExtent = roiIjkExtentsForGeometries[volumeGeometryKey]
+    if roiIjkExtent is None:
+      return None
+
+    # Access the voxels in the ROI through a view of the image data (no copy is made)
+    volumeArray = self.volumeToNumpyArray3D(volumeNode)
+    roiArray = volumeArray[roiIjkExtent[4]:roiIjkExtent[5]+1, roiIjkExtent[2]:roiIjkExtent[3]+1, roiIjkExtent[0]:roiIjkExtent[1]+1]
+
+    roiStatistics = {}
+    roiStatistics['mean'] = float(roiArray.mean(dtype=numpy.float64))
+    roiStatistics['median'] = float(numpy.median(roiArray))
+    roiStatistics['standardDeviation'] = float(roiArray.std(dtype=numpy.float64))
+    roiStatistics['numberOfPixels'] = roiArray.size
+    return roiStatistics
+
+  #------------------------------------------------------------------------------
+  def getRoiIjkExtentInVolume(self, roiNode, volumeNode):
+    # Get ROI corner points in world coordinate system
+    roiCenter = [0,0,0]
+    roiRadius = [0,0,0]
+    roiNode.GetXYZ(roiCenter)
+    roiNode.GetRadiusXYZ(roiRadius)
+    roiCorners_Roi = numpy.array([ [roiCenter[0]+xSign*roiRadius[0], roiCenter[1]+ySign*roiRadius[1], roiCenter[2]+zSign*roiRadius[2], 1.0] for xSign in [-1,1] for ySign in [-1,1] for zSign in [-1,1] ])
+    roiToWorldMatrix = vtk.vtkMatrix4x4()
+    if roiNode.GetParentTransformNode():
+      roiNode.GetParentTransformNode().GetMatrixTransformToWorld(roiToWorldMatrix)
+
+    # Get world to IJK transform of the volume
+    worldToIjkMatrix = vtk.vtkMatrix4x4()
+    rasToIjkMatrix = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIjkMatrix)
+    worldToRasMatrix = vtk.vtkMatrix4x4()
+    if volumeNode.GetParentTransformNode():
+      volumeNode.GetParentTransformNode().GetMatrixTransformToWorld(worldToRasMatrix)
+      worldToRasMatrix.Invert()
+    vtk.vtkMatrix4x4.Multiply4x4(rasToIjkMatrix, worldToRasMatrix, worldToIjkMatrix)
+
+    roiToIjkMatrix = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(worldToIjkMatrix, roiToWorldMatrix, roiToIjkMatrix)
+    roiToIjkArray = numpy.array([[roiToIjkMatrix.GetElement(row,column) for column in xrange(4)] for row in xrange(4)])
+    roiCorners_Ijk = roiCorners_Roi.dot(roiToIjkArray.T)[:,0:3]
+
+    # Voxels are included if their centers are inside the ROI
+    imageExtent = volumeNode.GetImageData().GetExtent()
+    roiIjkExtent = [0]*6
+    for axis in xrange(3):
+      roiIjkExtent[axis*2] = max(int(math.ceil(roiCorners_Ijk[:,axis].min())), imageExtent[axis*2]) - imageExtent[axis*2]
+      roiIjkExtent[axis*2+1] = min(int(math.floor(roiCorners_Ijk[:,axis].max())), imageExtent[axis*2+1]) - imageExtent[axis*2]
+      if roiIjkExtent[axis*2] > roiIjkExtent[axis*2+1]:
+        logging.error('ROI ' + roiNode.GetName() + ' does not overlap volume ' + volumeNode.GetName())
+        return None
+
+    return roiIjkExtent
+
+  #------------------------------------------------------------------------------
+  def getVolumeGeometryKey(self, volumeNode):
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    ijkToRasElements = tuple([ijkToRasMatrix.GetElement(row,column) for row in xrange(4) for column in xrange(4)])
+    parentTransformNodeID = volumeNode.GetTransformNodeID()
+    return (ijkToRasElements, tuple(volumeNode.GetImageData().GetExtent()), parentTransformNodeID)
+
   #------------------------------------------------------------------------------
   # Step 3
 
@@ -373,21 +506,21 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
   #------------------------------------------------------------------------------
   def loadCalibrationFunctionFromFile(self, filePath):
-    file = open(filePath, 'r+')
+    # Returns error message, empty string on success
+    file = open(filePath, 'r')
     lines = file.readlines()
+    file.close()
     if len(lines) != 6:
       message = "Invalid calibration coefficients file!"
       logging.error(message)
-      qt.QMessageBox.critical(None, 'Error', message)
-      return
+      return message
 
     # Store coefficients
     self.calibrationCoefficients[0] = float(lines[2].rstrip())
     self.calibrationCoefficients[1] = float(lines[3].rstrip())
     self.calibrationCoefficients[2] = float(lines[4].rstrip())
     self.calibrationCoefficients[3] = float(lines[5].rstrip())
-
-    file.close()
+    return ""
 
   #------------------------------------------------------------------------------
   def applyCalibrationOnExperimentalFilm(self):
@@ -395,7 +528,7 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       message = "Invalid experimental film selection!"
       logging.error(message)
       return message
-    if self.experimentalFloodFieldVolumeNode is None:
+    if self.experimentalFloodFieldVolumeNode is None and self.experimentalFloodFieldValue is None:
       message = "Invalid experimental flood field image selection!"
       logging.error(message)
       return message
@@ -403,59 +536,150 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       message = "Invalid calibration function"
       logging.error(message)
       return message
+    if self.experimentalFilmVolumeNode.IsA('vtkMRMLVectorVolumeNode') or (self.experimentalFloodFieldValue is None and self.experimentalFloodFieldVolumeNode.IsA('vtkMRMLVectorVolumeNode')):
+      message = "Red channel needs to be extracted from RGB images before calibration"
+      logging.error(message)
+      return message
+    if self.experimentalFloodFieldValue is None:
+      experimentalFilmDimensions = self.experimentalFilmVolumeNode.GetImageData().GetDimensions()
+      floodFieldDimensions = self.experimentalFloodFieldVolumeNode.GetImageData().GetDimensions()
+      if experimentalFilmDimensions != floodFieldDimensions:
+        message = "Experimental and flood field images must be the same size! (Experimental: " + str(experimentalFilmDimensions) + ", FloodField: " + str(floodFieldDimensions) + ")"
+        logging.error(message)
+        return message
+
+    # Dose conversion is skipped if the film, the flood field and the calibration function have not changed
+    doseConversionInputs = self.getVolumeNodeFingerprint(self.experimentalFilmVolumeNode) + list(self.calibrationCoefficients)
+    if self.experimentalFloodFieldValue is not None:
+      doseConversionInputs.append(self.experimentalFloodFieldValue)
+    else:
+      doseConversionInputs += self.getVolumeNodeFingerprint(self.experimentalFloodFieldVolumeNode)
+    fingerprint = self.workflowStageLogic.getStageFingerprint(DOSE_CONVERSION_STAGE, doseConversionInputs)
+    if self.workflowStageLogic.isStageUpToDate(DOSE_CONVERSION_STAGE, fingerprint, self.getWorkflowStageOutputFingerprint([self.calibratedExperimentalFilmVolumeNode])):
+      return ""
+    self.workflowStageLogic.invalidateStage(DOSE_CONVERSION_STAGE)
 
     experimentalFilmExtent = self.experimentalFilmVolumeNode.GetImageData().GetExtent()
 
-    # Perform calibration
-    self.calculatedDoseDoubleArrayGy = self.calculateDoseFromExperimentalFilmImage(self.experimentalFilmVolumeNode, self.experimentalFloodFieldVolumeNode)
-
-    # Convert numpy array to VTK image data
-    calculatedDoseVolumeScalarsGy = numpy_support.numpy_to_vtk(self.calculatedDoseDoubleArrayGy,1)
+    # Dose of the same film scan converted with the same calibration is loaded from the disk cache (memory-mapped)
+    self.doseConversionDiskCacheKey = self.getDoseConversionDiskCacheKey()
+    cachedArrays = self.diskCacheLogic.getArrays(self.doseConversionDiskCacheKey)
+    if cachedArrays is not None:
+      self.calculatedDoseDoubleArrayGy = cachedArrays[0]
+    else:
+      # Perform calibration
+      if self.useStreamingCalibration:
+        self.calculatedDoseDoubleArrayGy = self.calculateDoseFromExperimentalFilmImageStreaming(self.experimentalFilmVolumeNode, self.experimentalFloodFieldVolumeNode)
+      else:
+        self.calculatedDoseDoubleArrayGy = self.calculateDoseFromExperimentalFilmImage(self.experimentalFilmVolumeNode, self.experimentalFloodFieldVolumeNode)
+      if self.calculatedDoseDoubleArrayGy is None:
+        self.doseConversionDiskCacheKey = None
+        message = "Failed to calculate dose from experimental film"
+        logging.error(message)
+        return message
+      self.diskCacheLogic.setArrays(self.doseConversionDiskCacheKey, [self.calculatedDoseDoubleArrayGy])
+
+    # Convert numpy array to VTK image data. The dose array is wrapped without copy (the VTK array keeps
+    # a reference to it), so in streaming mode the calibrated volume uses the memory-mapped dose file
+    calculatedDoseVolumeScalarsGy = numpy_support.numpy_to_vtk(self.calculatedDoseDoubleArrayGy, 0)
     calculatedDoseImageData = vtk.vtkImageData()
     calculatedDoseImageData.GetPointData().SetScalars(calculatedDoseVolumeScalarsGy)
     calculatedDoseImageData.SetExtent(experimentalFilmExtent[0],experimentalFilmExtent[1], experimentalFilmExtent[2],experimentalFilmExtent[3], 0,0)
-    # Create scalar volume node for calibrated film
-    self.calibratedExperimentalFilmVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+    # Create scalar volume node for calibrated film (the node of the previous calibration is reused)
+    if self.calibratedExperimentalFilmVolumeNode is None or not slicer.mrmlScene.IsNodePresent(self.calibratedExperimentalFilmVolumeNode):
+      self.calibratedExperimentalFilmVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+      slicer.mrmlScene.AddNode(self.calibratedExperimentalFilmVolumeNode)
+      self.calibratedExperimentalFilmVolumeNode.CreateDefaultDisplayNodes()
     self.calibratedExperimentalFilmVolumeNode.SetName(self.experimentalFilmVolumeNode.GetName() + self.calibratedExperimentalFilmVolumeNamePostfix)
-    slicer.mrmlScene.AddNode(self.calibratedExperimentalFilmVolumeNode)
-    self.calibratedExperimentalFilmVolumeNode.CreateDefaultDisplayNodes()
     self.calibratedExperimentalFilmVolumeNode.SetAndObserveImageData(calculatedDoseImageData)
     # Set same geometry as experimental film
+    self.calibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(None)
     self.calibratedExperimentalFilmVolumeNode.SetOrigin(self.experimentalFilmVolumeNode.GetOrigin())
     self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.experimentalFilmVolumeNode.GetSpacing())
     self.calibratedExperimentalFilmVolumeNode.CopyOrientation(self.experimentalFilmVolumeNode)
 
+    self.workflowStageLogic.setStageCompleted(DOSE_CONVERSION_STAGE, fingerprint, self.getWorkflowStageOutputFingerprint([self.calibratedExperimentalFilmVolumeNode]))
     return ""
 
+  #------------------------------------------------------------------------------
+  def getDoseConversionDiskCacheKey(self):
+    # Dose depends on the pixel values of the film and the flood field, and on the calibration function
+    if not self.useDiskCache:
+      return None
+    keyItems = [DOSE_CONVERSION_STAGE, self.getVolumeContentHash(self.experimentalFilmVolumeNode)] + list(self.calibrationCoefficients)
+    if self.experimentalFloodFieldValue is not None:
+      keyItems.append(self.experimentalFloodFieldValue)
+    else:
+      keyItems.append(self.getVolumeContentHash(self.experimentalFloodFieldVolumeNode))
+    return self.getDiskCacheKey(keyItems)
+
   #------------------------------------------------------------------------------
   def calculateDoseFromExperimentalFilmImage(self, experimentalFilmVolumeNode, experimentalFloodFieldVolumeNode):
-    #TODO: This should be done in SimpleITK
     experimentalFilmArray = self.volumeToNumpyArray(experimentalFilmVolumeNode)
-    floodFieldArray = self.volumeToNumpyArray(experimentalFloodFieldVolumeNode)
 
-    if len(experimentalFilmArray) != len(floodFieldArray):
-      message = "Experimental and flood field images must be the same size! (Experimental: " + str(len(experimentalFilmArray)) + ", FloodField: " + str(len(floodFieldArray))
-      logging.error(message)
-      qt.QMessageBox.critical(None, 'Error', message)
-      return
+    # Uniform flood field value is used if specified, otherwise the flood field image
+    if self.experimentalFloodFieldValue is not None:
+      floodField = self.experimentalFloodFieldValue
+    else:
+      floodField = self.volumeToNumpyArray(experimentalFloodFieldVolumeNode)
+      if len(experimentalFilmArray) != len(floodField):
+        message = "Experimental and flood field images must be the same size! (Experimental: " + str(len(experimentalFilmArray)) + ", FloodField: " + str(len(floodField))
+        logging.error(message)
+        return
 
-    doseArray_cGy = numpy.zeros(len(floodFieldArray))
-    for index in xrange(len(experimentalFilmArray)):
-      opticalDensity = 0.0
-      try:
-        opticalDensity = math.log10(float(floodFieldArray[index])/experimentalFilmArray[index])
-      except:
-        logging.error('Failure when calculating optical density for experimental film image. Failing values: FloodField=' + str(floodFieldArray[index]) + ', PixelValue=' + str(experimentalFilmArray[index]))
-        opticalDensity = 0.0
-      if opticalDensity <= 0.0:
-        opticalDensity = 0.0
-      doseArray_cGy[index] = self.applyCalibrationFunctionOnSingleOpticalDensityValue(opticalDensity, self.calibrationCoefficients[0], self.calibrationCoefficients[1], self.calibrationCoefficients[2], self.calibrationCoefficients[3]) / 100.0
-      if doseArray_cGy[index] < 0.0:
-        doseArray_cGy[index] = 0.0
-      # if index%1000==0: # Debugging snippet
-        # print('DEBUG: ExpFilm=' + str(experimentalFilmArray[index]) + ', Flood=' + str(floodFieldArray[index]) + ', OD=' + str(opticalDensity) + ', Dose=' + str(doseArray_cGy[index]))
-
-    return doseArray_cGy
+    self.setCoreLogicParameters()
+    return self.coreLogic.calculateDoseFromPixelValueArrays(experimentalFilmArray, floodField)
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromExperimentalFilmImageStreaming(self, experimentalFilmVolumeNode, experimentalFloodFieldVolumeNode):
+    # Same as calculateDoseFromExperimentalFilmImage, but processes the film in row tiles and writes
+    # dose into a memory-mapped array, so the working memory does not grow with the film size.
+    # Pixel values are read through views of the loaded volumes, so tiles are not copied.
+    experimentalFilmArray = self.volumeToNumpyArray(experimentalFilmVolumeNode)
+    numberOfColumns = experimentalFilmVolumeNode.GetImageData().GetDimensions()[0]
+
+    if self.experimentalFloodFieldValue is not None:
+      floodField = self.experimentalFloodFieldValue
+    else:
+      floodField = self.volumeToNumpyArray(experimentalFloodFieldVolumeNode)
+      if len(experimentalFilmArray) != len(floodField):
+        message = "Experimental and flood field images must be the same size! (Experimental: " + str(len(experimentalFilmArray)) + ", FloodField: " + str(len(floodField))
+        logging.error(message)
+        return
+
+    self.setCoreLogicParameters()
+    return self.coreLogic.calculateDoseFromPixelValueArraysInRowTiles(experimentalFilmArray, floodField, numberOfColumns, experimentalFilmVolumeNode.GetName())
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromExperimentalFilmFilesStreaming(self, experimentalFilmFilePath, floodFieldFilePath, outputFilePath=None):
+    # Calibrate a film scan directly from file without loading it into the scene.
+    # Flood field is the uniform flood field value (experimentalFloodFieldValue) if floodFieldFilePath is None.
+    # Returns the flat dose array (Gy), memory-mapped to outputFilePath if given.
+    self.setCoreLogicParameters()
+    return self.coreLogic.calculateDoseFromFilmFilesStreaming(experimentalFilmFilePath, floodFieldFilePath, self.experimentalFloodFieldValue, outputFilePath)
+
+  #------------------------------------------------------------------------------
+  def setCoreLogicParameters(self):
+    self.coreLogic.calibrationCoefficients = list(self.calibrationCoefficients)
+    self.coreLogic.calibrationFunctionExponentMinimum = self.calibrationFunctionExponentMinimum
+    self.coreLogic.calibrationFunctionExponentMaximum = self.calibrationFunctionExponentMaximum
+    self.coreLogic.calibrationFunctionExponentSearchStep = self.calibrationFunctionExponentSearchStep
+    self.coreLogic.calibrationFunctionExponentTolerance = self.calibrationFunctionExponentTolerance
+    self.coreLogic.useDoseLookupTable = self.useDoseLookupTable
+    self.coreLogic.doseLookupTableBlockSize = self.doseLookupTableBlockSize
+    self.coreLogic.streamingCalibrationMaximumMemoryMb = self.streamingCalibrationMaximumMemoryMb
+    self.coreLogic.streamingCalibrationWorkingBytesPerPixel = self.streamingCalibrationWorkingBytesPerPixel
+    self.coreLogic.streamingCalibrationOutputDirectory = self.streamingCalibrationOutputDirectory
+    self.coreLogic.streamingCalibrationStreamableFileExtensions = self.streamingCalibrationStreamableFileExtensions
+    # In-plane registration samples as many pixels as BRAINSFit does from the padded plan dose volume
+    self.coreLogic.registrationSamplingPercentage = min(1.0, self.registrationSamplingPercentage * self.numberOfSlicesToPad)
+    self.coreLogic.registrationSamplingSeed = self.registrationSamplingSeed
+    self.coreLogic.registrationMaximumStepLength = self.registrationMaximumStepLength
+    self.coreLogic.registrationMinimumStepLength = self.registrationMinimumStepLength
+    self.coreLogic.registrationMaximumNumberOfIterations = self.registrationMaximumNumberOfIterations
+    self.coreLogic.registrationRelaxationFactor = self.registrationRelaxationFactor
+    self.coreLogic.registrationGradientMagnitudeTolerance = self.registrationGradientMagnitudeTolerance
+    self.coreLogic.registrationRotationScale = self.registrationRotationScale
 
   #------------------------------------------------------------------------------
   def volumeToNumpyArray(self, currentVolume):
@@ -464,23 +688,56 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     numpyArrayVolume = numpy_support.vtk_to_numpy(volumeDataScalars)
     return numpyArrayVolume
 
+  #------------------------------------------------------------------------------
+  def volumeToNumpyArray3D(self, currentVolume):
+    # Array view indexed as [k,j,i] (no copy is made)
+    volumeDimensions = currentVolume.GetImageData().GetDimensions()
+    return self.volumeToNumpyArray(currentVolume).reshape(volumeDimensions[2], volumeDimensions[1], volumeDimensions[0])
+
+  #------------------------------------------------------------------------------
+  def getVolumeIjkToWorldMatrixArray(self, volumeNode):
+    # 4x4 matrix mapping the indices of the volume array (starting at the first voxel of the extent) to world
+    # coordinates, including the parent transforms of the volume
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    if volumeNode.GetParentTransformNode() is not None:
+      volumeToWorldMatrix = vtk.vtkMatrix4x4()
+      volumeNode.GetParentTransformNode().GetMatrixTransformToWorld(volumeToWorldMatrix)
+      vtk.vtkMatrix4x4.Multiply4x4(volumeToWorldMatrix, ijkToRasMatrix, ijkToRasMatrix)
+    ijkToWorldMatrixArray = self.vtkMatrixToNumpyArray(ijkToRasMatrix)
+    extent = volumeNode.GetImageData().GetExtent()
+    ijkToWorldMatrixArray[:,3] = ijkToWorldMatrixArray.dot([extent[0], extent[2], extent[4], 1])
+    return ijkToWorldMatrixArray
+
+  #------------------------------------------------------------------------------
+  def vtkMatrixToNumpyArray(self, matrix):
+    return numpy.array([[matrix.GetElement(row,column) for column in xrange(4)] for row in xrange(4)])
+
+  #------------------------------------------------------------------------------
+  def numpyArrayToVtkMatrix(self, matrixArray):
+    matrix = vtk.vtkMatrix4x4()
+    for row in xrange(4):
+      for column in xrange(4):
+        matrix.SetElement(row, column, matrixArray[row][column])
+    return matrix
+
   #------------------------------------------------------------------------------
   # Step 4
 
   #------------------------------------------------------------------------------
   def initializeFilmToPlanDoseRegistration(self):
+    # Prepare the calibrated film and the plan dose slice for registration. Upstream stages are brought up to date
+    # first, and the preparation is only done again if they or the film geometry changed since it was last done
     if self.experimentalFilmPixelSpacing is None:
       return "Invalid mm/pixel resolution for the experimental film must be entered"
-
-    # Set spacing of the experimental film volume
     if self.calibratedExperimentalFilmVolumeNode is None:
       return "Unable to access calibrated experimental film"
-    if self.experimentalFilmSliceOrientation == AXIAL:
-      self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.experimentalFilmPixelSpacing, self.experimentalFilmPixelSpacing, self.planDoseVolumeNode.GetSpacing()[0])
-    elif self.experimentalFilmSliceOrientation == CORONAL:
-      self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.experimentalFilmPixelSpacing, self.planDoseVolumeNode.GetSpacing()[1], self.experimentalFilmPixelSpacing)
-    elif self.experimentalFilmSliceOrientation == SAGITTAL:
-      self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.planDoseVolumeNode.GetSpacing()[2], self.experimentalFilmPixelSpacing, self.experimentalFilmPixelSpacing)
+
+    # Calibrate the film again if the calibration function or the film changed since it was calibrated
+    message = self.applyCalibrationOnExperimentalFilm()
+    if message != '':
+      logging.error("Failed to calibrate experimental film")
+      return message
 
     # Crop the dose volume to the specified slice in the specified orientation
     message = self.cropPlanDoseVolumeToSlice()
@@ -488,12 +745,28 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       logging.error("Failed to crop plan dose volume")
       return message
 
-    # Prepare plan dose slice for registration by padding into 5 slices
-    message = self.padPlanDoseSliceForRegistration()
-    if message != '' or self.paddedPlanDoseSliceVolumeNode is None:
-      logging.error("Failed to prepare plan dose volume for registration")
+    fingerprint = self.workflowStageLogic.getStageFingerprint(REGISTRATION_PREPARATION_STAGE,
+      [self.experimentalFilmPixelSpacing, self.experimentalFilmSliceOrientation, self.useBrainsFitRegistration, self.numberOfSlicesToPad])
+    if self.workflowStageLogic.isStageUpToDate(REGISTRATION_PREPARATION_STAGE, fingerprint, self.getRegistrationPreparationOutputFingerprint()):
+      return ''
+    self.workflowStageLogic.invalidateStage(REGISTRATION_PREPARATION_STAGE)
+
+    # Set spacing of the experimental film volume, and discard transforms hardened by a previous registration
+    self.resetCalibratedFilmGeometry()
+
+    # Make calibrated film have the orientation of the plan dose slice
+    message = self.orientCalibratedFilmToPlanDoseSlice()
+    if message != '':
+      logging.error("Failed to prepare calibrated film for registration")
       return message
 
+    # Prepare plan dose slice for BRAINSFit registration by padding into 5 slices
+    if self.useBrainsFitRegistration:
+      message = self.padPlanDoseSliceForRegistration()
+      if message != '' or self.paddedPlanDoseSliceVolumeNode is None:
+        logging.error("Failed to prepare plan dose volume for registration")
+        return message
+
     # Pre-align calibrated film to plan dose slice
     message = self.preAlignCalibratedFilmWithPlanDoseSlice()
     if message != '':
@@ -506,192 +779,198 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       logging.error("Failed to initialize scan setup alignment transform for calibrated film")
       return message
 
+    self.workflowStageLogic.setStageCompleted(REGISTRATION_PREPARATION_STAGE, fingerprint, self.getRegistrationPreparationOutputFingerprint())
     return ''
 
   #------------------------------------------------------------------------------
-  def cropPlanDoseVolumeToSlice(self):
-    if self.croppedPlanDoseSliceVolumeNode is not None:
-      # Cropping already took place
-      return ""
+  def getRegistrationPreparationOutputFingerprint(self):
+    outputNodes = [self.experimentalFilmPreAlignmentTransformNode, self.experimentalFilmScanSetupAligmentTransformNode]
+    if self.useBrainsFitRegistration:
+      outputNodes += [self.paddedCalibratedExperimentalFilmVolumeNode, self.paddedPlanDoseSliceVolumeNode]
+    return self.getWorkflowStageOutputFingerprint(outputNodes)
 
+  #------------------------------------------------------------------------------
+  def resetCalibratedFilmGeometry(self):
+    # Geometry of the calibrated film as scanned: film pixel spacing in plane, plan dose spacing along the normal,
+    # no parent transform. Transforms hardened on the (padded) calibrated film by a registration are discarded
+    self.calibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(None)
+    self.calibratedExperimentalFilmVolumeNode.SetOrigin(self.experimentalFilmVolumeNode.GetOrigin())
+    self.calibratedExperimentalFilmVolumeNode.CopyOrientation(self.experimentalFilmVolumeNode)
+    if self.experimentalFilmSliceOrientation == AXIAL:
+      self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.experimentalFilmPixelSpacing, self.experimentalFilmPixelSpacing, self.planDoseVolumeNode.GetSpacing()[0])
+    elif self.experimentalFilmSliceOrientation == CORONAL:
+      self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.experimentalFilmPixelSpacing, self.planDoseVolumeNode.GetSpacing()[1], self.experimentalFilmPixelSpacing)
+    elif self.experimentalFilmSliceOrientation == SAGITTAL:
+      self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.planDoseVolumeNode.GetSpacing()[2], self.experimentalFilmPixelSpacing, self.experimentalFilmPixelSpacing)
+
+    if self.paddedCalibratedExperimentalFilmVolumeNode is not None:
+      self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(None)
+      self.paddedCalibratedExperimentalFilmVolumeNode.SetOrigin(self.calibratedExperimentalFilmVolumeNode.GetOrigin())
+      self.paddedCalibratedExperimentalFilmVolumeNode.SetSpacing(self.calibratedExperimentalFilmVolumeNode.GetSpacing())
+      self.paddedCalibratedExperimentalFilmVolumeNode.CopyOrientation(self.calibratedExperimentalFilmVolumeNode)
+
+  #------------------------------------------------------------------------------
+  def cropPlanDoseVolumeToSlice(self):
     if self.planDoseVolumeNode is None:
       message = "No plan dose volume is selected!"
       logging.error(message)
       return message
 
-    # Create ROI for cropping dose volume to selected slice
-    roiNode = slicer.vtkMRMLAnnotationROINode()
-    roiNode.SetName("CropPlanDoseVolumeROI")
-    slicer.mrmlScene.AddNode(roiNode)
-
-    #TODO: Support non-axis-aligned volumes too
-    bounds = [0]*6
-    self.planDoseVolumeNode.GetRASBounds(bounds)
-    cropCenter = [(bounds[0]+bounds[1])/2, (bounds[2]+bounds[3])/2, (bounds[4]+bounds[5])/2]
-    cropRadius = [abs(bounds[1]-bounds[0])/2, abs(bounds[3]-bounds[2])/2, abs(bounds[5]-bounds[4])/2]
-    if self.experimentalFilmSliceOrientation == AXIAL:
-      cropCenter[2] = self.experimentalFilmSlicePosition
-      cropRadius[2] = 0.5*self.planDoseVolumeNode.GetSpacing()[2]
-    elif self.experimentalFilmSliceOrientation == CORONAL:
-      cropCenter[1] = self.experimentalFilmSlicePosition
-      cropRadius[1] = 0.5*self.planDoseVolumeNode.GetSpacing()[1]
-    elif self.experimentalFilmSliceOrientation == SAGITTAL:
-      cropCenter[0] = self.experimentalFilmSlicePosition
-      cropRadius[0] = 0.5*self.planDoseVolumeNode.GetSpacing()[0]
-    roiNode.SetXYZ(cropCenter)
-    roiNode.SetRadiusXYZ(cropRadius)
-
-    # Perform cropping
-    cropVolumeParameterNode = slicer.vtkMRMLCropVolumeParametersNode()
-    slicer.mrmlScene.AddNode(cropVolumeParameterNode)
-    cropVolumeParameterNode.SetInputVolumeNodeID(self.planDoseVolumeNode.GetID())
-    cropVolumeParameterNode.SetROINodeID(roiNode.GetID())
-    cropVolumeParameterNode.SetVoxelBased(False)
-    cropLogic = slicer.modules.cropvolume.logic()
-
-    cropLogic.Apply(cropVolumeParameterNode)
-    self.croppedPlanDoseSliceVolumeNode = slicer.mrmlScene.GetNodeByID(cropVolumeParameterNode.GetOutputVolumeNodeID())
-    croppedPlanDoseVolumeName = slicer.mrmlScene.GenerateUniqueName(self.planDoseVolumeNode.GetName() + self.croppedPlanDoseVolumeNamePostfix)
-    self.croppedPlanDoseSliceVolumeNode.SetName(croppedPlanDoseVolumeName)
-
-    # Delete ROI and parameter nodes (comment out only for debugging)
-    slicer.mrmlScene.RemoveNode(roiNode)
-    slicer.mrmlScene.RemoveNode(cropVolumeParameterNode)
+    # Cropping is skipped if the plan dose volume and the film orientation and position have not changed
+    fingerprint = self.workflowStageLogic.getStageFingerprint(PLAN_DOSE_SLICE_STAGE,
+      self.getVolumeNodeFingerprint(self.planDoseVolumeNode) + [self.experimentalFilmSliceOrientation, self.experimentalFilmSlicePosition])
+    if self.workflowStageLogic.isStageUpToDate(PLAN_DOSE_SLICE_STAGE, fingerprint, self.getWorkflowStageOutputFingerprint([self.croppedPlanDoseSliceVolumeNode])):
+      return ""
+    self.workflowStageLogic.invalidateStage(PLAN_DOSE_SLICE_STAGE)
 
+    # Slice of the same plan dose at the same position is loaded from the disk cache
+    self.planDoseSliceDiskCacheKey = self.getPlanDoseSliceDiskCacheKey()
+    cachedArrays = self.diskCacheLogic.getArrays(self.planDoseSliceDiskCacheKey)
+    if cachedArrays is not None:
+      [planDoseSliceArray3D, [planDoseSliceOrigin, planDoseSliceSpacing]] = [cachedArrays[0], cachedArrays[1].tolist()]
+    else:
+      # Extract the plan dose at the film position as a single slice volume aligned with the RAS axes
+      # (plan doses not aligned with the RAS axes are resampled)
+      planDoseSlice = self.coreLogic.extractPlanDoseSlice(self.volumeToNumpyArray3D(self.planDoseVolumeNode),
+        self.getVolumeIjkToWorldMatrixArray(self.planDoseVolumeNode), self.experimentalFilmSliceOrientation, self.experimentalFilmSlicePosition)
+      if planDoseSlice is None:
+        self.planDoseSliceDiskCacheKey = None
+        return "Failed to extract " + self.experimentalFilmSliceOrientation.lower() + " plan dose slice at position " + str(self.experimentalFilmSlicePosition)
+      [planDoseSliceArray3D, planDoseSliceOrigin, planDoseSliceSpacing] = planDoseSlice
+      self.diskCacheLogic.setArrays(self.planDoseSliceDiskCacheKey, [planDoseSliceArray3D, numpy.array([planDoseSliceOrigin, planDoseSliceSpacing], dtype=numpy.float64)])
+
+    planDoseSliceImageData = vtk.vtkImageData()
+    planDoseSliceImageData.SetDimensions(planDoseSliceArray3D.shape[2], planDoseSliceArray3D.shape[1], planDoseSliceArray3D.shape[0])
+    # Scalars reference the numpy array (no copy), which is kept alive by the VTK array
+    planDoseSliceImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(planDoseSliceArray3D.ravel(), 0))
+
+    # The slice node of the previous cropping is reused
+    if self.croppedPlanDoseSliceVolumeNode is None or not slicer.mrmlScene.IsNodePresent(self.croppedPlanDoseSliceVolumeNode):
+      self.croppedPlanDoseSliceVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+      croppedPlanDoseVolumeName = slicer.mrmlScene.GenerateUniqueName(self.planDoseVolumeNode.GetName() + self.croppedPlanDoseVolumeNamePostfix)
+      self.croppedPlanDoseSliceVolumeNode.SetName(croppedPlanDoseVolumeName)
+      slicer.mrmlScene.AddNode(self.croppedPlanDoseSliceVolumeNode)
+      self.croppedPlanDoseSliceVolumeNode.CreateDefaultDisplayNodes()
+    self.croppedPlanDoseSliceVolumeNode.SetAndObserveImageData(planDoseSliceImageData)
+    self.croppedPlanDoseSliceVolumeNode.SetOrigin(planDoseSliceOrigin)
+    self.croppedPlanDoseSliceVolumeNode.SetSpacing(planDoseSliceSpacing)
+    # Keep dose volume attributes (e.g. dose unit) and display settings of the plan dose
+    for attributeName in self.planDoseVolumeNode.GetAttributeNames():
+      self.croppedPlanDoseSliceVolumeNode.SetAttribute(attributeName, self.planDoseVolumeNode.GetAttribute(attributeName))
+    if self.planDoseVolumeNode.GetDisplayNode() is not None:
+      self.croppedPlanDoseSliceVolumeNode.GetDisplayNode().SetAndObserveColorNodeID(self.planDoseVolumeNode.GetDisplayNode().GetColorNodeID())
+
+    self.workflowStageLogic.setStageCompleted(PLAN_DOSE_SLICE_STAGE, fingerprint, self.getWorkflowStageOutputFingerprint([self.croppedPlanDoseSliceVolumeNode]))
     return ""
 
   #------------------------------------------------------------------------------
-  def padPlanDoseSliceForRegistration(self):
-    if self.paddedPlanDoseSliceVolumeNode is not None and self.paddedCalibratedExperimentalFilmVolumeNode is not None:
-      # Padding already took place
-      return ""
+  def getPlanDoseSliceDiskCacheKey(self):
+    # Slice depends on the plan dose voxels and geometry, and on the film orientation and position
+    if not self.useDiskCache:
+      return None
+    return self.getDiskCacheKey([PLAN_DOSE_SLICE_STAGE, self.getVolumeContentHash(self.planDoseVolumeNode),
+      self.getVolumeIjkToWorldMatrixArray(self.planDoseVolumeNode), self.experimentalFilmSliceOrientation, self.experimentalFilmSlicePosition])
+
+  #------------------------------------------------------------------------------
+  def getCroppedPlanDoseSliceArray2D(self):
+    # In-plane [row, column] view of the cropped plan dose slice, None if it is not a slice in the film orientation
+    return self.coreLogic.getInPlaneSliceArray2D(self.volumeToNumpyArray3D(self.croppedPlanDoseSliceVolumeNode), self.experimentalFilmSliceOrientation)
+
+  #------------------------------------------------------------------------------
+  def getCalibratedExperimentalFilmArray2D(self):
+    experimentalFilmExtent = self.experimentalFilmVolumeNode.GetImageData().GetExtent() # Axial volume, so extent elements 4 and 5 will be 0 and 1, respectively
+    return self.calculatedDoseDoubleArrayGy.reshape(experimentalFilmExtent[3]-experimentalFilmExtent[2]+1, experimentalFilmExtent[1]-experimentalFilmExtent[0]+1)
 
+  #------------------------------------------------------------------------------
+  def orientCalibratedFilmToPlanDoseSlice(self):
     if self.planDoseVolumeNode is None or self.croppedPlanDoseSliceVolumeNode is None:
       message = "No plan dose volume is selected or cropping to slice failed"
       logging.error(message)
       return message
+    if self.experimentalFilmSliceOrientation not in [AXIAL, CORONAL, SAGITTAL]:
+      message = "Invalid experimental film slice orientation"
+      logging.error(message)
+      return message
+    if self.getCroppedPlanDoseSliceArray2D() is None:
+      message = "Invalid cropped " + self.experimentalFilmSliceOrientation.lower() + " plan dose slice"
+      logging.error(message)
+      return message
 
-    # Expand the calibrated image to multiple slices for registration
-    paddedCalculatedDoseVolumeArrayGy = numpy.tile(self.calculatedDoseDoubleArrayGy, self.numberOfSlicesToPad)
+    # Make film image have the orientation of the dose slice so that processing can be done on the same plane.
+    # The film has a single slice, so its voxel order is the same in every orientation and only the extent needs to change
+    experimentalFilmExtent = self.experimentalFilmVolumeNode.GetImageData().GetExtent()
+    calibratedExperimentalFilmImageData = self.calibratedExperimentalFilmVolumeNode.GetImageData()
+    calibratedExperimentalFilmImageData.SetExtent(self.coreLogic.getOrientedSliceExtent(self.getCalibratedExperimentalFilmArray2D().shape, 1, self.experimentalFilmSliceOrientation, experimentalFilmExtent[0], experimentalFilmExtent[2]))
+    self.calibratedExperimentalFilmVolumeNode.SetAndObserveImageData(calibratedExperimentalFilmImageData)
 
-    # Make film images have the orientation of the dose slice so that processing can be done on the same plane
-    experimentalFilmExtent = self.experimentalFilmVolumeNode.GetImageData().GetExtent() # Axial volume, so extent elements 4 and 5 will be 0 and 1, respectively
-    croppedPlanDoseExtent = self.croppedPlanDoseSliceVolumeNode.GetImageData().GetExtent()
-    croppedDoseSliceDimensions = self.croppedPlanDoseSliceVolumeNode.GetImageData().GetDimensions()
-    message = ""
-    if self.experimentalFilmSliceOrientation == AXIAL:
-      if croppedPlanDoseExtent[4] == croppedPlanDoseExtent[5]:
-        # Pad cropped dose volume slice into multiple slices in coronal orientation
-        croppedPlanDoseArray = self.volumeToNumpyArray(self.croppedPlanDoseSliceVolumeNode)
-        paddedPlanDoseArray = numpy.tile(croppedPlanDoseArray, self.numberOfSlicesToPad)
-        paddedPlanDoseImageScalars = numpy_support.numpy_to_vtk(paddedPlanDoseArray, 1)
-        paddedPlanDoseImageDataExtent = [0,croppedDoseSliceDimensions[0]-1, 0,croppedDoseSliceDimensions[1]-1, 0,self.numberOfSlicesToPad-1]
-      else:
-        message = "Invalid cropped axial plan dose slice"
+    return ""
 
-    elif self.experimentalFilmSliceOrientation == CORONAL:
-      if croppedPlanDoseExtent[2] != croppedPlanDoseExtent[3]:
-        message = "Invalid cropped coronal plan dose slice"
-      else:
-        # Rotate calibrated experimental film image data to coronal
-        coronalExperimentalFilmExtent = [experimentalFilmExtent[0],experimentalFilmExtent[1],0,0,experimentalFilmExtent[2],experimentalFilmExtent[3]]
-        calculatedDoseDoubleArrayGy3D = self.calculatedDoseDoubleArrayGy.reshape(1, experimentalFilmExtent[3]-experimentalFilmExtent[2]+1, experimentalFilmExtent[1]-experimentalFilmExtent[0]+1)
-        coronalCalculatedDoseDoubleArrayGy3D = numpy.swapaxes(calculatedDoseDoubleArrayGy3D,0,1)
-        coronalCalculatedDoseDoubleArrayGy = numpy.ravel(coronalCalculatedDoseDoubleArrayGy3D)
-        calibratedExperimentalFilmImageData = self.calibratedExperimentalFilmVolumeNode.GetImageData()
-        calibratedExperimentalFilmImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(coronalCalculatedDoseDoubleArrayGy,1))
-        calibratedExperimentalFilmImageData.SetExtent(coronalExperimentalFilmExtent)
-        self.calibratedExperimentalFilmVolumeNode.SetAndObserveImageData(calibratedExperimentalFilmImageData)
-
-        # Rotate padded calibrated experimental film image data to coronal
-        paddedCoronalExperimentalFilmExtent = [experimentalFilmExtent[0],experimentalFilmExtent[1],0,self.numberOfSlicesToPad-1,experimentalFilmExtent[2],experimentalFilmExtent[3]]
-        paddedCalculatedDoseVolumeArrayGy3D = paddedCalculatedDoseVolumeArrayGy.reshape(self.numberOfSlicesToPad, experimentalFilmExtent[3]-experimentalFilmExtent[2]+1, experimentalFilmExtent[1]-experimentalFilmExtent[0]+1)
-        coronalPaddedCalculatedDoseVolumeArrayGy3D = numpy.swapaxes(paddedCalculatedDoseVolumeArrayGy3D,0,1)
-        coronalPaddedCalculatedDoseVolumeArrayGy = numpy.ravel(coronalPaddedCalculatedDoseVolumeArrayGy3D)
-        paddedCalibratedExperimentalFilmImageData = vtk.vtkImageData()
-        paddedCalibratedExperimentalFilmImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(coronalPaddedCalculatedDoseVolumeArrayGy,1))
-        paddedCalibratedExperimentalFilmImageData.SetExtent(paddedCoronalExperimentalFilmExtent)
-
-        # Pad cropped dose volume slice into multiple slices in coronal orientation
-        self.croppedPlanDoseSliceVolumeNode.GetImageData().SetExtent(croppedPlanDoseExtent[0],croppedPlanDoseExtent[1], croppedPlanDoseExtent[4],croppedPlanDoseExtent[5], 0,0) # Set extent to axial so that padding works properly
-        croppedPlanDoseArray = self.volumeToNumpyArray(self.croppedPlanDoseSliceVolumeNode)
-        paddedPlanDoseArray = numpy.tile(croppedPlanDoseArray, self.numberOfSlicesToPad)
-        paddedPlanDoseArrayGy3D = paddedPlanDoseArray.reshape(self.numberOfSlicesToPad, croppedPlanDoseExtent[5]-croppedPlanDoseExtent[4]+1, croppedPlanDoseExtent[1]-croppedPlanDoseExtent[0]+1)
-        coronalPaddedPlanDoseArrayGy3D = numpy.swapaxes(paddedPlanDoseArrayGy3D,0,1)
-        coronalPaddedPlanDoseArrayGy = numpy.ravel(coronalPaddedPlanDoseArrayGy3D)
-        paddedPlanDoseImageScalars = numpy_support.numpy_to_vtk(coronalPaddedPlanDoseArrayGy, 1)
-        paddedPlanDoseImageDataExtent = [0,croppedDoseSliceDimensions[0]-1, 0,self.numberOfSlicesToPad-1, 0,croppedDoseSliceDimensions[2]-1]
-        self.croppedPlanDoseSliceVolumeNode.GetImageData().SetExtent(croppedPlanDoseExtent) # Restore extent for further processing
+  #------------------------------------------------------------------------------
+  def padPlanDoseSliceForRegistration(self):
+    if self.planDoseVolumeNode is None or self.croppedPlanDoseSliceVolumeNode is None:
+      message = "No plan dose volume is selected or cropping to slice failed"
+      logging.error(message)
+      return message
 
-    elif self.experimentalFilmSliceOrientation == SAGITTAL:
-      if croppedPlanDoseExtent[0] != croppedPlanDoseExtent[1]:
-        message = "Invalid cropped sagittal plan dose slice"
-      else:
-        # Rotate calibrated experimental film image data to sagittal
-        sagittalExperimentalFilmExtent = [0,0,experimentalFilmExtent[0],experimentalFilmExtent[1],experimentalFilmExtent[2],experimentalFilmExtent[3]]
-        calculatedDoseDoubleArrayGy3D = self.calculatedDoseDoubleArrayGy.reshape(1, experimentalFilmExtent[3]-experimentalFilmExtent[2]+1, experimentalFilmExtent[1]-experimentalFilmExtent[0]+1)
-        sagittalCalculatedDoseDoubleArrayGy3D = numpy.swapaxes(numpy.swapaxes(calculatedDoseDoubleArrayGy3D,0,1),1,2)
-        sagittalCalculatedDoseDoubleArrayGy = numpy.ravel(sagittalCalculatedDoseDoubleArrayGy3D)
-        calibratedExperimentalFilmImageData = self.calibratedExperimentalFilmVolumeNode.GetImageData()
-        calibratedExperimentalFilmImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(sagittalCalculatedDoseDoubleArrayGy,1))
-        calibratedExperimentalFilmImageData.SetExtent(sagittalExperimentalFilmExtent)
-        self.calibratedExperimentalFilmVolumeNode.SetAndObserveImageData(calibratedExperimentalFilmImageData)
-
-        # Rotate padded calibrated experimental film image data to sagittal
-        paddedSagittalExperimentalFilmExtent = [0,self.numberOfSlicesToPad-1,experimentalFilmExtent[0],experimentalFilmExtent[1],experimentalFilmExtent[2],experimentalFilmExtent[3]]
-        paddedCalculatedDoseVolumeArrayGy3D = paddedCalculatedDoseVolumeArrayGy.reshape(self.numberOfSlicesToPad, experimentalFilmExtent[3]-experimentalFilmExtent[2]+1, experimentalFilmExtent[1]-experimentalFilmExtent[0]+1)
-        sagittalPaddedCalculatedDoseVolumeArrayGy3D = numpy.swapaxes(numpy.swapaxes(paddedCalculatedDoseVolumeArrayGy3D,0,1),1,2)
-        sagittalPaddedCalculatedDoseVolumeArrayGy = numpy.ravel(sagittalPaddedCalculatedDoseVolumeArrayGy3D)
-        paddedCalibratedExperimentalFilmImageData = vtk.vtkImageData()
-        paddedCalibratedExperimentalFilmImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(sagittalPaddedCalculatedDoseVolumeArrayGy,1))
-        paddedCalibratedExperimentalFilmImageData.SetExtent(paddedSagittalExperimentalFilmExtent)
-
-        # Pad cropped dose volume slice into multiple slices in sagittal orientation
-        self.croppedPlanDoseSliceVolumeNode.GetImageData().SetExtent(croppedPlanDoseExtent[0],croppedPlanDoseExtent[1], croppedPlanDoseExtent[4],croppedPlanDoseExtent[5], 0,0) # Set extent to axial so that padding works properly
-        croppedPlanDoseArray = self.volumeToNumpyArray(self.croppedPlanDoseSliceVolumeNode)
-        paddedPlanDoseArray = numpy.tile(croppedPlanDoseArray, self.numberOfSlicesToPad)
-        paddedPlanDoseArrayGy3D = paddedPlanDoseArray.reshape(self.numberOfSlicesToPad, croppedPlanDoseExtent[5]-croppedPlanDoseExtent[4]+1, croppedPlanDoseExtent[3]-croppedPlanDoseExtent[2]+1)
-        sagittalPaddedPlanDoseArrayGy3D = numpy.swapaxes(numpy.swapaxes(paddedPlanDoseArrayGy3D,0,1),1,2)
-        sagittalPaddedPlanDoseArrayGy = numpy.ravel(sagittalPaddedPlanDoseArrayGy3D)
-        paddedPlanDoseImageScalars = numpy_support.numpy_to_vtk(sagittalPaddedPlanDoseArrayGy, 1)
-        paddedPlanDoseImageDataExtent = [0,self.numberOfSlicesToPad-1, 0,croppedDoseSliceDimensions[1]-1, 0,croppedDoseSliceDimensions[2]-1]
-        self.croppedPlanDoseSliceVolumeNode.GetImageData().SetExtent(croppedPlanDoseExtent) # Restore extent for further processing
-
-    if message != "":
+    croppedPlanDoseArray2D = self.getCroppedPlanDoseSliceArray2D()
+    if croppedPlanDoseArray2D is None:
+      message = "Invalid cropped plan dose slice for " + self.experimentalFilmSliceOrientation + " experimental film"
       logging.error(message)
       return message
 
-    # Create scalar volume node for padded calibrated film
-    self.paddedCalibratedExperimentalFilmVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+    # Expand the calibrated film and the plan dose slice to multiple slices for registration
+    experimentalFilmExtent = self.experimentalFilmVolumeNode.GetImageData().GetExtent()
+    paddedCalibratedExperimentalFilmImageData = self.createPaddedOrientedSliceImageData(self.getCalibratedExperimentalFilmArray2D(), self.numberOfSlicesToPad, experimentalFilmExtent[0], experimentalFilmExtent[2])
+    paddedPlanDoseImageData = self.createPaddedOrientedSliceImageData(croppedPlanDoseArray2D, self.numberOfSlicesToPad)
+
+    # Create scalar volume node for padded calibrated film (nodes of the previous padding are reused)
+    if self.paddedCalibratedExperimentalFilmVolumeNode is None or not slicer.mrmlScene.IsNodePresent(self.paddedCalibratedExperimentalFilmVolumeNode):
+      self.paddedCalibratedExperimentalFilmVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+      slicer.mrmlScene.AddNode(self.paddedCalibratedExperimentalFilmVolumeNode)
+      self.paddedCalibratedExperimentalFilmVolumeNode.CreateDefaultDisplayNodes()
     self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveImageData(paddedCalibratedExperimentalFilmImageData)
     self.paddedCalibratedExperimentalFilmVolumeNode.SetName(self.experimentalFilmVolumeNode.GetName() + self.paddedForRegistrationVolumeNamePostfix)
-    slicer.mrmlScene.AddNode(self.paddedCalibratedExperimentalFilmVolumeNode)
-    self.paddedCalibratedExperimentalFilmVolumeNode.CreateDefaultDisplayNodes()
     # Set same geometry as experimental film
+    self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(None)
     self.paddedCalibratedExperimentalFilmVolumeNode.SetOrigin(self.calibratedExperimentalFilmVolumeNode.GetOrigin())
     self.paddedCalibratedExperimentalFilmVolumeNode.SetSpacing(self.calibratedExperimentalFilmVolumeNode.GetSpacing())
     self.paddedCalibratedExperimentalFilmVolumeNode.CopyOrientation(self.calibratedExperimentalFilmVolumeNode)
     # Auto window-level
-    self.paddedCalibratedExperimentalFilmVolumeNode.CreateDefaultDisplayNodes()
     self.paddedCalibratedExperimentalFilmVolumeNode.GetDisplayNode().AutoWindowLevelOn()
 
-    # Set padded scalars into image data
-    paddedPlanDoseImageData = vtk.vtkImageData()
-    paddedPlanDoseImageData.GetPointData().SetScalars(paddedPlanDoseImageScalars)
-    paddedPlanDoseImageData.SetExtent(paddedPlanDoseImageDataExtent)
     # Create padded dose slice volume
-    self.paddedPlanDoseSliceVolumeNode = slicer.vtkMRMLScalarVolumeNode()
-    paddedPlanDoseSliceVolumeName = slicer.mrmlScene.GenerateUniqueName(self.planDoseVolumeNode.GetName() + self.paddedForRegistrationVolumeNamePostfix)
-    self.paddedPlanDoseSliceVolumeNode.SetName(paddedPlanDoseSliceVolumeName)
-    slicer.mrmlScene.AddNode(self.paddedPlanDoseSliceVolumeNode)
+    if self.paddedPlanDoseSliceVolumeNode is None or not slicer.mrmlScene.IsNodePresent(self.paddedPlanDoseSliceVolumeNode):
+      self.paddedPlanDoseSliceVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+      paddedPlanDoseSliceVolumeName = slicer.mrmlScene.GenerateUniqueName(self.planDoseVolumeNode.GetName() + self.paddedForRegistrationVolumeNamePostfix)
+      self.paddedPlanDoseSliceVolumeNode.SetName(paddedPlanDoseSliceVolumeName)
+      slicer.mrmlScene.AddNode(self.paddedPlanDoseSliceVolumeNode)
+      self.paddedPlanDoseSliceVolumeNode.CreateDefaultDisplayNodes()
     self.paddedPlanDoseSliceVolumeNode.SetAndObserveImageData(paddedPlanDoseImageData)
     self.paddedPlanDoseSliceVolumeNode.CopyOrientation(self.croppedPlanDoseSliceVolumeNode)
-    self.paddedPlanDoseSliceVolumeNode.CreateDefaultDisplayNodes()
     self.paddedPlanDoseSliceVolumeNode.GetDisplayNode().AutoWindowLevelOn()
     self.paddedPlanDoseSliceVolumeNode.GetDisplayNode().SetAndObserveColorNodeID(self.croppedPlanDoseSliceVolumeNode.GetDisplayNode().GetColorNodeID())
 
     return ""
 
+  #------------------------------------------------------------------------------
+  def createPaddedOrientedSliceImageData(self, sliceArray2D, numberOfSlices, firstColumnIndex=0, firstRowIndex=0):
+    # Repeat a [row, column] slice along the normal of the experimental film slice orientation
+    paddedArray = self.coreLogic.createPaddedOrientedSliceArray(sliceArray2D, numberOfSlices, self.experimentalFilmSliceOrientation).ravel()
+
+    paddedImageData = vtk.vtkImageData()
+    # Scalars reference the numpy array (no copy), which is kept alive by the VTK array
+    paddedImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(paddedArray, 0))
+    paddedImageData.SetExtent(self.coreLogic.getOrientedSliceExtent(sliceArray2D.shape, numberOfSlices, self.experimentalFilmSliceOrientation, firstColumnIndex, firstRowIndex))
+    return paddedImageData
+
+  #------------------------------------------------------------------------------
+  def getRegistrationVolumeNodes(self):
+    # Film and plan dose volumes that are registered: padded volumes for BRAINSFit, the calibrated film
+    # and the cropped plan dose slice for in-plane registration. Returns [film, plan dose]
+    if self.useBrainsFitRegistration:
+      return [self.paddedCalibratedExperimentalFilmVolumeNode, self.paddedPlanDoseSliceVolumeNode]
+    return [self.calibratedExperimentalFilmVolumeNode, self.croppedPlanDoseSliceVolumeNode]
+
   #------------------------------------------------------------------------------
   def preAlignCalibratedFilmWithPlanDoseSlice(self):
     if self.experimentalFilmPreAlignmentTransformNode is None:
@@ -710,10 +989,11 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     experimentalFilmPreAlignmentTransform.Identity()
 
     # Align film image center to dose slice center
+    [registrationFilmVolumeNode, registrationPlanDoseVolumeNode] = self.getRegistrationVolumeNodes()
     expBounds = [0]*6
-    self.paddedCalibratedExperimentalFilmVolumeNode.GetRASBounds(expBounds)
+    registrationFilmVolumeNode.GetRASBounds(expBounds)
     doseBounds = [0]*6
-    self.paddedPlanDoseSliceVolumeNode.GetRASBounds(doseBounds)
+    registrationPlanDoseVolumeNode.GetRASBounds(doseBounds)
     doseCenter = [(doseBounds[0]+doseBounds[1])/2, (doseBounds[2]+doseBounds[3])/2, (doseBounds[4]+doseBounds[5])/2]
     expCenter = [(expBounds[0]+expBounds[1])/2, (expBounds[2]+expBounds[3])/2, (expBounds[4]+expBounds[5])/2]
     exp2DoseTranslation = [doseCenter[x] - expCenter[x] for x in xrange(len(doseCenter))]
@@ -721,7 +1001,8 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     # Transform calibrated and padded experimental films
     self.experimentalFilmPreAlignmentTransformNode.SetMatrixTransformToParent(experimentalFilmPreAlignmentTransform.GetMatrix())
-    self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmPreAlignmentTransformNode.GetID())
+    if self.paddedCalibratedExperimentalFilmVolumeNode is not None:
+      self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmPreAlignmentTransformNode.GetID())
     self.calibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmPreAlignmentTransformNode.GetID())
 
     return ""
@@ -744,7 +1025,8 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     # Set pre-alignment and scan setup alignment transform to volumes
     # (in case registration already took place, but needed to be performed again)
-    self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmPreAlignmentTransformNode.GetID())
+    if self.paddedCalibratedExperimentalFilmVolumeNode is not None:
+      self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmPreAlignmentTransformNode.GetID())
     self.calibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmPreAlignmentTransformNode.GetID())
 
     return ""
@@ -804,6 +1086,187 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
   #------------------------------------------------------------------------------
   def registerExperimentalFilmToPlanDose(self):
+    # Register experimental film to plan dose slice and wait for the registration to complete.
+    # Registration is skipped if the registration stage is up to date
+    message = self.initializeFilmToPlanDoseRegistration()
+    if message != '':
+      return message
+    fingerprint = self.getRegistrationStageFingerprint()
+    if self.workflowStageLogic.isStageUpToDate(REGISTRATION_STAGE, fingerprint, self.getWorkflowStageOutputFingerprint([self.experimentalFilmToDoseSliceTransformNode])):
+      return ""
+
+    message = self.prepareExperimentalFilmToPlanDoseRegistration()
+    if message != '':
+      return message
+
+    # Transform of a registration of the same film and plan dose slice with the same parameters is loaded from the disk cache
+    registrationDiskCacheKey = self.getRegistrationDiskCacheKey()
+    cachedArrays = self.diskCacheLogic.getArrays(registrationDiskCacheKey)
+    if cachedArrays is not None:
+      self.experimentalFilmToDoseSliceTransformNode.SetMatrixTransformToParent(self.numpyArrayToVtkMatrix(cachedArrays[0]))
+    elif self.useBrainsFitRegistration:
+      cliBrainsFitRigidNode = slicer.cli.run(slicer.modules.brainsfit, None, self.getBrainsFitRegistrationParameters(), wait_for_completion=True)
+      logging.info("Registration status: " + cliBrainsFitRigidNode.GetStatusString())
+      if cliBrainsFitRigidNode.GetStatus() != cliBrainsFitRigidNode.Completed:
+        message = "BRAINSFit registration failed (status: " + cliBrainsFitRigidNode.GetStatusString() + ")"
+        logging.error(message)
+        # Film was modified for registration, so it is prepared again next time
+        self.workflowStageLogic.invalidateStage(REGISTRATION_PREPARATION_STAGE)
+        return message
+    else:
+      self.experimentalFilmToDoseSliceTransformNode.SetMatrixTransformToParent(self.registerExperimentalFilmToPlanDoseInPlane())
+    if cachedArrays is None:
+      self.storeRegistrationResultInDiskCache(registrationDiskCacheKey)
+
+    self.applyExperimentalFilmToPlanDoseRegistrationResult()
+    self.workflowStageLogic.setStageCompleted(REGISTRATION_STAGE, fingerprint, self.getWorkflowStageOutputFingerprint([self.experimentalFilmToDoseSliceTransformNode]))
+    return ""
+
+  #------------------------------------------------------------------------------
+  def startExperimentalFilmToPlanDoseRegistration(self, completedCallback, progressCallback=None):
+    # Register experimental film to plan dose slice without blocking the application.
+    # BRAINSFit runs in the background and its CLI node status events drive the registration:
+    # - progressCallback(progressPercent) is called on progress updates
+    # - completedCallback(message) is called with empty message as soon as the registration transform is ready,
+    #   or with the error message if registration failed, was cancelled or did not complete in time
+    # In-plane registration, and registration that is skipped because the registration stage is up to date or its result
+    # is in the disk cache, complete before this function returns (and completedCallback is called).
+    # Returns error message if registration could not be started, in which case completedCallback is not called
+    if self.brainsFitCliNode is not None:
+      return "Registration is already in progress"
+
+    message = self.initializeFilmToPlanDoseRegistration()
+    if message != '':
+      return message
+    fingerprint = self.getRegistrationStageFingerprint()
+    if self.workflowStageLogic.isStageUpToDate(REGISTRATION_STAGE, fingerprint, self.getWorkflowStageOutputFingerprint([self.experimentalFilmToDoseSliceTransformNode])):
+      completedCallback('')
+      return ''
+
+    message = self.prepareExperimentalFilmToPlanDoseRegistration()
+    if message != '':
+      return message
+
+    registrationDiskCacheKey = self.getRegistrationDiskCacheKey()
+    cachedArrays = self.diskCacheLogic.getArrays(registrationDiskCacheKey)
+    if cachedArrays is not None or not self.useBrainsFitRegistration:
+      if cachedArrays is not None:
+        self.experimentalFilmToDoseSliceTransformNode.SetMatrixTransformToParent(self.numpyArrayToVtkMatrix(cachedArrays[0]))
+      else:
+        self.experimentalFilmToDoseSliceTransformNode.SetMatrixTransformToParent(self.registerExperimentalFilmToPlanDoseInPlane())
+        self.storeRegistrationResultInDiskCache(registrationDiskCacheKey)
+      self.applyExperimentalFilmToPlanDoseRegistrationResult()
+      self.workflowStageLogic.setStageCompleted(REGISTRATION_STAGE, fingerprint, self.getWorkflowStageOutputFingerprint([self.experimentalFilmToDoseSliceTransformNode]))
+      completedCallback('')
+      return ''
+
+    self.brainsFitRegistrationFingerprint = fingerprint
+    self.brainsFitRegistrationDiskCacheKey = registrationDiskCacheKey
+    self.registrationCompletedCallback = completedCallback
+    self.registrationProgressCallback = progressCallback
+    self.brainsFitCliNode = slicer.cli.run(slicer.modules.brainsfit, None, self.getBrainsFitRegistrationParameters(), wait_for_completion=False)
+    self.brainsFitCliNodeObserverTag = self.brainsFitCliNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onBrainsFitCliNodeModified)
+
+    if self.registrationTimeoutTimer is None:
+      self.registrationTimeoutTimer = qt.QTimer()
+      self.registrationTimeoutTimer.setSingleShot(True)
+      self.registrationTimeoutTimer.connect('timeout()', self.onRegistrationTimeout)
+    self.registrationTimeoutTimer.start(self.registrationTimeoutSeconds * 1000)
+
+    # Handle the case when the status has already changed before the observer was added
+    self.onBrainsFitCliNodeModified(self.brainsFitCliNode, None)
+    return ''
+
+  #------------------------------------------------------------------------------
+  def cancelExperimentalFilmToPlanDoseRegistration(self):
+    if self.brainsFitCliNode is None:
+      return
+    self.brainsFitCliNode.Cancel()
+    self.endBrainsFitRegistration("Registration was cancelled")
+
+  #------------------------------------------------------------------------------
+  def onBrainsFitCliNodeModified(self, cliNode, event):
+    if self.brainsFitCliNode is None:
+      return
+    status = cliNode.GetStatus()
+    if status == cliNode.Completed:
+      logging.info("Registration status: " + cliNode.GetStatusString())
+      self.endBrainsFitRegistration('')
+    elif status == cliNode.CompletedWithErrors or status == cliNode.Cancelled:
+      self.endBrainsFitRegistration("BRAINSFit registration failed (status: " + cliNode.GetStatusString() + ")")
+    elif self.registrationProgressCallback is not None:
+      self.registrationProgressCallback(cliNode.GetProgress())
+
+  #------------------------------------------------------------------------------
+  def onRegistrationTimeout(self):
+    if self.brainsFitCliNode is None:
+      return
+    self.brainsFitCliNode.Cancel()
+    self.endBrainsFitRegistration("BRAINSFit registration did not complete in " + str(self.registrationTimeoutSeconds) + " seconds")
+
+  #------------------------------------------------------------------------------
+  def endBrainsFitRegistration(self, message):
+    self.registrationTimeoutTimer.stop()
+    self.brainsFitCliNode.RemoveObserver(self.brainsFitCliNodeObserverTag)
+    self.brainsFitCliNode = None
+    self.brainsFitCliNodeObserverTag = None
+    completedCallback = self.registrationCompletedCallback
+    self.registrationCompletedCallback = None
+    self.registrationProgressCallback = None
+    fingerprint = self.brainsFitRegistrationFingerprint
+    self.brainsFitRegistrationFingerprint = None
+    registrationDiskCacheKey = self.brainsFitRegistrationDiskCacheKey
+    self.brainsFitRegistrationDiskCacheKey = None
+
+    if message == '':
+      self.storeRegistrationResultInDiskCache(registrationDiskCacheKey)
+      self.applyExperimentalFilmToPlanDoseRegistrationResult()
+      self.workflowStageLogic.setStageCompleted(REGISTRATION_STAGE, fingerprint, self.getWorkflowStageOutputFingerprint([self.experimentalFilmToDoseSliceTransformNode]))
+    else:
+      logging.error(message)
+      # Film was modified for registration, so it is prepared again next time
+      self.workflowStageLogic.invalidateStage(REGISTRATION_PREPARATION_STAGE)
+    if completedCallback is not None:
+      completedCallback(message)
+
+  #------------------------------------------------------------------------------
+  def getRegistrationStageFingerprint(self):
+    # Registration depends on the prepared film and plan dose slice (upstream stage), the scan setup alignment
+    # and the registration parameters
+    preAlignmentToWorldMatrix = vtk.vtkMatrix4x4()
+    self.experimentalFilmPreAlignmentTransformNode.GetMatrixTransformToWorld(preAlignmentToWorldMatrix)
+    registrationInputs = self.getRegistrationInputs()
+    registrationInputs += [preAlignmentToWorldMatrix.GetElement(row, column) for row in xrange(3) for column in xrange(4)]
+    return self.workflowStageLogic.getStageFingerprint(REGISTRATION_STAGE, registrationInputs)
+
+  #------------------------------------------------------------------------------
+  def getRegistrationInputs(self):
+    return [self.useBrainsFitRegistration, self.registrationSamplingPercentage, self.registrationSamplingSeed,
+      self.registrationMaximumStepLength, self.registrationMinimumStepLength, self.registrationMaximumNumberOfIterations,
+      self.registrationRelaxationFactor, self.registrationGradientMagnitudeTolerance, self.registrationRotationScale]
+
+  #------------------------------------------------------------------------------
+  def getRegistrationDiskCacheKey(self):
+    # Registration depends on the calibrated film and the plan dose slice (identified by their disk cache keys), the geometry
+    # of the prepared film (pixel spacing and hardened pre-alignment) and the registration parameters.
+    # None if the upstream results are not in the disk cache
+    if self.doseConversionDiskCacheKey is None or self.planDoseSliceDiskCacheKey is None:
+      return None
+    return self.getDiskCacheKey([REGISTRATION_STAGE, self.doseConversionDiskCacheKey, self.planDoseSliceDiskCacheKey,
+      self.getVolumeIjkToWorldMatrixArray(self.calibratedExperimentalFilmVolumeNode), self.experimentalFilmSliceOrientation,
+      self.numberOfSlicesToPad] + self.getRegistrationInputs())
+
+  #------------------------------------------------------------------------------
+  def storeRegistrationResultInDiskCache(self, registrationDiskCacheKey):
+    filmToDoseSliceMatrix = vtk.vtkMatrix4x4()
+    self.experimentalFilmToDoseSliceTransformNode.GetMatrixTransformToParent(filmToDoseSliceMatrix)
+    self.diskCacheLogic.setArrays(registrationDiskCacheKey, [self.vtkMatrixToNumpyArray(filmToDoseSliceMatrix)])
+
+  #------------------------------------------------------------------------------
+  def prepareExperimentalFilmToPlanDoseRegistration(self):
+    # The film is modified for registration, so the result of a previous registration is not valid any more
+    self.workflowStageLogic.invalidateStage(REGISTRATION_STAGE)
+
     # Setup initialization transform
     if self.experimentalFilmToDoseSliceInitializationTransformNode is None:
       self.experimentalFilmToDoseSliceInitializationTransformNode = slicer.vtkMRMLLinearTransformNode()
@@ -815,38 +1278,38 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     # Harden initialization transform on the film images. It is necessary to harden, and not
     # simply use the "initialTransform" registration parameter, because it is not taken into account
-    # correctly (rotation takes place).
-    self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmToDoseSliceInitializationTransformNode.GetID())
-    slicer.vtkSlicerTransformLogic.hardenTransform(self.paddedCalibratedExperimentalFilmVolumeNode)
+    # correctly (rotation takes place). Geometry is reset first, so that a transform hardened by a previous
+    # registration is not applied twice.
+    self.resetCalibratedFilmGeometry()
+    if self.paddedCalibratedExperimentalFilmVolumeNode is not None:
+      self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmToDoseSliceInitializationTransformNode.GetID())
+      slicer.vtkSlicerTransformLogic.hardenTransform(self.paddedCalibratedExperimentalFilmVolumeNode)
     self.calibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmToDoseSliceInitializationTransformNode.GetID())
     slicer.vtkSlicerTransformLogic.hardenTransform(self.calibratedExperimentalFilmVolumeNode)
 
-    # Create output transform node
-    self.experimentalFilmToDoseSliceTransformNode = slicer.vtkMRMLLinearTransformNode()
-    slicer.mrmlScene.AddNode(self.experimentalFilmToDoseSliceTransformNode)
-    self.experimentalFilmToDoseSliceTransformNode.SetName(self.experimentalFilmToDoseSliceTransformName)
+    # Create output transform node (the node of the previous registration is reused)
+    if self.experimentalFilmToDoseSliceTransformNode is None or not slicer.mrmlScene.IsNodePresent(self.experimentalFilmToDoseSliceTransformNode):
+      self.experimentalFilmToDoseSliceTransformNode = slicer.vtkMRMLLinearTransformNode()
+      slicer.mrmlScene.AddNode(self.experimentalFilmToDoseSliceTransformNode)
+      self.experimentalFilmToDoseSliceTransformNode.SetName(self.experimentalFilmToDoseSliceTransformName)
 
-    # Perform registration with BRAINS
+    return ""
+
+  #------------------------------------------------------------------------------
+  def getBrainsFitRegistrationParameters(self):
     parametersRigid = {}
     parametersRigid["fixedVolume"] = self.paddedPlanDoseSliceVolumeNode
     parametersRigid["movingVolume"] = self.paddedCalibratedExperimentalFilmVolumeNode
     parametersRigid["useRigid"] = True
-    parametersRigid["samplingPercentage"] = 0.05
-    parametersRigid["maximumStepLength"] = 15 # Start with long-range translations
-    parametersRigid["relaxationFactor"] = 0.8 # Relax quickly
-    parametersRigid["translationScale"] = 10000000 # Suppress rotation
+    parametersRigid["samplingPercentage"] = self.registrationSamplingPercentage
+    parametersRigid["maximumStepLength"] = self.registrationMaximumStepLength
+    parametersRigid["relaxationFactor"] = self.registrationRelaxationFactor
+    parametersRigid["translationScale"] = self.registrationRotationScale
     parametersRigid["linearTransform"] = self.experimentalFilmToDoseSliceTransformNode.GetID()
+    return parametersRigid
 
-    # Runs the registration
-    cliBrainsFitRigidNode = slicer.cli.run(slicer.modules.brainsfit, None, parametersRigid)
-    waitCount = 0
-    while cliBrainsFitRigidNode.GetStatusString() != 'Completed' and waitCount < 20:
-      self.delayDisplay( "Register experimental film to dose using rigid registration... %d" % waitCount )
-      waitCount += 1
-    self.delayDisplay("Register experimental film to dose using rigid registration finished")
-
-    logging.info("Registration status: " + cliBrainsFitRigidNode.GetStatusString())
-
+  #------------------------------------------------------------------------------
+  def applyExperimentalFilmToPlanDoseRegistrationResult(self):
     # Set transform to calibrated experimental film
     self.calibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmToDoseSliceTransformNode.GetID())
 
@@ -861,16 +1324,393 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     #TODO: Check AP translation and rotation parameters, warn if transform takes slice off-plane
 
+  #------------------------------------------------------------------------------
+  def registerExperimentalFilmToPlanDoseInPlane(self):
+    # Rigid 2-D registration of the (hardened) calibrated film to the cropped plan dose slice (see FilmDosimetryCoreLogic).
+    # Returns the film to plan dose slice transform matrix (RAS)
+    fixedImage = self.createInPlaneSimpleItkImage(self.croppedPlanDoseSliceVolumeNode)
+    movingImage = self.createInPlaneSimpleItkImage(self.calibratedExperimentalFilmVolumeNode)
+    self.setCoreLogicParameters()
+    filmToDoseSliceMatrixArray = self.coreLogic.registerInPlane(fixedImage, movingImage, self.experimentalFilmSliceOrientation)
+    return self.numpyArrayToVtkMatrix(filmToDoseSliceMatrixArray)
+
+  #------------------------------------------------------------------------------
+  def getSlicePlaneRasAxes(self):
+    # RAS axes (and IJK axes of the axis-aligned slice volumes) spanning the plane of the film
+    return self.coreLogic.getSlicePlaneRasAxes(self.experimentalFilmSliceOrientation)
+
+  #------------------------------------------------------------------------------
+  def createInPlaneSimpleItkImage(self, sliceVolumeNode, pixelType=numpy.float32):
+    # 2-D SimpleITK image of a single slice volume. Physical coordinates are the in-plane RAS coordinates
+    # (with the parent transforms of the volume applied), so the film and the plan dose slice are in the same 2-D space.
+    return self.coreLogic.createInPlaneImage(self.volumeToNumpyArray3D(sliceVolumeNode), self.getVolumeIjkToWorldMatrixArray(sliceVolumeNode),
+      self.experimentalFilmSliceOrientation, pixelType)
+
+  #------------------------------------------------------------------------------
+  # Step 5
+
+  #------------------------------------------------------------------------------
+  def computeGammaDoseComparison(self):
+    # Gamma dose comparison of the registered calibrated film (compare dose) to the plan dose slice (reference dose).
+    # Results are stored in gammaVolumeNode, gammaPassFractionPercent and gammaReport.
+    # Gamma is not computed again if the gamma stage is up to date, the previous results are kept then
+    if self.croppedPlanDoseSliceVolumeNode is None or self.calibratedExperimentalFilmVolumeNode is None:
+      self.gammaPassFractionPercent = None
+      self.gammaReport = ''
+      message = "Plan dose slice or calibrated experimental film is missing"
+      logging.error(message)
+      return message
+    if self.gammaVolumeNode is None:
+      self.gammaPassFractionPercent = None
+      self.gammaReport = ''
+      message = "No gamma volume is selected"
+      logging.error(message)
+      return message
+
+    fingerprint = self.getGammaStageFingerprint()
+    if self.workflowStageLogic.isStageUpToDate(GAMMA_STAGE, fingerprint, self.getGammaStageOutputFingerprint()):
+      return ""
+    self.workflowStageLogic.invalidateStage(GAMMA_STAGE)
+    self.gammaPassFractionPercent = None
+    self.gammaReport = ''
+
+    if self.useBuiltInGammaEngine:
+      message = self.computeGammaDoseComparisonUsingBuiltInEngine()
+    else:
+      message = self.computeGammaDoseComparisonUsingDoseComparisonModule()
+    if message == '':
+      self.workflowStageLogic.setStageCompleted(GAMMA_STAGE, fingerprint, self.getGammaStageOutputFingerprint())
+    return message
+
+  #------------------------------------------------------------------------------
+  def getGammaStageFingerprint(self):
+    # Gamma depends on the dose volumes and the evaluation grid (see getGammaInputFingerprint), the mask and the gamma parameters
+    gammaInputs = self.getGammaInputFingerprint() + [self.useBuiltInGammaEngine, self.gammaDtaDistanceToleranceMm, self.gammaDoseDifferenceTolerancePercent,
+      self.gammaUseMaximumDose, self.gammaReferenceDoseGy, self.gammaAnalysisThresholdPercent, self.gammaUseEarlyTermination, self.gammaMaximumGamma,
+      self.gammaNormalizationMode, self.gammaHybridMinimumDosePercent, self.gammaVolumeNode.GetID()]
+    if self.maskSegmentationNode is not None:
+      gammaInputs.append(self.getSegmentMaskCacheKey(self.maskSegmentationNode, self.maskSegmentID, self.croppedPlanDoseSliceVolumeNode))
+    else:
+      gammaInputs.append(None)
+    return self.workflowStageLogic.getStageFingerprint(GAMMA_STAGE, gammaInputs)
+
+  #------------------------------------------------------------------------------
+  def getGammaStageOutputFingerprint(self):
+    # Gamma result is valid while the gamma image is not replaced
+    gammaImageData = self.gammaVolumeNode.GetImageData()
+    return self.getWorkflowStageOutputFingerprint([self.gammaVolumeNode]) + (gammaImageData.GetMTime() if gammaImageData is not None else None,)
+
+  #------------------------------------------------------------------------------
+  def computeGammaDoseComparisonUsingBuiltInEngine(self):
+    # Gamma is computed in 2-D by GammaLogic on the evaluation grid (see getGammaInputArrays)
+    gammaInputArrays = self.getGammaInputArrays()
+    if gammaInputArrays is None:
+      return "Failed to create mask from segmentation " + self.maskSegmentationNode.GetName()
+    [referenceDoseArray, compareDoseArray, pixelSpacingMm, maskArray] = gammaInputArrays
+
+    self.setGammaLogicParameters()
+    gammaArray = self.gammaLogic.computeGamma(referenceDoseArray, compareDoseArray, pixelSpacingMm, maskArray, self.gammaInputFingerprint)
+
+    # Gamma volume has the geometry of the evaluation grid
+    self.gammaVolumeNode.SetAndObserveImageData(self.createPaddedOrientedSliceImageData(gammaArray, 1))
+    self.gammaVolumeNode.SetIJKToRASMatrix(self.getGammaEvaluationGridIjkToRasMatrix())
+    self.gammaVolumeNode.SetAndObserveTransformNodeID(None)
+    if self.gammaVolumeNode.GetDisplayNode() is None:
+      self.gammaVolumeNode.CreateDefaultDisplayNodes()
+
+    if self.gammaLogic.passFractionPercent is None:
+      message = "No pixels to evaluate (check the analysis threshold, the mask and the film position)"
+      logging.error(message)
+      return message
+    self.gammaPassFractionPercent = self.gammaLogic.passFractionPercent
+    self.gammaReport = self.gammaLogic.report
     return ""
 
+  #------------------------------------------------------------------------------
+  def computeGammaCriteriaSweep(self, criteria, tableNode=None):
+    # Gamma pass rates for several [DTA (mm), dose difference (%), analysis threshold (%)] criteria with the built-in
+    # engine in a single pass. A normalization mode may be given as fourth element of a criterion, e.g. to get global
+    # and local gamma side by side. Other parameters are the current gamma parameters. Returns a table (list of rows with
+    # the columns in gammaCriteriaSweepColumnNames), which is also written to tableNode if given. None on error
+    if self.croppedPlanDoseSliceVolumeNode is None or self.calibratedExperimentalFilmVolumeNode is None:
+      logging.error("Plan dose slice or calibrated experimental film is missing")
+      return None
+    gammaInputArrays = self.getGammaInputArrays()
+    if gammaInputArrays is None:
+      return None
+    [referenceDoseArray, compareDoseArray, pixelSpacingMm, maskArray] = gammaInputArrays
+
+    self.setGammaLogicParameters()
+    table = self.gammaLogic.computeGammaSweep(referenceDoseArray, compareDoseArray, pixelSpacingMm, criteria, maskArray)
+
+    if tableNode is not None:
+      vtkTable = tableNode.GetTable()
+      vtkTable.Initialize()
+      for columnIndex in xrange(len(self.gammaCriteriaSweepColumnNames)):
+        # Normalization mode is text, the others are numbers
+        column = vtk.vtkStringArray() if columnIndex == 3 else vtk.vtkDoubleArray()
+        column.SetName(self.gammaCriteriaSweepColumnNames[columnIndex])
+        column.SetNumberOfValues(len(table))
+        for rowIndex in xrange(len(table)):
+          value = table[rowIndex][columnIndex]
+          column.SetValue(rowIndex, value if value is not None else float('nan'))
+        vtkTable.AddColumn(column)
+      tableNode.Modified()
+
+    return table
 
+  #------------------------------------------------------------------------------
+  def getGammaInputArrays(self):
+    # Reference and compare dose arrays on the evaluation grid, which is the plan dose slice grid refined by
+    # gammaEvaluationGridRefinementFactor. The calibrated film is resampled on it, plan dose pixels not covered
+    # by the film are NaN in the compare dose. Returns [reference dose, compare dose, [row, column] spacing, mask]
+    # (mask is None if no mask segmentation is selected), None if the mask cannot be created.
+    # The dose arrays are kept until the fingerprint of the inputs changes.
+    gammaInputFingerprint = self.getGammaInputFingerprint()
+    if self.gammaInputArrays is None or gammaInputFingerprint != self.gammaInputFingerprint:
+      self.gammaInputArrays = self.coreLogic.createGammaInputArrays(self.createInPlaneSimpleItkImage(self.croppedPlanDoseSliceVolumeNode, numpy.float64),
+        self.createInPlaneSimpleItkImage(self.calibratedExperimentalFilmVolumeNode, numpy.float64), self.gammaEvaluationGridRefinementFactor, self.gammaUseLinearInterpolation)
+      self.gammaInputFingerprint = gammaInputFingerprint
+    [referenceDoseArray, compareDoseArray, pixelSpacingMm, evaluationGridGeometryImage] = self.gammaInputArrays
+
+    maskArray = None
+    if self.maskSegmentationNode is not None:
+      maskArray = self.getGammaMaskArray(evaluationGridGeometryImage)
+      if maskArray is None:
+        logging.error("Failed to create mask from segmentation " + self.maskSegmentationNode.GetName())
+        return None
+
+    return [referenceDoseArray, compareDoseArray, pixelSpacingMm, maskArray]
 
-#
-# Constants
-#
-AXIAL = 'Axial'
-CORONAL = 'Coronal'
-SAGITTAL = 'Sagittal'
+  #------------------------------------------------------------------------------
+  def getGammaInputFingerprint(self):
+    # Everything the gamma input dose arrays depend on: the plan dose slice and calibrated film volumes
+    # (modified times of the nodes and their images, film position), interpolation and evaluation grid
+    fingerprint = [self.experimentalFilmSliceOrientation, self.gammaUseLinearInterpolation, self.gammaEvaluationGridRefinementFactor]
+    for volumeNode in [self.croppedPlanDoseSliceVolumeNode, self.calibratedExperimentalFilmVolumeNode]:
+      fingerprint += self.getVolumeNodeFingerprint(volumeNode)
+    return fingerprint
+
+  #------------------------------------------------------------------------------
+  def setGammaLogicParameters(self):
+    self.gammaLogic.dtaDistanceToleranceMm = self.gammaDtaDistanceToleranceMm
+    self.gammaLogic.doseDifferenceTolerancePercent = self.gammaDoseDifferenceTolerancePercent
+    self.gammaLogic.referenceDoseGy = None if self.gammaUseMaximumDose else self.gammaReferenceDoseGy
+    self.gammaLogic.analysisThresholdPercent = self.gammaAnalysisThresholdPercent
+    self.gammaLogic.maximumGamma = self.gammaMaximumGamma
+    self.gammaLogic.numberOfThreads = self.gammaNumberOfThreads
+    self.gammaLogic.useEarlyTermination = self.gammaUseEarlyTermination
+    self.gammaLogic.normalizationMode = self.gammaNormalizationMode
+    self.gammaLogic.hybridMinimumDosePercent = self.gammaHybridMinimumDosePercent
+
+  #------------------------------------------------------------------------------
+  def getGammaEvaluationGridIjkToRasMatrix(self):
+    # IJK to RAS matrix of the plan dose slice with the in-plane axes refined by gammaEvaluationGridRefinementFactor
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    self.croppedPlanDoseSliceVolumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    ijkToRasMatrixArray = self.vtkMatrixToNumpyArray(ijkToRasMatrix)
+    extent = self.croppedPlanDoseSliceVolumeNode.GetImageData().GetExtent()
+    ijkToRasMatrixArray[:,3] = ijkToRasMatrixArray.dot([extent[0], extent[2], extent[4], 1])
+    return self.numpyArrayToVtkMatrix(self.coreLogic.getGammaEvaluationGridIjkToRasMatrix(ijkToRasMatrixArray, self.experimentalFilmSliceOrientation, self.gammaEvaluationGridRefinementFactor))
+
+  #------------------------------------------------------------------------------
+  def getGammaMaskArray(self, evaluationGridImage):
+    # Mask segment (or all segments if none is selected) rasterized on the gamma evaluation grid
+    maskImage = self.getSegmentMaskImage(self.maskSegmentationNode, self.maskSegmentID, self.croppedPlanDoseSliceVolumeNode)
+    if maskImage is None:
+      return None
+    if maskImage.GetSize() != evaluationGridImage.GetSize():
+      maskImage = sitk.Resample(maskImage, evaluationGridImage, sitk.Transform(), sitk.sitkNearestNeighbor, 0, sitk.sitkUInt8)
+    return sitk.GetArrayFromImage(maskImage) != 0
+
+  #------------------------------------------------------------------------------
+  def getLineProfileSampleMask(self, lineStartPointRas, lineEndPointRas, numberOfLineSamples):
+    # Whether the samples of a line profile are inside the mask segment (or any segment if none is selected).
+    # Returns None if no mask segmentation is selected or the mask cannot be created
+    if self.maskSegmentationNode is None or self.croppedPlanDoseSliceVolumeNode is None:
+      return None
+    maskImage = self.getSegmentMaskImage(self.maskSegmentationNode, self.maskSegmentID, self.croppedPlanDoseSliceVolumeNode)
+    if maskImage is None:
+      logging.error("Failed to create mask from segmentation " + self.maskSegmentationNode.GetName())
+      return None
+    maskArray = sitk.GetArrayFromImage(maskImage)
+    maskSize = maskImage.GetSize()
+
+    # Nearest mask pixel of all samples at once (the line is projected onto the slice plane)
+    planeRasAxes = self.getSlicePlaneRasAxes()
+    lineStartPoint = numpy.array([lineStartPointRas[rasAxis] for rasAxis in planeRasAxes])
+    lineEndPoint = numpy.array([lineEndPointRas[rasAxis] for rasAxis in planeRasAxes])
+    samplePoints = lineStartPoint + numpy.linspace(0.0, 1.0, numberOfLineSamples)[:,numpy.newaxis] * (lineEndPoint - lineStartPoint)
+    physicalToIndexMatrix = numpy.linalg.inv(numpy.array(maskImage.GetDirection()).reshape(2,2) * numpy.array(maskImage.GetSpacing()))
+    sampleIndices = numpy.floor((samplePoints - numpy.array(maskImage.GetOrigin())).dot(physicalToIndexMatrix.T) + 0.5).astype(int)
+    insideMaskImage = (sampleIndices >= 0).all(axis=1) & (sampleIndices[:,0] < maskSize[0]) & (sampleIndices[:,1] < maskSize[1])
+    sampleMask = numpy.zeros(numberOfLineSamples, dtype=bool)
+    sampleMask[insideMaskImage] = maskArray[sampleIndices[insideMaskImage,1], sampleIndices[insideMaskImage,0]] != 0
+    return sampleMask
+
+  #------------------------------------------------------------------------------
+  def getSegmentMaskImage(self, segmentationNode, segmentID, referenceVolumeNode):
+    # Segment (or all segments if segmentID is empty) rasterized on the grid of a slice volume, as an in-plane
+    # 2-D SimpleITK image. Rasterizing large structure sets is slow, so the masks are cached as packed bits until
+    # the segments or the reference geometry change. Returns None if the segments cannot be exported
+    cacheKey = self.getSegmentMaskCacheKey(segmentationNode, segmentID, referenceVolumeNode)
+    if cacheKey in self.segmentMaskCache:
+      cacheEntry = self.segmentMaskCache.pop(cacheKey)
+      self.segmentMaskCache[cacheKey] = cacheEntry
+      [packedMaskArray, maskShape, maskOrigin, maskSpacing, maskDirection] = cacheEntry
+      maskArray = numpy.unpackbits(packedMaskArray)[:maskShape[0]*maskShape[1]].reshape(maskShape)
+      maskImage = sitk.GetImageFromArray(maskArray)
+      maskImage.SetOrigin(maskOrigin)
+      maskImage.SetSpacing(maskSpacing)
+      maskImage.SetDirection(maskDirection)
+      return maskImage
+
+    segmentIDs = vtk.vtkStringArray()
+    if segmentID is not None and segmentID != '':
+      segmentIDs.InsertNextValue(segmentID)
+    else:
+      segmentationNode.GetSegmentation().GetSegmentIDs(segmentIDs)
+
+    maskLabelmapNode = slicer.vtkMRMLLabelMapVolumeNode()
+    slicer.mrmlScene.AddNode(maskLabelmapNode)
+    maskImage = None
+    if slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentationNode, segmentIDs, maskLabelmapNode, referenceVolumeNode):
+      labelmapImage = self.createInPlaneSimpleItkImage(maskLabelmapNode, numpy.uint8)
+      maskArray = sitk.GetArrayFromImage(labelmapImage) != 0
+      maskImage = sitk.GetImageFromArray(maskArray.astype(numpy.uint8))
+      maskImage.CopyInformation(labelmapImage)
+      self.segmentMaskCache[cacheKey] = [numpy.packbits(maskArray), maskArray.shape, maskImage.GetOrigin(), maskImage.GetSpacing(), maskImage.GetDirection()]
+      while len(self.segmentMaskCache) > self.segmentMaskCacheMaximumNumberOfEntries:
+        self.segmentMaskCache.popitem(last=False)
+    slicer.mrmlScene.RemoveNode(maskLabelmapNode)
+    return maskImage
+
+  #------------------------------------------------------------------------------
+  def getSegmentMaskCacheKey(self, segmentationNode, segmentID, referenceVolumeNode):
+    # Everything the rasterized mask depends on: the segments (modified times of the segmentation, the segments and
+    # their master representations, segmentation position) and the geometry of the reference volume
+    segmentation = segmentationNode.GetSegmentation()
+    segmentIDs = vtk.vtkStringArray()
+    if segmentID is not None and segmentID != '':
+      segmentIDs.InsertNextValue(segmentID)
+    else:
+      segmentation.GetSegmentIDs(segmentIDs)
+    cacheKey = [segmentationNode.GetID(), segmentID, self.experimentalFilmSliceOrientation, segmentationNode.GetMTime(), segmentation.GetMTime()]
+    for index in xrange(segmentIDs.GetNumberOfValues()):
+      segment = segmentation.GetSegment(segmentIDs.GetValue(index))
+      if segment is None:
+        continue
+      cacheKey += [segmentIDs.GetValue(index), segment.GetMTime()]
+      masterRepresentation = segment.GetRepresentation(segmentation.GetMasterRepresentationName())
+      if masterRepresentation is not None:
+        cacheKey.append(masterRepresentation.GetMTime())
+
+    cacheKey += [referenceVolumeNode.GetID()] + list(referenceVolumeNode.GetImageData().GetExtent())
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    cacheKey += [ijkToRasMatrix.GetElement(row, column) for row in xrange(3) for column in xrange(4)]
+    # Modifying the parent transforms does not modify the nodes, so the transform matrices are included
+    for transformableNode in [segmentationNode, referenceVolumeNode]:
+      nodeToWorldMatrix = vtk.vtkMatrix4x4()
+      if transformableNode.GetParentTransformNode() is not None:
+        transformableNode.GetParentTransformNode().GetMatrixTransformToWorld(nodeToWorldMatrix)
+      cacheKey += [nodeToWorldMatrix.GetElement(row, column) for row in xrange(3) for column in xrange(4)]
+    return tuple(cacheKey)
+
+  #------------------------------------------------------------------------------
+  def computeGammaDoseComparisonUsingDoseComparisonModule(self):
+    # Gamma dose comparison using the SlicerRT dose comparison module
+    if self.gammaNormalizationMode != GLOBAL_NORMALIZATION:
+      message = "Local and hybrid gamma normalization are only supported by the built-in gamma engine"
+      logging.error(message)
+      return message
+    try:
+      doseComparisonLogic = slicer.modules.dosecomparison.logic()
+    except AttributeError:
+      message = "Dose comparison module is not available (SlicerRT extension needs to be installed)"
+      logging.error(message)
+      return message
+
+    gammaParameterSetNode = slicer.vtkMRMLDoseComparisonNode()
+    slicer.mrmlScene.AddNode(gammaParameterSetNode)
+    gammaParameterSetNode.SetAndObserveReferenceDoseVolumeNode(self.croppedPlanDoseSliceVolumeNode)
+    gammaParameterSetNode.SetAndObserveCompareDoseVolumeNode(self.calibratedExperimentalFilmVolumeNode)
+    gammaParameterSetNode.SetAndObserveMaskSegmentationNode(self.maskSegmentationNode)
+    if self.maskSegmentID is not None and self.maskSegmentID != '':
+      gammaParameterSetNode.SetMaskSegmentID(self.maskSegmentID)
+    else:
+      gammaParameterSetNode.SetMaskSegmentID(None)
+    gammaParameterSetNode.SetAndObserveGammaVolumeNode(self.gammaVolumeNode)
+    gammaParameterSetNode.SetDtaDistanceToleranceMm(self.gammaDtaDistanceToleranceMm)
+    gammaParameterSetNode.SetDoseDifferenceTolerancePercent(self.gammaDoseDifferenceTolerancePercent)
+    gammaParameterSetNode.SetUseMaximumDose(self.gammaUseMaximumDose)
+    gammaParameterSetNode.SetUseLinearInterpolation(self.gammaUseLinearInterpolation)
+    gammaParameterSetNode.SetReferenceDoseGy(self.gammaReferenceDoseGy)
+    gammaParameterSetNode.SetAnalysisThresholdPercent(self.gammaAnalysisThresholdPercent)
+    gammaParameterSetNode.SetDoseThresholdOnReferenceOnly(True)
+    gammaParameterSetNode.SetMaximumGamma(self.gammaMaximumGamma)
+
+    message = doseComparisonLogic.ComputeGammaDoseDifference(gammaParameterSetNode)
+    if not gammaParameterSetNode.GetResultsValid():
+      logging.error("Gamma dose comparison failed: " + str(message))
+      return message if message else "Gamma dose comparison failed"
+    self.setNotEvaluatedGammaOfDoseComparisonModule()
+    self.gammaPassFractionPercent = gammaParameterSetNode.GetPassFractionPercent()
+    self.gammaReport = gammaParameterSetNode.GetReportString()
+    return ""
+
+  #------------------------------------------------------------------------------
+  def setNotEvaluatedGammaOfDoseComparisonModule(self):
+    # Gamma of the pixels that the dose comparison module does not evaluate (below the analysis threshold or outside
+    # the mask) is 0 in its gamma volume. They are set to NOT_EVALUATED_GAMMA, as with the built-in engine
+    gammaArray2D = self.coreLogic.getInPlaneSliceArray2D(self.volumeToNumpyArray3D(self.gammaVolumeNode), self.experimentalFilmSliceOrientation)
+    referenceDoseArray2D = self.getCroppedPlanDoseSliceArray2D()
+    if gammaArray2D is None or referenceDoseArray2D is None or gammaArray2D.shape != referenceDoseArray2D.shape:
+      logging.warning("Gamma volume is not on the plan dose slice grid, gamma of the pixels that are not evaluated is left at 0")
+      return
+    maskArray = None
+    if self.maskSegmentationNode is not None:
+      maskImage = self.getSegmentMaskImage(self.maskSegmentationNode, self.maskSegmentID, self.croppedPlanDoseSliceVolumeNode)
+      if maskImage is not None:
+        maskArray = sitk.GetArrayFromImage(maskImage) != 0
+
+    self.setGammaLogicParameters()
+    referenceDoseArray2D = numpy.asarray(referenceDoseArray2D, dtype=numpy.float64)
+    referenceDoseGy = self.gammaLogic.referenceDoseGy if self.gammaLogic.referenceDoseGy is not None else float(referenceDoseArray2D.max())
+    evaluatedPixelMask = self.gammaLogic.getEvaluatedPixelMask(referenceDoseArray2D, numpy.zeros(referenceDoseArray2D.shape), referenceDoseGy, maskArray)
+    gammaArray2D[~evaluatedPixelMask] = NOT_EVALUATED_GAMMA
+    self.gammaVolumeNode.GetImageData().Modified()
+
+  #------------------------------------------------------------------------------
+  def compareGammaEngines(self, criteria=((1.0,1.0), (2.0,2.0), (3.0,3.0))):
+    # Compute gamma with both the built-in engine and the SlicerRT dose comparison module for each
+    # [DTA (mm), dose difference (%)] criterion, using the current gamma parameters otherwise.
+    # Returns a list of [DTA, dose difference, built-in pass fraction, SlicerRT pass fraction, built-in time (s), SlicerRT time (s)].
+    # Pass fraction of an engine is None if it failed (the error is logged)
+    originalParameters = [self.useBuiltInGammaEngine, self.gammaDtaDistanceToleranceMm, self.gammaDoseDifferenceTolerancePercent]
+    results = []
+    try:
+      for [dtaDistanceToleranceMm, doseDifferenceTolerancePercent] in criteria:
+        self.gammaDtaDistanceToleranceMm = dtaDistanceToleranceMm
+        self.gammaDoseDifferenceTolerancePercent = doseDifferenceTolerancePercent
+        result = [dtaDistanceToleranceMm, doseDifferenceTolerancePercent]
+        times = []
+        for useBuiltInGammaEngine in [True, False]:
+          self.useBuiltInGammaEngine = useBuiltInGammaEngine
+          startTime = time.time()
+          message = self.computeGammaDoseComparison()
+          times.append(time.time() - startTime)
+          if message != '':
+            logging.error('Gamma {0}mm/{1}% failed with the {2} engine: {3}'.format(dtaDistanceToleranceMm, doseDifferenceTolerancePercent,
+              'built-in' if useBuiltInGammaEngine else 'SlicerRT', message))
+            result.append(None)
+          else:
+            result.append(self.gammaPassFractionPercent)
+        results.append(result + times)
+        logging.info('Gamma {0}mm/{1}%: pass fraction {2}% (built-in, {4:.2f}s), {3}% (SlicerRT, {5:.2f}s)'.format(*results[-1]))
+    finally:
+      [self.useBuiltInGammaEngine, self.gammaDtaDistanceToleranceMm, self.gammaDoseDifferenceTolerancePercent] = originalParameters
+    return results
 
 
 
@@ -0,0 +1,678 @@
+import os
+import math
+import logging
+import tempfile
+import numpy
+import SimpleITK as sitk
+
+#
+# FilmDosimetryCoreLogic
+#
+class FilmDosimetryCoreLogic:
+  """ Numeric core of film dosimetry analysis: optical density, calibration function fitting, dose conversion,
+      plan dose slice extraction, slice reorientation, in-plane registration and the gamma evaluation grid.
+      Operates on NumPy arrays and SimpleITK images with their geometry instead of MRML nodes, and does not
+      use Slicer or Qt, so it can be used in worker processes and plain Python. Gamma itself is computed by GammaLogic.
+      Geometry: 4x4 IJK to RAS matrices map [i,j,k] voxel indices of arrays indexed as [k,j,i] to RAS coordinates.
+  """
+
+  def __init__(self):
+    # Calibration parameters
+    self.calibrationCoefficients = [0,0,0,0] # Calibration coefficients [a,b,c,n] in calibration function dose = a + b*OD + c*OD^n (cGy)
+    self.calibrationFunctionExponentMinimum = 1.0
+    self.calibrationFunctionExponentMaximum = 4.0
+    self.calibrationFunctionExponentSearchStep = 0.01 # Coarse search step, the exponent is then refined to the tolerance below
+    self.calibrationFunctionExponentTolerance = 1e-6
+
+    # Dose conversion parameters
+    self.useDoseLookupTable = True # Convert unsigned integer film scans to dose using precomputed lookup tables
+    self.doseLookupTableBlockSize = 8192 # Number of pixels converted at once with logarithm tables, small enough to stay in cache
+    self.streamingCalibrationMaximumMemoryMb = 256 # Upper bound of the working memory used by streaming calibration
+    self.streamingCalibrationWorkingBytesPerPixel = 48 # Input tiles, optical density, masks and dose temporaries for one pixel
+    self.streamingCalibrationOutputDirectory = None # Directory of the memory-mapped dose files (unnamed temporary file if None)
+    self.streamingCalibrationStreamableFileExtensions = ['.mha', '.mhd'] # Formats read tile by tile (uncompressed MetaImage)
+
+    # In-plane registration parameters
+    self.registrationSamplingPercentage = 0.25 # Fraction of the fixed image pixels sampled by the metric
+    self.registrationSamplingSeed = 1 # Fixed seed for the random metric samples so that registration is repeatable
+    self.registrationMaximumStepLength = 15 # Start with long-range translations
+    self.registrationMinimumStepLength = 0.001
+    self.registrationMaximumNumberOfIterations = 1500
+    self.registrationRelaxationFactor = 0.8 # Relax quickly
+    self.registrationGradientMagnitudeTolerance = 1e-8 # Stop on step length instead of gradient (metric gradients are small for dose images)
+    self.registrationRotationScale = 10000000 # Suppress rotation (optimizer scale of the rotation angle relative to the translations)
+
+    # Dose lookup tables for the current calibration coefficients, keyed by pixel types and flood field
+    self.doseLookupTables = {}
+    self.doseLookupTableCalibrationCoefficients = None
+    self.streamingCalibrationNumberOfInvalidPixels = None # Invalid optical density pixels summed over the tiles during streaming calibration
+
+  #------------------------------------------------------------------------------
+  # Calibration function
+
+  #------------------------------------------------------------------------------
+  def calculateOpticalDensity(self, floodFieldPixelValue, filmPixelValue):
+    # Optical density of a (mean) film pixel value, negative values are clamped to 0
+    opticalDensity = math.log10(float(floodFieldPixelValue)/filmPixelValue)
+    return max(opticalDensity, 0.0)
+
+  #------------------------------------------------------------------------------
+  def findBestFittingCalibrationFunctionCoefficients(self, opticalDensities, doses):
+    # Fit the calibration function to measured optical density and dose (cGy) arrays.
+    # Stores and returns the coefficients [a,b,c,n]
+    opticalDensities = numpy.asarray(opticalDensities, dtype=numpy.float64)
+    doses = numpy.asarray(doses, dtype=numpy.float64)
+
+    # Coarse search: evaluate all candidate exponents at once
+    exponentCandidates = numpy.arange(self.calibrationFunctionExponentMinimum, self.calibrationFunctionExponentMaximum + 0.5*self.calibrationFunctionExponentSearchStep, self.calibrationFunctionExponentSearchStep)
+    sumSquaredErrors = self.calculateCalibrationFunctionSumSquaredErrorsForExponents(opticalDensities, doses, exponentCandidates)
+    bestCandidateIndex = numpy.argmin(sumSquaredErrors)
+    bestN = exponentCandidates[bestCandidateIndex]
+
+    # Refine exponent around the best candidate using golden-section search
+    lowerN = max(self.calibrationFunctionExponentMinimum, bestN - self.calibrationFunctionExponentSearchStep)
+    upperN = min(self.calibrationFunctionExponentMaximum, bestN + self.calibrationFunctionExponentSearchStep)
+    sumSquaredErrorForExponent = lambda n: self.calculateCalibrationFunctionSumSquaredErrorsForExponents(opticalDensities, doses, numpy.array([n]))[0]
+    refinedN = self.findMinimumInInterval(sumSquaredErrorForExponent, lowerN, upperN, self.calibrationFunctionExponentTolerance)
+    if sumSquaredErrorForExponent(refinedN) <= sumSquaredErrors[bestCandidateIndex]:
+      bestN = refinedN
+
+    bestN = float(bestN)
+    coeffs = self.findCoefficientsForExponent(opticalDensities, doses, bestN)
+    MSE = self.meanSquaredError(opticalDensities, doses, coeffs[0],coeffs[1],coeffs[2],bestN)
+    self.calibrationCoefficients = [ coeffs[0], coeffs[1], coeffs[2], bestN ]
+    logging.info("Optimized calibration function coefficients: A=" + str(round(self.calibrationCoefficients[0],4)) + ", B=" + str(round(self.calibrationCoefficients[1],4)) + ", C=" + str(round(self.calibrationCoefficients[2],4)) + ", N=" + str(round(self.calibrationCoefficients[3],4)) + " (mean square error: "  + str(round(MSE,4)) + ")")
+    return self.calibrationCoefficients
+
+  #------------------------------------------------------------------------------
+  def calculateCalibrationFunctionSumSquaredErrorsForExponents(self, opticalDensities, doses, exponents):
+    # Least squares residuals of dose = a + b*OD + c*OD^n for every exponent n in one pass.
+    # The columns [1, OD] are common to all design matrices, so they are orthogonalized once,
+    # then the OD^n columns of all the stacked design matrices are projected out together.
+    # The remaining one-dimensional least squares problems have a closed form solution.
+    commonTermsBasis = numpy.linalg.qr(numpy.column_stack((numpy.ones_like(opticalDensities), opticalDensities)))[0]
+    doseResiduals = doses - commonTermsBasis.dot(commonTermsBasis.T.dot(doses))
+    powerTerms = numpy.power(opticalDensities[numpy.newaxis,:], numpy.asarray(exponents, dtype=numpy.float64)[:,numpy.newaxis])
+    powerTermResiduals = powerTerms - powerTerms.dot(commonTermsBasis).dot(commonTermsBasis.T)
+
+    doseResidualsSumSquares = doseResiduals.dot(doseResiduals)
+    powerTermResidualsSumSquares = numpy.einsum('ij,ij->i', powerTermResiduals, powerTermResiduals)
+    powerTermDoseProducts = powerTermResiduals.dot(doseResiduals)
+
+    # Where OD^n is (numerically) a linear function of OD the power term does not improve the fit
+    independentPowerTerms = powerTermResidualsSumSquares > 1e-12 * numpy.einsum('ij,ij->i', powerTerms, powerTerms)
+    sumSquaredErrors = numpy.full(len(powerTerms), doseResidualsSumSquares)
+    sumSquaredErrors[independentPowerTerms] -= powerTermDoseProducts[independentPowerTerms]**2 / powerTermResidualsSumSquares[independentPowerTerms]
+    return numpy.maximum(sumSquaredErrors, 0.0)
+
+  #------------------------------------------------------------------------------
+  def findMinimumInInterval(self, function, lowerBound, upperBound, tolerance):
+    # Golden-section search for the minimum of a unimodal function within [lowerBound, upperBound]
+    inverseGoldenRatio = (math.sqrt(5.0) - 1.0) / 2.0
+    lowerProbe = upperBound - inverseGoldenRatio * (upperBound - lowerBound)
+    upperProbe = lowerBound + inverseGoldenRatio * (upperBound - lowerBound)
+    lowerProbeValue = function(lowerProbe)
+    upperProbeValue = function(upperProbe)
+    while upperBound - lowerBound > tolerance:
+      if lowerProbeValue <= upperProbeValue:
+        upperBound = upperProbe
+        upperProbe, upperProbeValue = lowerProbe, lowerProbeValue
+        lowerProbe = upperBound - inverseGoldenRatio * (upperBound - lowerBound)
+        lowerProbeValue = function(lowerProbe)
+      else:
+        lowerBound = lowerProbe
+        lowerProbe, lowerProbeValue = upperProbe, upperProbeValue
+        upperProbe = lowerBound + inverseGoldenRatio * (upperBound - lowerBound)
+        upperProbeValue = function(upperProbe)
+    return (lowerBound + upperBound) / 2.0
+
+  #------------------------------------------------------------------------------
+  def findCoefficientsForExponent(self, opticalDensities, doses, n):
+    # Calculate matrix A
+    functionTermsMatrix = numpy.column_stack((numpy.ones_like(opticalDensities), opticalDensities, numpy.power(opticalDensities, n)))
+
+    # Calculate constant term coefficient vector
+    functionConstantTerms = numpy.linalg.lstsq(functionTermsMatrix, doses, rcond=-1)
+    return functionConstantTerms[0].tolist()
+
+  #------------------------------------------------------------------------------
+  def meanSquaredError(self, opticalDensities, doses, a, b, c, n):
+    calculatedDoses = self.applyCalibrationFunctionOnOpticalDensityArray(opticalDensities, a, b, c, n)
+    return numpy.mean((doses - calculatedDoses)**2)
+
+  #------------------------------------------------------------------------------
+  def applyCalibrationFunctionOnSingleOpticalDensityValue(self, OD, a, b, c, n):
+    return a + b*OD + c*(OD**n)
+
+  #------------------------------------------------------------------------------
+  def applyCalibrationFunctionOnOpticalDensityArray(self, opticalDensityArray, a, b, c, n):
+    # Evaluated in the same order as applyCalibrationFunctionOnSingleOpticalDensityValue
+    doseArray = opticalDensityArray * b
+    doseArray += a
+    powerTermArray = numpy.power(opticalDensityArray, n)
+    powerTermArray *= c
+    doseArray += powerTermArray
+    return doseArray
+
+  #------------------------------------------------------------------------------
+  # Dose conversion
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromPixelValueArrays(self, experimentalFilmArray, floodField):
+    # Convert film pixel values to dose (Gy) using whole-array operations.
+    # Gives the same result as evaluating the calibration function pixel by pixel.
+    # Flood field is either an array of the same size as the film or a single uniform pixel value.
+    if self.useDoseLookupTable and self.isDoseLookupTableApplicable(experimentalFilmArray, floodField):
+      return self.calculateDoseUsingLookupTables(experimentalFilmArray, floodField)
+
+    opticalDensityArray = self.calculateOpticalDensityArray(experimentalFilmArray, floodField)
+    return self.calculateDoseFromOpticalDensityArray(opticalDensityArray)
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromOpticalDensityArray(self, opticalDensityArray):
+    doseArrayGy = self.applyCalibrationFunctionOnOpticalDensityArray(opticalDensityArray, self.calibrationCoefficients[0], self.calibrationCoefficients[1], self.calibrationCoefficients[2], self.calibrationCoefficients[3])
+    doseArrayGy /= 100.0 # cGy to Gy
+    numpy.maximum(doseArrayGy, 0.0, out=doseArrayGy)
+    return doseArrayGy
+
+  #------------------------------------------------------------------------------
+  def calculateOpticalDensityArray(self, experimentalFilmArray, floodField, logInvalidPixels=True):
+    # Flood field to film pixel value ratio (computed in double precision regardless of the input type)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      opticalDensityArray = numpy.true_divide(floodField, experimentalFilmArray, dtype=numpy.float64)
+
+    # Optical density cannot be calculated where the film pixel is zero or the ratio is not positive
+    invalidPixelMask = (experimentalFilmArray == 0)
+    invalidPixelMask |= (opticalDensityArray <= 0.0)
+    numberOfInvalidPixels = numpy.count_nonzero(invalidPixelMask)
+    if numberOfInvalidPixels > 0:
+      if logInvalidPixels:
+        self.logInvalidOpticalDensityPixels(numberOfInvalidPixels)
+      opticalDensityArray[invalidPixelMask] = 1.0
+
+    numpy.log10(opticalDensityArray, out=opticalDensityArray)
+    numpy.maximum(opticalDensityArray, 0.0, out=opticalDensityArray)
+    return opticalDensityArray
+
+  #------------------------------------------------------------------------------
+  def logInvalidOpticalDensityPixels(self, numberOfInvalidPixels):
+    if self.streamingCalibrationNumberOfInvalidPixels is not None:
+      # Streaming calibration reports the total for the whole film after the last tile
+      self.streamingCalibrationNumberOfInvalidPixels += numberOfInvalidPixels
+      return
+    logging.error('Failure when calculating optical density for ' + str(numberOfInvalidPixels) + ' pixels of the experimental film image (zero film pixel value or non-positive flood field to film ratio). Optical density is set to 0 for these pixels')
+
+  #------------------------------------------------------------------------------
+  def isDoseLookupTableApplicable(self, experimentalFilmArray, floodField):
+    # Lookup tables span every possible pixel value, so only 8 and 16 bit unsigned integer scans are supported
+    if experimentalFilmArray.dtype not in (numpy.uint8, numpy.uint16):
+      return False
+    if numpy.ndim(floodField) == 0:
+      return True
+    return floodField.dtype in (numpy.uint8, numpy.uint16)
+
+  #------------------------------------------------------------------------------
+  def calculateDoseUsingLookupTables(self, experimentalFilmArray, floodField):
+    # Lookup tables only depend on the calibration function, so they are rebuilt when the coefficients change
+    calibrationCoefficients = tuple(self.calibrationCoefficients)
+    if calibrationCoefficients != self.doseLookupTableCalibrationCoefficients:
+      self.doseLookupTables = {}
+      self.doseLookupTableCalibrationCoefficients = calibrationCoefficients
+
+    if numpy.ndim(floodField) == 0:
+      # Uniform flood field: dose only depends on the film pixel value, conversion is a single gather
+      floodFieldValue = float(floodField)
+      lookupTableKey = ('UniformFloodField', experimentalFilmArray.dtype.str, floodFieldValue)
+      doseLookupTable = self.doseLookupTables.get(lookupTableKey)
+      if doseLookupTable is None:
+        pixelValues = numpy.arange(numpy.iinfo(experimentalFilmArray.dtype).max + 1, dtype=experimentalFilmArray.dtype)
+        opticalDensityLookupTable = self.calculateOpticalDensityArray(pixelValues, floodFieldValue, logInvalidPixels=False)
+        doseLookupTable = self.calculateDoseFromOpticalDensityArray(opticalDensityLookupTable)
+        self.doseLookupTables[lookupTableKey] = doseLookupTable
+
+      if floodFieldValue > 0:
+        numberOfInvalidPixels = numpy.count_nonzero(experimentalFilmArray == 0)
+      else:
+        numberOfInvalidPixels = experimentalFilmArray.size
+      if numberOfInvalidPixels > 0:
+        self.logInvalidOpticalDensityPixels(numberOfInvalidPixels)
+
+      return doseLookupTable.take(experimentalFilmArray)
+
+    if experimentalFilmArray.dtype == numpy.uint8 and floodField.dtype == numpy.uint8:
+      # 8 bit film and flood field: dose for every pixel value pair fits in a 256x256 table
+      lookupTableKey = ('FloodFieldImage', experimentalFilmArray.dtype.str, floodField.dtype.str)
+      doseLookupTable = self.doseLookupTables.get(lookupTableKey)
+      if doseLookupTable is None:
+        floodFieldValues, filmValues = numpy.meshgrid(numpy.arange(256, dtype=numpy.uint8), numpy.arange(256, dtype=numpy.uint8), indexing='ij')
+        opticalDensityLookupTable = self.calculateOpticalDensityArray(filmValues.ravel(), floodFieldValues.ravel(), logInvalidPixels=False)
+        doseLookupTable = self.calculateDoseFromOpticalDensityArray(opticalDensityLookupTable)
+        self.doseLookupTables[lookupTableKey] = doseLookupTable
+
+      lookupTableIndices = floodField.astype(numpy.uint16)
+      lookupTableIndices <<= 8
+      lookupTableIndices |= experimentalFilmArray
+      numberOfInvalidPixels = experimentalFilmArray.size - numpy.count_nonzero(numpy.logical_and(experimentalFilmArray, floodField))
+      if numberOfInvalidPixels > 0:
+        self.logInvalidOpticalDensityPixels(numberOfInvalidPixels)
+
+      return doseLookupTable.take(lookupTableIndices)
+
+    # Per-pixel flood field with 16 bit values: factorise OD = log10(floodField) - log10(film) into
+    # two 1-D logarithm tables. Zero pixel values map to -inf/+inf so the difference is -inf for
+    # every invalid pixel, which is then clamped to 0 optical density like in the direct calculation.
+    # The calibration function still needs to be evaluated per pixel, so it is done in blocks that
+    # stay in cache instead of creating image-sized temporary arrays.
+    floodFieldLogarithmTable = self.getLogarithmLookupTable(floodField.dtype, -numpy.inf)
+    filmLogarithmTable = self.getLogarithmLookupTable(experimentalFilmArray.dtype, numpy.inf)
+    experimentalFilmPixels = experimentalFilmArray.ravel()
+    floodFieldPixels = floodField.ravel()
+    numberOfPixels = experimentalFilmPixels.size
+    doseArrayGy = numpy.empty(numberOfPixels, dtype=numpy.float64)
+    opticalDensityBlock = numpy.empty(self.doseLookupTableBlockSize, dtype=numpy.float64)
+    filmLogarithmBlock = numpy.empty(self.doseLookupTableBlockSize, dtype=numpy.float64)
+    numberOfInvalidPixels = 0
+    for blockStart in range(0, numberOfPixels, self.doseLookupTableBlockSize):
+      blockEnd = min(blockStart + self.doseLookupTableBlockSize, numberOfPixels)
+      opticalDensities = opticalDensityBlock[:blockEnd-blockStart]
+      filmLogarithms = filmLogarithmBlock[:blockEnd-blockStart]
+      floodFieldLogarithmTable.take(floodFieldPixels[blockStart:blockEnd], out=opticalDensities)
+      filmLogarithmTable.take(experimentalFilmPixels[blockStart:blockEnd], out=filmLogarithms)
+      opticalDensities -= filmLogarithms
+      numberOfInvalidPixels += numpy.count_nonzero(opticalDensities == -numpy.inf)
+      numpy.maximum(opticalDensities, 0.0, out=opticalDensities)
+      doseArrayGy[blockStart:blockEnd] = self.calculateDoseFromOpticalDensityArray(opticalDensities)
+
+    if numberOfInvalidPixels > 0:
+      self.logInvalidOpticalDensityPixels(numberOfInvalidPixels)
+
+    return doseArrayGy.reshape(experimentalFilmArray.shape)
+
+  #------------------------------------------------------------------------------
+  def getLogarithmLookupTable(self, pixelType, logarithmOfZero):
+    # Base 10 logarithm of every value of an unsigned integer pixel type
+    lookupTableKey = ('Logarithm', numpy.dtype(pixelType).str, logarithmOfZero)
+    logarithmTable = self.doseLookupTables.get(lookupTableKey)
+    if logarithmTable is None:
+      logarithmTable = numpy.arange(numpy.iinfo(pixelType).max + 1, dtype=numpy.float64)
+      logarithmTable[0] = 1.0
+      numpy.log10(logarithmTable, out=logarithmTable)
+      logarithmTable[0] = logarithmOfZero
+      self.doseLookupTables[lookupTableKey] = logarithmTable
+    return logarithmTable
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromPixelValueArraysInRowTiles(self, experimentalFilmArray, floodField, numberOfColumns, name, outputFilePath=None):
+    # Same as calculateDoseFromPixelValueArrays for flat pixel value arrays, but processes the film in row tiles and
+    # writes dose into a memory-mapped array, so the working memory does not grow with the film size.
+    # Tiles are views of the input arrays, so they are not copied.
+    numberOfRows = len(experimentalFilmArray) // numberOfColumns
+    if numpy.ndim(floodField) == 0:
+      readFloodFieldRows = None
+    else:
+      readFloodFieldRows = lambda firstRow, lastRow: floodField[firstRow*numberOfColumns:lastRow*numberOfColumns]
+    readFilmRows = lambda firstRow, lastRow: experimentalFilmArray[firstRow*numberOfColumns:lastRow*numberOfColumns]
+    return self.calculateDoseInRowTiles(numberOfRows, numberOfColumns, readFilmRows, readFloodFieldRows, floodField, name, outputFilePath)
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromFilmFilesStreaming(self, experimentalFilmFilePath, floodFieldFilePath, floodFieldValue=None, outputFilePath=None):
+    # Calibrate a film scan directly from file. Flood field is the uniform floodFieldValue if floodFieldFilePath is None.
+    # Returns the flat dose array (Gy), memory-mapped to outputFilePath if given.
+    filmRowReader = self.createImageFileRowReader(experimentalFilmFilePath)
+    if filmRowReader is None:
+      return None
+    [readFilmRows, filmSize] = filmRowReader
+    numberOfColumns = filmSize[0]
+    numberOfRows = filmSize[1]
+
+    if floodFieldFilePath is None:
+      if floodFieldValue is None:
+        logging.error('Flood field image or uniform flood field value is needed for calibration')
+        return None
+      floodField = floodFieldValue
+      readFloodFieldRows = None
+    else:
+      floodFieldRowReader = self.createImageFileRowReader(floodFieldFilePath)
+      if floodFieldRowReader is None:
+        return None
+      [readFloodFieldRows, floodFieldSize] = floodFieldRowReader
+      if floodFieldSize != filmSize:
+        logging.error("Experimental and flood field images must be the same size! (Experimental: " + str(filmSize) + ", FloodField: " + str(floodFieldSize))
+        return None
+      floodField = None
+
+    return self.calculateDoseInRowTiles(numberOfRows, numberOfColumns, readFilmRows, readFloodFieldRows, floodField, os.path.basename(experimentalFilmFilePath), outputFilePath)
+
+  #------------------------------------------------------------------------------
+  def createImageFileRowReader(self, filePath):
+    # Returns [readRows, size] where readRows(firstRow, lastRow) gives the flat pixel values of the rows.
+    # Formats that support streamed reading are read one tile at a time with a region-limited reader,
+    # other formats are read once (their readers would load the whole image for every tile).
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filePath)
+    try:
+      reader.ReadImageInformation()
+    except RuntimeError as e:
+      logging.error('Failed to read image information from ' + filePath + ': ' + str(e))
+      return None
+    if reader.GetNumberOfComponents() != 1:
+      logging.error('Only single component film images are supported: ' + filePath)
+      return None
+    size = reader.GetSize()
+    if len(size) > 2 and size[2] != 1:
+      logging.error('Only single slice film images are supported: ' + filePath)
+      return None
+
+    if os.path.splitext(filePath)[1].lower() in self.streamingCalibrationStreamableFileExtensions:
+      readRows = lambda firstRow, lastRow: self.readImageFileRows(reader, firstRow, lastRow)
+    else:
+      image = reader.Execute()
+      pixelValues = sitk.GetArrayViewFromImage(image).ravel()
+      # The row views reference the image buffer, so the image is kept alive by the closure
+      readRows = lambda firstRow, lastRow, image=image: pixelValues[firstRow*size[0]:lastRow*size[0]]
+    return [readRows, size]
+
+  #------------------------------------------------------------------------------
+  def readImageFileRows(self, reader, firstRow, lastRow):
+    # Read rows [firstRow, lastRow) as a flat pixel value array
+    size = reader.GetSize()
+    extractIndex = [0, firstRow] + [0] * (len(size) - 2)
+    extractSize = [size[0], lastRow - firstRow] + [1] * (len(size) - 2)
+    reader.SetExtractIndex(extractIndex)
+    reader.SetExtractSize(extractSize)
+    return sitk.GetArrayFromImage(reader.Execute()).ravel()
+
+  #------------------------------------------------------------------------------
+  def calculateDoseInRowTiles(self, numberOfRows, numberOfColumns, readFilmRows, readFloodFieldRows, floodField, name, outputFilePath=None):
+    # readFilmRows and readFloodFieldRows return the flat pixel values of rows [firstRow, lastRow).
+    # If readFloodFieldRows is None then floodField is the uniform flood field value.
+    maximumWorkingMemoryBytes = self.streamingCalibrationMaximumMemoryMb * 1024 * 1024
+    numberOfRowsPerTile = max(1, int(maximumWorkingMemoryBytes // (numberOfColumns * self.streamingCalibrationWorkingBytesPerPixel)))
+    doseArrayGy = self.createMemoryMappedDoseArray(numberOfRows * numberOfColumns, outputFilePath)
+
+    self.streamingCalibrationNumberOfInvalidPixels = 0
+    try:
+      for firstRow in range(0, numberOfRows, numberOfRowsPerTile):
+        lastRow = min(firstRow + numberOfRowsPerTile, numberOfRows)
+        experimentalFilmTile = readFilmRows(firstRow, lastRow)
+        floodFieldTile = readFloodFieldRows(firstRow, lastRow) if readFloodFieldRows is not None else floodField
+        doseArrayGy[firstRow*numberOfColumns:lastRow*numberOfColumns] = self.calculateDoseFromPixelValueArrays(experimentalFilmTile, floodFieldTile)
+      numberOfInvalidPixels = self.streamingCalibrationNumberOfInvalidPixels
+    finally:
+      self.streamingCalibrationNumberOfInvalidPixels = None
+    if numberOfInvalidPixels > 0:
+      self.logInvalidOpticalDensityPixels(numberOfInvalidPixels)
+
+    doseArrayGy.flush()
+    logging.info('Streaming calibration of ' + name + ': ' + str(numberOfRows) + ' rows in tiles of ' + str(numberOfRowsPerTile) + ' rows')
+    return doseArrayGy
+
+  #------------------------------------------------------------------------------
+  def createMemoryMappedDoseArray(self, numberOfPixels, outputFilePath=None):
+    # Dose is written to a file-backed array, so its pages can be written out and dropped by the
+    # operating system instead of being held in memory. Without an explicit path an unnamed
+    # temporary file is used that is removed when the array is released (the mapping keeps the file open).
+    if outputFilePath is not None:
+      return numpy.memmap(outputFilePath, dtype=numpy.float64, mode='w+', shape=(numberOfPixels,))
+    with tempfile.TemporaryFile(dir=self.streamingCalibrationOutputDirectory) as doseFile:
+      return numpy.memmap(doseFile, dtype=numpy.float64, mode='w+', shape=(numberOfPixels,))
+
+  #------------------------------------------------------------------------------
+  # Slice extraction and orientation
+
+  #------------------------------------------------------------------------------
+  def getSlicePlaneRasAxes(self, orientation):
+    # RAS axes (and IJK axes of the axis-aligned slice volumes) spanning the plane of the film
+    if orientation == AXIAL:
+      return [0,1]
+    elif orientation == CORONAL:
+      return [0,2]
+    else: # SAGITTAL
+      return [1,2]
+
+  #------------------------------------------------------------------------------
+  def extractPlanDoseSlice(self, planDoseArray3D, ijkToRasMatrix, orientation, slicePositionMm):
+    # Plan dose slice at slicePositionMm along the normal of the film orientation, linearly interpolated between the
+    # two nearest dose planes. If the plan dose voxel grid is aligned with the RAS axes (axes may be permuted or flipped),
+    # the slice keeps the in-plane voxel grid of the plan dose, with IJK axes reordered to point along the RAS axes.
+    # Other plan doses (e.g. oblique) are resampled on a grid aligned with the RAS axes, see resamplePlanDoseSlice.
+    # Returns [slice array indexed as [k,j,i] with a single voxel along the normal, origin, spacing], None on error
+    ijkToRasMatrix = numpy.asarray(ijkToRasMatrix, dtype=numpy.float64)
+    ijkToRasDirections = ijkToRasMatrix[0:3,0:3]
+    rasAxesOfIjkAxes = numpy.argmax(numpy.abs(ijkToRasDirections), axis=0)
+    numberOfNonzeroElements = numpy.count_nonzero(numpy.abs(ijkToRasDirections) > 1e-6 * numpy.abs(ijkToRasDirections).max())
+    if sorted(rasAxesOfIjkAxes.tolist()) != [0,1,2] or numberOfNonzeroElements != 3:
+      return self.resamplePlanDoseSlice(planDoseArray3D, ijkToRasMatrix, orientation, slicePositionMm)
+
+    # Array axes in [S,A,R] order and increasing RAS coordinates
+    ijkAxesOfRasAxes = [rasAxesOfIjkAxes.tolist().index(rasAxis) for rasAxis in range(3)]
+    rasArray3D = numpy.transpose(planDoseArray3D, [2-ijkAxesOfRasAxes[2], 2-ijkAxesOfRasAxes[1], 2-ijkAxesOfRasAxes[0]])
+    origin = ijkToRasMatrix[0:3,3].copy()
+    spacing = [0.0]*3
+    for rasAxis in range(3):
+      axisScale = ijkToRasDirections[rasAxis, ijkAxesOfRasAxes[rasAxis]]
+      spacing[rasAxis] = abs(axisScale)
+      if axisScale < 0:
+        numberOfVoxels = rasArray3D.shape[2-rasAxis]
+        origin[rasAxis] += axisScale * (numberOfVoxels-1)
+        reversedAxisIndex = [slice(None)]*3
+        reversedAxisIndex[2-rasAxis] = slice(None, None, -1)
+        rasArray3D = rasArray3D[tuple(reversedAxisIndex)]
+
+    # Interpolate between the planes around the slice position. Positions within half a voxel
+    # outside of the first or last plane use that plane
+    planeRasAxes = self.getSlicePlaneRasAxes(orientation)
+    normalRasAxis = 3 - planeRasAxes[0] - planeRasAxes[1]
+    normalArrayAxis = 2 - normalRasAxis
+    numberOfPlanes = rasArray3D.shape[normalArrayAxis]
+    planeIndex = (slicePositionMm - origin[normalRasAxis]) / spacing[normalRasAxis]
+    if planeIndex < -0.5 or planeIndex > numberOfPlanes - 0.5:
+      logging.error("Film slice position " + str(slicePositionMm) + " is outside the plan dose volume")
+      return None
+    planeIndex = min(max(planeIndex, 0.0), numberOfPlanes - 1.0)
+    lowerPlaneIndex = min(int(math.floor(planeIndex)), max(numberOfPlanes - 2, 0))
+    upperPlaneWeight = planeIndex - lowerPlaneIndex
+    sliceArray3D = numpy.take(rasArray3D, [lowerPlaneIndex], axis=normalArrayAxis).astype(numpy.result_type(rasArray3D.dtype, numpy.float32))
+    if upperPlaneWeight > 0:
+      sliceArray3D *= (1.0 - upperPlaneWeight)
+      sliceArray3D += upperPlaneWeight * numpy.take(rasArray3D, [lowerPlaneIndex+1], axis=normalArrayAxis)
+    origin[normalRasAxis] = slicePositionMm
+    return [numpy.ascontiguousarray(sliceArray3D), origin.tolist(), spacing]
+
+  #------------------------------------------------------------------------------
+  def resamplePlanDoseSlice(self, planDoseArray3D, ijkToRasMatrix, orientation, slicePositionMm):
+    # Plan dose slice at slicePositionMm of a plan dose that is not aligned with the RAS axes, linearly interpolated on
+    # a grid aligned with the RAS axes that covers the plan dose in the film plane. Grid spacing along each RAS axis is
+    # the spacing of the closest plan dose IJK axis. Voxels outside of the plan dose are 0.
+    # Returns [slice array indexed as [k,j,i] with a single voxel along the normal, origin, spacing], None on error
+    ijkToRasMatrix = numpy.asarray(ijkToRasMatrix, dtype=numpy.float64)
+    ijkToRasDirections = ijkToRasMatrix[0:3,0:3]
+    ijkSpacing = numpy.sqrt(numpy.sum(ijkToRasDirections**2, axis=0))
+    planDoseImage = sitk.GetImageFromArray(planDoseArray3D)
+    planDoseImage.SetOrigin(ijkToRasMatrix[0:3,3].tolist())
+    planDoseImage.SetSpacing(ijkSpacing.tolist())
+    try:
+      planDoseImage.SetDirection((ijkToRasDirections / ijkSpacing).ravel().tolist())
+    except RuntimeError as e:
+      logging.error("Invalid plan dose geometry: " + str(e))
+      return None
+
+    # Bounds of the voxel centers of the plan dose
+    dimensions = planDoseArray3D.shape[::-1]
+    cornerIjkPoints = numpy.array([[i, j, k, 1.0] for i in [0, dimensions[0]-1] for j in [0, dimensions[1]-1] for k in [0, dimensions[2]-1]])
+    cornerRasPoints = ijkToRasMatrix.dot(cornerIjkPoints.T)[0:3]
+    boundsMin = cornerRasPoints.min(axis=1)
+    boundsMax = cornerRasPoints.max(axis=1)
+    spacing = [float(ijkSpacing[numpy.argmax(numpy.abs(ijkToRasDirections[rasAxis,:]) / ijkSpacing)]) for rasAxis in range(3)]
+
+    planeRasAxes = self.getSlicePlaneRasAxes(orientation)
+    normalRasAxis = 3 - planeRasAxes[0] - planeRasAxes[1]
+    if slicePositionMm < boundsMin[normalRasAxis] - 0.5*spacing[normalRasAxis] or slicePositionMm > boundsMax[normalRasAxis] + 0.5*spacing[normalRasAxis]:
+      logging.error("Film slice position " + str(slicePositionMm) + " is outside the plan dose volume")
+      return None
+    origin = boundsMin.copy()
+    origin[normalRasAxis] = slicePositionMm
+    size = [1]*3
+    for rasAxis in planeRasAxes:
+      size[rasAxis] = int(math.floor((boundsMax[rasAxis] - boundsMin[rasAxis]) / spacing[rasAxis] + 1e-6)) + 1
+    referenceImage = sitk.Image(size, sitk.sitkUInt8)
+    referenceImage.SetOrigin(origin.tolist())
+    referenceImage.SetSpacing(spacing)
+
+    slicePixelType = sitk.sitkFloat64 if numpy.result_type(planDoseArray3D.dtype, numpy.float32) == numpy.float64 else sitk.sitkFloat32
+    sliceImage = sitk.Resample(planDoseImage, referenceImage, sitk.Transform(), sitk.sitkLinear, 0.0, slicePixelType)
+    return [sitk.GetArrayFromImage(sliceImage), origin.tolist(), spacing]
+
+  #------------------------------------------------------------------------------
+  def getInPlaneSliceArray2D(self, sliceArray3D, orientation):
+    # In-plane [row, column] view of an axis-aligned slice array (indexed as [k,j,i]), None if it is not a
+    # single slice in the film orientation
+    normalArrayAxis = 2 - (3 - sum(self.getSlicePlaneRasAxes(orientation)))
+    if sliceArray3D.shape[normalArrayAxis] != 1:
+      return None
+    return numpy.squeeze(sliceArray3D, axis=normalArrayAxis)
+
+  #------------------------------------------------------------------------------
+  def createPaddedOrientedSliceArray(self, sliceArray2D, numberOfSlices, orientation):
+    # Repeat a [row, column] slice along the normal of the slice orientation. Returns a contiguous [k,j,i] array.
+    # The repetition is a strided view, and the only copy is the contiguous array.
+    rows, columns = sliceArray2D.shape
+    if orientation == AXIAL:
+      paddedArray3D = numpy.broadcast_to(sliceArray2D[numpy.newaxis,:,:], (numberOfSlices, rows, columns))
+    elif orientation == CORONAL:
+      paddedArray3D = numpy.broadcast_to(sliceArray2D[:,numpy.newaxis,:], (rows, numberOfSlices, columns))
+    else: # SAGITTAL
+      paddedArray3D = numpy.broadcast_to(sliceArray2D[:,:,numpy.newaxis], (rows, columns, numberOfSlices))
+    return numpy.ascontiguousarray(paddedArray3D)
+
+  #------------------------------------------------------------------------------
+  def getOrientedSliceExtent(self, sliceShape, numberOfSlices, orientation, firstColumnIndex=0, firstRowIndex=0):
+    # Extent of a [row, column] slice repeated numberOfSlices times in the slice orientation
+    rows, columns = sliceShape
+    columnExtent = [firstColumnIndex, firstColumnIndex+columns-1]
+    rowExtent = [firstRowIndex, firstRowIndex+rows-1]
+    sliceExtent = [0, numberOfSlices-1]
+    if orientation == AXIAL:
+      return columnExtent + rowExtent + sliceExtent
+    elif orientation == CORONAL:
+      return columnExtent + sliceExtent + rowExtent
+    else: # SAGITTAL
+      return sliceExtent + columnExtent + rowExtent
+
+  #------------------------------------------------------------------------------
+  # In-plane registration
+
+  #------------------------------------------------------------------------------
+  def createInPlaneImage(self, sliceArray3D, ijkToRasMatrix, orientation, pixelType=numpy.float32):
+    # 2-D SimpleITK image of a single slice array (indexed as [k,j,i]) in the slice orientation. Physical coordinates
+    # are the in-plane RAS coordinates, so slices of the same orientation are in the same 2-D space.
+    # ijkToRasMatrix maps the array indices to RAS (including any transform of the slice)
+    planeRasAxes = self.getSlicePlaneRasAxes(orientation)
+    normalIjkAxis = 3 - planeRasAxes[0] - planeRasAxes[1]
+    sliceArray2D = numpy.squeeze(sliceArray3D, axis=2-normalIjkAxis)
+    image = sitk.GetImageFromArray(sliceArray2D.astype(pixelType))
+
+    ijkToRasMatrix = numpy.asarray(ijkToRasMatrix, dtype=numpy.float64)
+    spacing = [0.0, 0.0]
+    direction = [0.0]*4
+    for column in range(2):
+      axisVector = [ijkToRasMatrix[rasAxis, planeRasAxes[column]] for rasAxis in planeRasAxes]
+      spacing[column] = math.sqrt(axisVector[0]**2 + axisVector[1]**2)
+      for row in range(2):
+        direction[row*2+column] = axisVector[row] / spacing[column]
+    # Image origin is the RAS position of the first voxel
+    image.SetOrigin([ijkToRasMatrix[rasAxis, 3] for rasAxis in planeRasAxes])
+    image.SetSpacing(spacing)
+    image.SetDirection(direction)
+    return image
+
+  #------------------------------------------------------------------------------
+  def registerInPlane(self, fixedImage, movingImage, orientation):
+    # Rigid 2-D registration of the moving image (film) to the fixed image (plan dose slice) with SimpleITK: Mattes
+    # mutual information on a random sample of the fixed image pixels, regular step gradient descent starting with
+    # long-range translations, rotation suppressed. Returns the 4x4 moving to fixed transform matrix (RAS)
+    initialTransform = sitk.Euler2DTransform()
+    initialTransform.SetCenter(fixedImage.TransformContinuousIndexToPhysicalPoint([(size-1)/2.0 for size in fixedImage.GetSize()]))
+
+    registration = sitk.ImageRegistrationMethod()
+    registration.SetMetricAsMattesMutualInformation()
+    registration.SetMetricSamplingStrategy(registration.RANDOM)
+    registration.SetMetricSamplingPercentage(self.registrationSamplingPercentage, self.registrationSamplingSeed)
+    registration.SetInterpolator(sitk.sitkLinear)
+    registration.SetOptimizerAsRegularStepGradientDescent(self.registrationMaximumStepLength, self.registrationMinimumStepLength, self.registrationMaximumNumberOfIterations, self.registrationRelaxationFactor, self.registrationGradientMagnitudeTolerance)
+    registration.SetOptimizerScales([self.registrationRotationScale, 1.0, 1.0]) # Parameters are (angle, translation x, translation y)
+    registration.SetInitialTransform(initialTransform, inPlace=True)
+    registration.Execute(fixedImage, movingImage)
+    logging.info('In-plane registration finished after ' + str(registration.GetOptimizerIteration()) + ' iterations, metric value: ' + str(registration.GetMetricValue()) + ' (' + registration.GetOptimizerStopConditionDescription() + ')')
+
+    # Result maps fixed image points to moving image points, the moving image needs the inverse
+    planeRasAxes = self.getSlicePlaneRasAxes(orientation)
+    fixedToMovingMatrix = numpy.identity(4)
+    transformedOrigin = initialTransform.TransformPoint([0.0, 0.0])
+    for column in range(2):
+      unitVector = [0.0, 0.0]
+      unitVector[column] = 1.0
+      transformedUnitVector = initialTransform.TransformPoint(unitVector)
+      for row in range(2):
+        fixedToMovingMatrix[planeRasAxes[row], planeRasAxes[column]] = transformedUnitVector[row] - transformedOrigin[row]
+    for row in range(2):
+      fixedToMovingMatrix[planeRasAxes[row], 3] = transformedOrigin[row]
+    return numpy.linalg.inv(fixedToMovingMatrix)
+
+  #------------------------------------------------------------------------------
+  # Gamma evaluation grid
+
+  #------------------------------------------------------------------------------
+  def createGammaInputArrays(self, planDoseSliceImage, filmImage, refinementFactor=1, useLinearInterpolation=True):
+    # Reference and compare dose arrays on the evaluation grid, which is the plan dose slice grid refined by
+    # refinementFactor. The film is resampled on it, pixels not covered by the film are NaN in the compare dose.
+    # Returns [reference dose, compare dose, [row, column] spacing, image with the evaluation grid geometry]
+    evaluationGridImage = planDoseSliceImage
+    if evaluationGridImage.GetPixelID() != sitk.sitkFloat64:
+      evaluationGridImage = sitk.Cast(evaluationGridImage, sitk.sitkFloat64)
+    if refinementFactor > 1:
+      evaluationGridImage = sitk.Resample(evaluationGridImage, self.createGammaEvaluationGridReferenceImage(evaluationGridImage, refinementFactor), sitk.Transform(), sitk.sitkLinear, 0.0, sitk.sitkFloat64)
+    referenceDoseArray = sitk.GetArrayFromImage(evaluationGridImage)
+
+    compareInterpolator = sitk.sitkLinear if useLinearInterpolation else sitk.sitkNearestNeighbor
+    compareDoseImage = sitk.Resample(filmImage, evaluationGridImage, sitk.Transform(), compareInterpolator, float('nan'), sitk.sitkFloat64)
+    compareDoseArray = sitk.GetArrayFromImage(compareDoseImage)
+
+    # Only the geometry of the evaluation grid is kept (for rasterizing masks)
+    evaluationGridGeometryImage = sitk.Image(evaluationGridImage.GetSize(), sitk.sitkUInt8)
+    evaluationGridGeometryImage.CopyInformation(evaluationGridImage)
+    # Spacing of the [row, column] arrays is the reverse of the image spacing
+    return [referenceDoseArray, compareDoseArray, evaluationGridImage.GetSpacing()[::-1], evaluationGridGeometryImage]
+
+  #------------------------------------------------------------------------------
+  def createGammaEvaluationGridReferenceImage(self, planDoseSliceImage, refinementFactor):
+    # Empty image with the plan dose slice grid refined by refinementFactor, covering the same area
+    referenceImage = sitk.Image([size*refinementFactor for size in planDoseSliceImage.GetSize()], sitk.sitkUInt8)
+    referenceImage.SetSpacing([spacing/refinementFactor for spacing in planDoseSliceImage.GetSpacing()])
+    referenceImage.SetDirection(planDoseSliceImage.GetDirection())
+    firstPixelOffset = -(refinementFactor-1) / (2.0*refinementFactor)
+    referenceImage.SetOrigin(planDoseSliceImage.TransformContinuousIndexToPhysicalPoint([firstPixelOffset, firstPixelOffset]))
+    return referenceImage
+
+  #------------------------------------------------------------------------------
+  def getGammaEvaluationGridIjkToRasMatrix(self, planDoseSliceIjkToRasMatrix, orientation, refinementFactor):
+    # IJK to RAS matrix of the plan dose slice (for array indices) with the in-plane axes refined by refinementFactor
+    ijkToRasMatrix = numpy.array(planDoseSliceIjkToRasMatrix, dtype=numpy.float64)
+    planeRasAxes = self.getSlicePlaneRasAxes(orientation)
+    firstVoxelIjk = numpy.array([0.0, 0.0, 0.0, 1.0])
+    for ijkAxis in planeRasAxes:
+      firstVoxelIjk[ijkAxis] -= (refinementFactor-1) / (2.0*refinementFactor)
+    firstVoxelRas = ijkToRasMatrix.dot(firstVoxelIjk)
+    for ijkAxis in planeRasAxes:
+      ijkToRasMatrix[0:3, ijkAxis] /= refinementFactor
+    ijkToRasMatrix[0:3, 3] = firstVoxelRas[0:3]
+    return ijkToRasMatrix
+
+
+
+#
+# Constants
+#
+AXIAL = 'Axial'
+CORONAL = 'Coronal'
+SAGITTAL = 'Sagittal'
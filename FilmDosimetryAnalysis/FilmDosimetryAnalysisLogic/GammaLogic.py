@@ -0,0 +1,449 @@
+import logging
+import math
+import numpy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+#
+# GammaLogic
+#
+class GammaLogic:
+  """ Gamma dose comparison of two dose images sampled on the same 2-D grid.
+      Only uses NumPy, so it can be used without Slicer.
+  """
+
+  def __init__(self):
+    # Gamma parameters (same meaning as in the SlicerRT dose comparison module)
+    self.dtaDistanceToleranceMm = 3.0
+    self.doseDifferenceTolerancePercent = 3.0
+    self.referenceDoseGy = None # Dose that the tolerance and the threshold percentages refer to. Maximum reference dose is used if None
+    self.analysisThresholdPercent = 0.0 # Pixels with reference dose below this are not evaluated
+    self.maximumGamma = 2.0 # Upper bound of gamma, also determines the search radius (maximumGamma * DTA)
+    self.normalizationMode = GLOBAL_NORMALIZATION # Dose difference tolerance relative to referenceDoseGy (global) or the dose of each reference pixel (local)
+    self.hybridMinimumDosePercent = 10.0 # Hybrid normalization uses the local dose, but at least this percentage of referenceDoseGy
+
+    # Computation settings
+    self.numberOfThreads = None # Number of threads computing the tiles. Number of processors is used if None
+    self.tileSizePixels = 128 # Tiles are small enough for the reference, compare and result parts to stay in cache
+    self.useEarlyTermination = False # Stop the search for each pixel when no farther offset can lower its gamma or it passes (gamma <= 1)
+    self.searchOffsetGroupSize = 8 # Minimum number of offsets between checks for early termination
+
+    # Results of the last computation
+    self.gammaArray = None
+    self.evaluatedPixelMask = None
+    self.numberOfEvaluatedPixels = 0
+    self.numberOfPassingPixels = 0
+    self.passFractionPercent = None
+    self.report = ''
+    self.sweepGammaArrays = [] # Gamma arrays of the criteria of the last sweep
+
+    # Minimum gamma^2 map of the last computation, with the key of its inputs and the upper bound it was computed with
+    self.minimumGammaSquaredCacheArray = None
+    self.minimumGammaSquaredCacheKey = None
+    self.minimumGammaSquaredCacheMaximumGamma = None
+    self.minimumGammaSquaredCacheEvaluatedPixelMask = None
+
+  #------------------------------------------------------------------------------
+  def computeGamma(self, referenceDoseArray, compareDoseArray, pixelSpacingMm, maskArray=None, inputKey=None):
+    # Compute gamma for each reference pixel.
+    #   referenceDoseArray, compareDoseArray: 2-D dose arrays (Gy) on the same grid, indexed as [row, column].
+    #     Compare dose pixels that are NaN (e.g. outside the film) are not used.
+    #   pixelSpacingMm: [row spacing, column spacing]
+    #   maskArray: optional boolean array, only pixels inside the mask are evaluated
+    #   inputKey: optional key identifying the dose arrays. If it is the same as in the previous call, the gamma map
+    #     of that call is reused when only the analysis threshold, the mask or a lower maximum gamma is different
+    # Gamma of evaluated pixels is clamped to maximumGamma, other pixels are set to NOT_EVALUATED_GAMMA.
+    # Returns the gamma array (float32), pass fraction and report are stored in the members.
+    referenceDoseArray = numpy.asarray(referenceDoseArray, dtype=numpy.float64)
+    compareDoseArray = numpy.asarray(compareDoseArray, dtype=numpy.float64)
+    if referenceDoseArray.shape != compareDoseArray.shape:
+      raise ValueError('Reference and compare dose arrays must have the same shape')
+
+    referenceDoseGy = self.referenceDoseGy
+    if referenceDoseGy is None:
+      referenceDoseGy = float(referenceDoseArray.max())
+
+    self.evaluatedPixelMask = self.getEvaluatedPixelMask(referenceDoseArray, compareDoseArray, referenceDoseGy, maskArray)
+
+    minimumGammaSquaredArray = self.getMinimumGammaSquared(referenceDoseArray, compareDoseArray, pixelSpacingMm, referenceDoseGy, self.evaluatedPixelMask, inputKey)
+
+    self.gammaArray = numpy.empty(referenceDoseArray.shape, dtype=numpy.float32)
+    self.gammaArray.fill(NOT_EVALUATED_GAMMA)
+    self.gammaArray[self.evaluatedPixelMask] = numpy.sqrt(minimumGammaSquaredArray[self.evaluatedPixelMask])
+
+    self.numberOfEvaluatedPixels = int(numpy.count_nonzero(self.evaluatedPixelMask))
+    self.numberOfPassingPixels = int(numpy.count_nonzero(self.gammaArray[self.evaluatedPixelMask] <= 1.0))
+    if self.numberOfEvaluatedPixels > 0:
+      self.passFractionPercent = 100.0 * self.numberOfPassingPixels / self.numberOfEvaluatedPixels
+    else:
+      self.passFractionPercent = None
+      logging.warning('No pixels to evaluate gamma for (check analysis threshold and mask)')
+    self.report = self.createReport(referenceDoseGy, pixelSpacingMm)
+
+    return self.gammaArray
+
+  #------------------------------------------------------------------------------
+  def getMinimumGammaSquared(self, referenceDoseArray, compareDoseArray, pixelSpacingMm, referenceDoseGy, evaluatedPixelMask, inputKey=None):
+    # Minimum gamma^2 bounded by maximumGamma^2 for the evaluated pixels. The result is cached with the inputs, the
+    # evaluated pixels and the bound it was computed with. It is reused if no other pixels need to be evaluated.
+    # Values below a bound do not depend on it (offsets farther than bound*DTA cannot give lower gamma), so a cached
+    # map computed with a higher bound gives exactly the same result after clipping to the current bound.
+    cacheKey = [inputKey, self.dtaDistanceToleranceMm, self.doseDifferenceTolerancePercent, referenceDoseGy, self.normalizationMode, self.hybridMinimumDosePercent,
+      list(pixelSpacingMm), referenceDoseArray.shape, self.useEarlyTermination]
+    maximumGammaSquared = self.maximumGamma * self.maximumGamma
+    # With early termination, gamma of passing pixels depends on the bound, so the map is reused only with the same bound
+    if inputKey is not None and self.minimumGammaSquaredCacheKey == cacheKey and (self.minimumGammaSquaredCacheMaximumGamma == self.maximumGamma
+        or (not self.useEarlyTermination and self.minimumGammaSquaredCacheMaximumGamma > self.maximumGamma)) \
+        and not numpy.any(evaluatedPixelMask & ~self.minimumGammaSquaredCacheEvaluatedPixelMask):
+      logging.info('Gamma map reused, only the analysis threshold, the mask or the upper bound for gamma changed')
+      if self.minimumGammaSquaredCacheMaximumGamma == self.maximumGamma:
+        return self.minimumGammaSquaredCacheArray
+      return numpy.minimum(self.minimumGammaSquaredCacheArray, maximumGammaSquared)
+
+    doseDifferenceToleranceGy = self.getDoseDifferenceToleranceGy(referenceDoseArray, referenceDoseGy, self.doseDifferenceTolerancePercent, self.normalizationMode)
+    minimumGammaSquaredArray = self.computeMinimumGammaSquared(referenceDoseArray, compareDoseArray, pixelSpacingMm, [[self.dtaDistanceToleranceMm, doseDifferenceToleranceGy]], evaluatedPixelMask)[0]
+    if inputKey is not None:
+      self.minimumGammaSquaredCacheArray = minimumGammaSquaredArray
+      self.minimumGammaSquaredCacheKey = cacheKey
+      self.minimumGammaSquaredCacheMaximumGamma = self.maximumGamma
+      self.minimumGammaSquaredCacheEvaluatedPixelMask = evaluatedPixelMask
+    else:
+      self.clearCache()
+    return minimumGammaSquaredArray
+
+  #------------------------------------------------------------------------------
+  def clearCache(self):
+    self.minimumGammaSquaredCacheArray = None
+    self.minimumGammaSquaredCacheKey = None
+    self.minimumGammaSquaredCacheMaximumGamma = None
+    self.minimumGammaSquaredCacheEvaluatedPixelMask = None
+
+  #------------------------------------------------------------------------------
+  def computeGammaSweep(self, referenceDoseArray, compareDoseArray, pixelSpacingMm, criteria, maskArray=None):
+    # Compute gamma for several [DTA (mm), dose difference (%), analysis threshold (%)] criteria in one pass.
+    # A criterion may have a normalization mode as fourth element (normalizationMode is used otherwise), so that
+    # for example global and local gamma are computed together.
+    # Search offsets and dose differences are computed once for all criteria, and criteria differing only in the
+    # threshold share the gamma map. Other parameters and the arrays are the same as in computeGamma.
+    # Returns a table with a row [DTA, dose difference, threshold, normalization mode, evaluated pixels, passing pixels,
+    # pass fraction (%)] for each criterion. Gamma arrays of the rows are stored in sweepGammaArrays.
+    referenceDoseArray = numpy.asarray(referenceDoseArray, dtype=numpy.float64)
+    compareDoseArray = numpy.asarray(compareDoseArray, dtype=numpy.float64)
+    if referenceDoseArray.shape != compareDoseArray.shape:
+      raise ValueError('Reference and compare dose arrays must have the same shape')
+
+    referenceDoseGy = self.referenceDoseGy
+    if referenceDoseGy is None:
+      referenceDoseGy = float(referenceDoseArray.max())
+
+    criteria = [list(criterion[:3]) + [criterion[3] if len(criterion) > 3 else self.normalizationMode] for criterion in criteria]
+    gammaMapCriteria = []
+    for [dtaDistanceToleranceMm, doseDifferenceTolerancePercent, analysisThresholdPercent, normalizationMode] in criteria:
+      if [dtaDistanceToleranceMm, doseDifferenceTolerancePercent, normalizationMode] not in gammaMapCriteria:
+        gammaMapCriteria.append([dtaDistanceToleranceMm, doseDifferenceTolerancePercent, normalizationMode])
+    # Gamma maps are computed for the pixels evaluated by any of the criteria
+    originalParameters = [self.analysisThresholdPercent, self.normalizationMode]
+    evaluatedPixelMasks = []
+    for [dtaDistanceToleranceMm, doseDifferenceTolerancePercent, analysisThresholdPercent, normalizationMode] in criteria:
+      self.analysisThresholdPercent = analysisThresholdPercent
+      self.normalizationMode = normalizationMode
+      evaluatedPixelMasks.append(self.getEvaluatedPixelMask(referenceDoseArray, compareDoseArray, referenceDoseGy, maskArray))
+    [self.analysisThresholdPercent, self.normalizationMode] = originalParameters
+    minimumGammaSquaredArrays = self.computeMinimumGammaSquared(referenceDoseArray, compareDoseArray, pixelSpacingMm,
+      [[dtaDistanceToleranceMm, self.getDoseDifferenceToleranceGy(referenceDoseArray, referenceDoseGy, doseDifferenceTolerancePercent, normalizationMode)]
+      for [dtaDistanceToleranceMm, doseDifferenceTolerancePercent, normalizationMode] in gammaMapCriteria], numpy.logical_or.reduce(evaluatedPixelMasks))
+
+    table = []
+    self.sweepGammaArrays = []
+    for [dtaDistanceToleranceMm, doseDifferenceTolerancePercent, analysisThresholdPercent, normalizationMode], evaluatedPixelMask in zip(criteria, evaluatedPixelMasks):
+      minimumGammaSquaredArray = minimumGammaSquaredArrays[gammaMapCriteria.index([dtaDistanceToleranceMm, doseDifferenceTolerancePercent, normalizationMode])]
+      gammaArray = numpy.empty(referenceDoseArray.shape, dtype=numpy.float32)
+      gammaArray.fill(NOT_EVALUATED_GAMMA)
+      gammaArray[evaluatedPixelMask] = numpy.sqrt(minimumGammaSquaredArray[evaluatedPixelMask])
+      self.sweepGammaArrays.append(gammaArray)
+
+      numberOfEvaluatedPixels = int(numpy.count_nonzero(evaluatedPixelMask))
+      numberOfPassingPixels = int(numpy.count_nonzero(gammaArray[evaluatedPixelMask] <= 1.0))
+      passFractionPercent = None
+      if numberOfEvaluatedPixels > 0:
+        passFractionPercent = 100.0 * numberOfPassingPixels / numberOfEvaluatedPixels
+      table.append([dtaDistanceToleranceMm, doseDifferenceTolerancePercent, analysisThresholdPercent, normalizationMode, numberOfEvaluatedPixels, numberOfPassingPixels, passFractionPercent])
+
+    return table
+
+  #------------------------------------------------------------------------------
+  def getEvaluatedPixelMask(self, referenceDoseArray, compareDoseArray, referenceDoseGy, maskArray=None):
+    # Pixels above the analysis threshold (on the reference dose only), covered by the compare dose and inside the mask.
+    # Local gamma is not defined where the reference dose is zero
+    analysisThresholdGy = referenceDoseGy * self.analysisThresholdPercent / 100.0
+    evaluatedPixelMask = referenceDoseArray >= analysisThresholdGy
+    if self.normalizationMode == LOCAL_NORMALIZATION:
+      evaluatedPixelMask &= referenceDoseArray > 0
+    evaluatedPixelMask &= ~numpy.isnan(compareDoseArray)
+    if maskArray is not None:
+      evaluatedPixelMask &= numpy.asarray(maskArray, dtype=bool)
+    return evaluatedPixelMask
+
+  #------------------------------------------------------------------------------
+  def getDoseDifferenceToleranceGy(self, referenceDoseArray, referenceDoseGy, doseDifferenceTolerancePercent, normalizationMode):
+    # Dose difference tolerance of the normalization mode: a single value for global normalization, an array
+    # (one value for each reference pixel) for local and hybrid normalization
+    if normalizationMode == GLOBAL_NORMALIZATION:
+      return referenceDoseGy * doseDifferenceTolerancePercent / 100.0
+    elif normalizationMode == LOCAL_NORMALIZATION:
+      return referenceDoseArray * (doseDifferenceTolerancePercent / 100.0)
+    elif normalizationMode == HYBRID_NORMALIZATION:
+      return numpy.maximum(referenceDoseArray, referenceDoseGy * self.hybridMinimumDosePercent / 100.0) * (doseDifferenceTolerancePercent / 100.0)
+    raise ValueError('Invalid gamma normalization mode: ' + str(normalizationMode))
+
+  #------------------------------------------------------------------------------
+  def computeMinimumGammaSquared(self, referenceDoseArray, compareDoseArray, pixelSpacingMm, criteria, evaluatedPixelMask=None):
+    # Minimum of (distance/DTA)^2 + (dose difference/DD)^2 over the search offsets for each reference pixel,
+    # for each [DTA (mm), dose difference tolerance (Gy)] criterion. Returns one array per criterion.
+    # The tolerance is a single value (global normalization) or an array of the reference dose shape (local normalization),
+    # the same kernel is used for both.
+    # The grid is split into tiles that are processed in parallel. Each tile reads the compare dose
+    # from its halo (the search radius around the tile) and writes only its own part of the results,
+    # so the results do not depend on the number of threads.
+    # If evaluatedPixelMask is given, only the tiles of its bounding box that contain evaluated pixels are computed
+    # (other pixels keep the upper bound). The halo of the tiles may extend beyond the bounding box, as the compare
+    # dose is read from the full arrays (no cropped copies are made).
+    maximumDtaDistanceToleranceMm = max([dtaDistanceToleranceMm for [dtaDistanceToleranceMm, doseDifferenceToleranceGy] in criteria])
+    searchOffsets, searchDistancesSquaredMm2 = self.getSearchOffsets(pixelSpacingMm, self.maximumGamma * maximumDtaDistanceToleranceMm)
+
+    # Offsets are sorted by distance, so each criterion uses the offsets up to its own search radius
+    tileCriteria = []
+    minimumGammaSquaredArrays = []
+    for [dtaDistanceToleranceMm, doseDifferenceToleranceGy] in criteria:
+      searchRadiusSquaredMm2 = (self.maximumGamma * dtaDistanceToleranceMm)**2
+      numberOfSearchOffsets = max(1, int(numpy.searchsorted(searchDistancesSquaredMm2, searchRadiusSquaredMm2, side='left')))
+      tileCriteria.append([numberOfSearchOffsets, 1.0 / (dtaDistanceToleranceMm * dtaDistanceToleranceMm), self.getInverseSquare(doseDifferenceToleranceGy)])
+      minimumGammaSquaredArray = numpy.empty(referenceDoseArray.shape, dtype=numpy.float64)
+      minimumGammaSquaredArray.fill(self.maximumGamma * self.maximumGamma)
+      minimumGammaSquaredArrays.append(minimumGammaSquaredArray)
+
+    if self.useEarlyTermination and len(criteria) == 1:
+      # Compare dose padded by the search radius with NaN (which is skipped), so that shifted pixels need no bounds checks
+      searchRadiusPixels = numpy.abs(numpy.array(searchOffsets)).max(axis=0)
+      paddedCompareDoseArray = numpy.empty((compareDoseArray.shape[0] + 2*searchRadiusPixels[0], compareDoseArray.shape[1] + 2*searchRadiusPixels[1]), dtype=numpy.float64)
+      paddedCompareDoseArray.fill(numpy.nan)
+      paddedCompareDoseArray[searchRadiusPixels[0]:searchRadiusPixels[0]+compareDoseArray.shape[0], searchRadiusPixels[1]:searchRadiusPixels[1]+compareDoseArray.shape[1]] = compareDoseArray
+      [numberOfSearchOffsets, inverseDtaSquared, inverseDoseDifferenceToleranceSquared] = tileCriteria[0]
+      def computeTile(tile):
+        self.computeMinimumGammaSquaredInTileWithEarlyTermination(referenceDoseArray, paddedCompareDoseArray, searchRadiusPixels, tile,
+          searchOffsets[:numberOfSearchOffsets], searchDistancesSquaredMm2[:numberOfSearchOffsets], inverseDtaSquared, inverseDoseDifferenceToleranceSquared,
+          minimumGammaSquaredArrays[0], evaluatedPixelMask)
+    else:
+      def computeTile(tile):
+        self.computeMinimumGammaSquaredInTile(referenceDoseArray, compareDoseArray, tile, searchOffsets, searchDistancesSquaredMm2,
+          tileCriteria, minimumGammaSquaredArrays)
+
+    tiles = self.getTiles(referenceDoseArray.shape, evaluatedPixelMask)
+    numberOfThreads = min(self.getNumberOfThreads(), len(tiles))
+    if numberOfThreads > 1:
+      # NumPy releases the GIL in the element-wise operations, so the tiles are computed concurrently
+      pool = ThreadPool(numberOfThreads)
+      try:
+        pool.map(computeTile, tiles, chunksize=1)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      for tile in tiles:
+        computeTile(tile)
+
+    return minimumGammaSquaredArrays
+
+  #------------------------------------------------------------------------------
+  def getInverseSquare(self, doseDifferenceToleranceGy):
+    # 1/tolerance^2 for a single tolerance value or an array. Zero tolerance (zero local dose) gives 0,
+    # those pixels are not evaluated
+    if numpy.ndim(doseDifferenceToleranceGy) == 0:
+      return 1.0 / (doseDifferenceToleranceGy * doseDifferenceToleranceGy)
+    inverseSquare = numpy.zeros(doseDifferenceToleranceGy.shape, dtype=numpy.float64)
+    numpy.divide(1.0, numpy.square(doseDifferenceToleranceGy), out=inverseSquare, where=doseDifferenceToleranceGy != 0)
+    return inverseSquare
+
+  #------------------------------------------------------------------------------
+  def computeMinimumGammaSquaredInTile(self, referenceDoseArray, compareDoseArray, tile, searchOffsets, searchDistancesSquaredMm2,
+      tileCriteria, minimumGammaSquaredArrays):
+    # Each offset is one whole-tile operation on the reference pixels of the tile whose shifted position is
+    # inside the compare array. The squared dose difference of an offset is computed once and shared by the
+    # criteria ([number of search offsets, 1/DTA^2, 1/DD^2] each). The results are bounded by maximumGamma^2,
+    # so only offsets closer than maximumGamma*DTA can lower them.
+    [firstRow, endRow, firstColumn, endColumn] = tile
+    numberOfRows, numberOfColumns = referenceDoseArray.shape
+    doseDifferenceSquaredBuffer = numpy.empty((endRow-firstRow, endColumn-firstColumn), dtype=numpy.float64)
+    gammaSquaredBuffer = numpy.empty((endRow-firstRow, endColumn-firstColumn), dtype=numpy.float64)
+    numberOfSearchOffsets = max([tileCriterion[0] for tileCriterion in tileCriteria])
+
+    for offsetIndex in range(numberOfSearchOffsets):
+      [rowOffset, columnOffset] = searchOffsets[offsetIndex]
+      referenceFirstRow = max(firstRow, -rowOffset)
+      referenceEndRow = min(endRow, numberOfRows - rowOffset)
+      referenceFirstColumn = max(firstColumn, -columnOffset)
+      referenceEndColumn = min(endColumn, numberOfColumns - columnOffset)
+      if referenceFirstRow >= referenceEndRow or referenceFirstColumn >= referenceEndColumn:
+        continue
+      referenceRows = slice(referenceFirstRow, referenceEndRow)
+      referenceColumns = slice(referenceFirstColumn, referenceEndColumn)
+      compareRows = slice(referenceFirstRow + rowOffset, referenceEndRow + rowOffset)
+      compareColumns = slice(referenceFirstColumn + columnOffset, referenceEndColumn + columnOffset)
+      doseDifferenceSquared = doseDifferenceSquaredBuffer[:referenceEndRow-referenceFirstRow, :referenceEndColumn-referenceFirstColumn]
+      gammaSquared = gammaSquaredBuffer[:referenceEndRow-referenceFirstRow, :referenceEndColumn-referenceFirstColumn]
+
+      numpy.subtract(compareDoseArray[compareRows, compareColumns], referenceDoseArray[referenceRows, referenceColumns], out=doseDifferenceSquared)
+      numpy.multiply(doseDifferenceSquared, doseDifferenceSquared, out=doseDifferenceSquared)
+      for [criterionNumberOfSearchOffsets, inverseDtaSquared, inverseDoseDifferenceToleranceSquared], minimumGammaSquaredArray in zip(tileCriteria, minimumGammaSquaredArrays):
+        if offsetIndex >= criterionNumberOfSearchOffsets:
+          continue
+        minimumGammaSquared = minimumGammaSquaredArray[referenceRows, referenceColumns]
+        if isinstance(inverseDoseDifferenceToleranceSquared, numpy.ndarray):
+          numpy.multiply(doseDifferenceSquared, inverseDoseDifferenceToleranceSquared[referenceRows, referenceColumns], out=gammaSquared)
+        else:
+          numpy.multiply(doseDifferenceSquared, inverseDoseDifferenceToleranceSquared, out=gammaSquared)
+        gammaSquared += searchDistancesSquaredMm2[offsetIndex] * inverseDtaSquared
+        # fmin ignores NaN, so compare pixels outside the compare dose are skipped
+        numpy.fmin(minimumGammaSquared, gammaSquared, out=minimumGammaSquared)
+
+  #------------------------------------------------------------------------------
+  def computeMinimumGammaSquaredInTileWithEarlyTermination(self, referenceDoseArray, paddedCompareDoseArray, searchRadiusPixels, tile,
+      searchOffsets, searchDistancesSquaredMm2, inverseDtaSquared, inverseDoseDifferenceToleranceSquared, minimumGammaSquaredArray, evaluatedPixelMask=None):
+    # Offsets are visited in groups in order of increasing distance. Before each group, pixels are dropped if the distance
+    # term of the group alone is not lower than their current gamma^2 (no further offset can lower it), or if they
+    # already pass (gamma <= 1). Only the remaining pixels are gathered from the padded compare dose for the next offsets.
+    # Gamma of failing pixels is the same as without early termination, passing pixels get a gamma that is at most 1.
+    # Only the evaluated pixels are searched if evaluatedPixelMask is given.
+    [firstRow, endRow, firstColumn, endColumn] = tile
+    paddedNumberOfColumns = paddedCompareDoseArray.shape[1]
+    flatPaddedCompareDoseArray = paddedCompareDoseArray.ravel()
+    rows, columns = numpy.mgrid[firstRow:endRow, firstColumn:endColumn]
+    activePaddedIndices = ((rows + searchRadiusPixels[0]) * paddedNumberOfColumns + columns + searchRadiusPixels[1]).ravel()
+    activeTileIndices = numpy.arange(activePaddedIndices.size)
+    activeReferenceDoses = referenceDoseArray[firstRow:endRow, firstColumn:endColumn].ravel()
+    activeInverseDoseDifferenceToleranceSquared = inverseDoseDifferenceToleranceSquared
+    if isinstance(inverseDoseDifferenceToleranceSquared, numpy.ndarray):
+      activeInverseDoseDifferenceToleranceSquared = inverseDoseDifferenceToleranceSquared[firstRow:endRow, firstColumn:endColumn].ravel()
+    tileMinimumGammaSquared = minimumGammaSquaredArray[firstRow:endRow, firstColumn:endColumn].ravel()
+    if evaluatedPixelMask is not None:
+      tileEvaluatedPixels = evaluatedPixelMask[firstRow:endRow, firstColumn:endColumn].ravel()
+      activeTileIndices = activeTileIndices[tileEvaluatedPixels]
+      activePaddedIndices = activePaddedIndices[tileEvaluatedPixels]
+      activeReferenceDoses = activeReferenceDoses[tileEvaluatedPixels]
+      if isinstance(activeInverseDoseDifferenceToleranceSquared, numpy.ndarray):
+        activeInverseDoseDifferenceToleranceSquared = activeInverseDoseDifferenceToleranceSquared[tileEvaluatedPixels]
+    activeMinimumGammaSquared = tileMinimumGammaSquared[activeTileIndices]
+    gammaSquaredBuffer = numpy.empty(activeTileIndices.size, dtype=numpy.float64)
+
+    for [firstOffsetIndex, endOffsetIndex] in self.getSearchOffsetGroups(searchDistancesSquaredMm2):
+      activePixels = activeMinimumGammaSquared > max(searchDistancesSquaredMm2[firstOffsetIndex] * inverseDtaSquared, 1.0)
+      if not activePixels.all():
+        finishedPixels = ~activePixels
+        tileMinimumGammaSquared[activeTileIndices[finishedPixels]] = activeMinimumGammaSquared[finishedPixels]
+        activeTileIndices = activeTileIndices[activePixels]
+        if activeTileIndices.size == 0:
+          break
+        activePaddedIndices = activePaddedIndices[activePixels]
+        activeReferenceDoses = activeReferenceDoses[activePixels]
+        if isinstance(activeInverseDoseDifferenceToleranceSquared, numpy.ndarray):
+          activeInverseDoseDifferenceToleranceSquared = activeInverseDoseDifferenceToleranceSquared[activePixels]
+        activeMinimumGammaSquared = activeMinimumGammaSquared[activePixels]
+      gammaSquared = gammaSquaredBuffer[:activeTileIndices.size]
+
+      for offsetIndex in range(firstOffsetIndex, endOffsetIndex):
+        [rowOffset, columnOffset] = searchOffsets[offsetIndex]
+        numpy.take(flatPaddedCompareDoseArray, activePaddedIndices + (rowOffset * paddedNumberOfColumns + columnOffset), out=gammaSquared, mode='clip')
+        gammaSquared -= activeReferenceDoses
+        numpy.multiply(gammaSquared, gammaSquared, out=gammaSquared)
+        gammaSquared *= activeInverseDoseDifferenceToleranceSquared
+        gammaSquared += searchDistancesSquaredMm2[offsetIndex] * inverseDtaSquared
+        numpy.fmin(activeMinimumGammaSquared, gammaSquared, out=activeMinimumGammaSquared)
+    else:
+      tileMinimumGammaSquared[activeTileIndices] = activeMinimumGammaSquared
+
+    minimumGammaSquaredArray[firstRow:endRow, firstColumn:endColumn] = tileMinimumGammaSquared.reshape(endRow-firstRow, endColumn-firstColumn)
+
+  #------------------------------------------------------------------------------
+  def getSearchOffsetGroups(self, searchDistancesSquaredMm2):
+    # Split the offsets sorted by distance into [first, end) index ranges of at least searchOffsetGroupSize offsets.
+    # Groups end at a change of distance, so offsets of the same distance are in the same group
+    groups = []
+    firstOffsetIndex = 0
+    for offsetIndex in range(1, len(searchDistancesSquaredMm2)):
+      if offsetIndex - firstOffsetIndex >= self.searchOffsetGroupSize and searchDistancesSquaredMm2[offsetIndex] != searchDistancesSquaredMm2[offsetIndex-1]:
+        groups.append([firstOffsetIndex, offsetIndex])
+        firstOffsetIndex = offsetIndex
+    groups.append([firstOffsetIndex, len(searchDistancesSquaredMm2)])
+    return groups
+
+  #------------------------------------------------------------------------------
+  def getTiles(self, shape, evaluatedPixelMask=None):
+    # Split the grid into tiles of at most tileSizePixels x tileSizePixels. Returns [firstRow, endRow, firstColumn, endColumn] for each tile.
+    # If evaluatedPixelMask is given, only its bounding box is split and tiles without evaluated pixels are left out
+    [firstRegionRow, endRegionRow, firstRegionColumn, endRegionColumn] = [0, shape[0], 0, shape[1]]
+    if evaluatedPixelMask is not None:
+      evaluatedRows = numpy.flatnonzero(evaluatedPixelMask.any(axis=1))
+      evaluatedColumns = numpy.flatnonzero(evaluatedPixelMask.any(axis=0))
+      if evaluatedRows.size == 0:
+        return []
+      [firstRegionRow, endRegionRow, firstRegionColumn, endRegionColumn] = [evaluatedRows[0], evaluatedRows[-1]+1, evaluatedColumns[0], evaluatedColumns[-1]+1]
+
+    tiles = []
+    for firstRow in range(firstRegionRow, endRegionRow, self.tileSizePixels):
+      for firstColumn in range(firstRegionColumn, endRegionColumn, self.tileSizePixels):
+        tile = [firstRow, min(firstRow + self.tileSizePixels, endRegionRow), firstColumn, min(firstColumn + self.tileSizePixels, endRegionColumn)]
+        if evaluatedPixelMask is None or evaluatedPixelMask[tile[0]:tile[1], tile[2]:tile[3]].any():
+          tiles.append(tile)
+    return tiles
+
+  #------------------------------------------------------------------------------
+  def getNumberOfThreads(self):
+    if self.numberOfThreads is None:
+      return multiprocessing.cpu_count()
+    return max(1, self.numberOfThreads)
+
+  #------------------------------------------------------------------------------
+  def getSearchOffsets(self, pixelSpacingMm, searchRadiusMm):
+    # Pixel offsets [row, column] within the search radius and their squared distances (mm^2), sorted by increasing distance
+    maximumRowOffset = int(math.floor(searchRadiusMm / pixelSpacingMm[0]))
+    maximumColumnOffset = int(math.floor(searchRadiusMm / pixelSpacingMm[1]))
+    rowOffsets, columnOffsets = numpy.mgrid[-maximumRowOffset:maximumRowOffset+1, -maximumColumnOffset:maximumColumnOffset+1]
+    rowOffsets = rowOffsets.ravel()
+    columnOffsets = columnOffsets.ravel()
+    distancesSquaredMm2 = (rowOffsets * pixelSpacingMm[0])**2 + (columnOffsets * pixelSpacingMm[1])**2
+
+    # Offsets at or beyond the search radius cannot give gamma below the upper bound
+    inSearchDisc = distancesSquaredMm2 < searchRadiusMm * searchRadiusMm
+    inSearchDisc[distancesSquaredMm2 == 0] = True
+    order = numpy.argsort(distancesSquaredMm2[inSearchDisc], kind='mergesort')
+    searchOffsets = numpy.column_stack([rowOffsets[inSearchDisc][order], columnOffsets[inSearchDisc][order]]).tolist()
+    return searchOffsets, distancesSquaredMm2[inSearchDisc][order].tolist()
+
+  #------------------------------------------------------------------------------
+  def createReport(self, referenceDoseGy, pixelSpacingMm):
+    report = 'Gamma dose comparison\n'
+    report += 'Distance-to-agreement criterion: ' + str(self.dtaDistanceToleranceMm) + ' mm\n'
+    if self.normalizationMode == GLOBAL_NORMALIZATION:
+      report += 'Dose difference criterion: ' + str(self.doseDifferenceTolerancePercent) + '% of ' + '{0:.4f}'.format(referenceDoseGy) + ' Gy (global)\n'
+    elif self.normalizationMode == LOCAL_NORMALIZATION:
+      report += 'Dose difference criterion: ' + str(self.doseDifferenceTolerancePercent) + '% of the local dose\n'
+    else:
+      report += 'Dose difference criterion: ' + str(self.doseDifferenceTolerancePercent) + '% of the local dose, but at least of ' + '{0:.4f}'.format(referenceDoseGy * self.hybridMinimumDosePercent / 100.0) + ' Gy (hybrid)\n'
+    report += 'Analysis threshold: ' + str(self.analysisThresholdPercent) + '%\n'
+    report += 'Upper bound for gamma: ' + str(self.maximumGamma) + '\n'
+    report += 'Pixel spacing: ' + '{0:.3f} x {1:.3f}'.format(pixelSpacingMm[0], pixelSpacingMm[1]) + ' mm\n'
+    report += 'Number of evaluated pixels: ' + str(self.numberOfEvaluatedPixels) + '\n'
+    report += 'Number of passing pixels: ' + str(self.numberOfPassingPixels) + '\n'
+    if self.passFractionPercent is not None:
+      report += 'Pass fraction: ' + '{0:.2f}'.format(self.passFractionPercent) + '%\n'
+    return report
+
+
+
+#
+# Constants
+#
+GLOBAL_NORMALIZATION = 'Global'
+LOCAL_NORMALIZATION = 'Local'
+HYBRID_NORMALIZATION = 'Hybrid'
+NOT_EVALUATED_GAMMA = -1.0 # Gamma of the pixels that are not evaluated (below the analysis threshold, outside the mask or the film), distinct from any gamma value
@@ -1,4 +1,6 @@
 from __main__ import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
+import numpy
 import math
 
 #
@@ -14,43 +16,191 @@ class LineProfileLogic:
 
   def __init__(self):
     self.chartNodeID = None
+    self.reuseProfileBuffer = False # Profiles are returned in a buffer that is overwritten by the next computation (for live updates)
+    self.profileBuffer = None
+    self.profileMetricNames = ['Maximum', 'Left field edge (mm)', 'Right field edge (mm)', 'Field width (FWHM, mm)', 'Field center (mm)',
+      'Left penumbra 80/20 (mm)', 'Right penumbra 80/20 (mm)', 'Flatness (%)', 'Symmetry (%)']
 
-  def run(self,inputVolume,inputRuler,outputArray,numberOfLineSamples=100):
+  def run(self,inputVolume,inputRuler,outputArray,numberOfLineSamples=100,sampleMask=None):
     """
     Run the actual algorithm
     """
 
-    self.updateOutputArray(inputVolume,inputRuler,outputArray,numberOfLineSamples)
+    self.updateOutputArray(inputVolume,inputRuler,outputArray,numberOfLineSamples,sampleMask)
     name = inputVolume.GetName()
     self.updateChart(outputArray,name)
 
     return True
 
-  def updateOutputArray(self,inputVolume,inputRuler,outputArray,numberOfLineSamples):
-    rulerStartPoint_Ruler = [0,0,0]
-    rulerEndPoint_Ruler = [0,0,0]
-    inputRuler.GetPosition1(rulerStartPoint_Ruler)
-    inputRuler.GetPosition2(rulerEndPoint_Ruler)
-    rulerStartPoint_Ruler1 = [rulerStartPoint_Ruler[0], rulerStartPoint_Ruler[1], rulerStartPoint_Ruler[2], 1.0]
-    rulerEndPoint_Ruler1 = [rulerEndPoint_Ruler[0], rulerEndPoint_Ruler[1], rulerEndPoint_Ruler[2], 1.0]
-    
-    rulerToRAS = vtk.vtkMatrix4x4()
-    rulerTransformNode = inputRuler.GetParentTransformNode()
-    if rulerTransformNode:
-      if rulerTransformNode.IsTransformToWorldLinear():
-        rulerToRAS.DeepCopy(rulerTransformNode.GetMatrixTransformToParent())
-      else:
-        print("Cannot handle non-linear transforms - ignoring transform of the input ruler")
+  def updateOutputArray(self,inputVolume,inputRuler,outputArray,numberOfLineSamples,sampleMask=None):
+    # Samples for which sampleMask is False (outside the mask structure) are left out of the profile
+    [sampleDistancesMm, profiles] = self.computeProfiles([inputRuler],[inputVolume],numberOfLineSamples,[sampleMask])
+    self.writeProfileToOutputArray(outputArray,sampleDistancesMm[0],profiles[0,0])
 
-    rulerStartPoint_RAS1 = [0,0,0,1]
-    rulerEndPoint_RAS1 = [0,0,0,1]
-    rulerToRAS.MultiplyPoint(rulerStartPoint_Ruler1,rulerStartPoint_RAS1)
-    rulerToRAS.MultiplyPoint(rulerEndPoint_Ruler1,rulerEndPoint_RAS1)        
-    
-    rulerLengthMm = math.sqrt(vtk.vtkMath.Distance2BetweenPoints(rulerStartPoint_RAS1[0:3],rulerEndPoint_RAS1[0:3]))
+  def computeProfiles(self,lines,volumes,numberOfLineSamples,sampleMasks=None,outputArrays=None,notEvaluatedValueVolumes=None):
+    # Profiles of several volumes along several lines. Lines are annotation rulers or [start point, end point] pairs of
+    # RAS coordinates. The sample points are computed once per line, and all lines are sampled in one vectorized pass
+    # per volume. Samples for which the sample mask of the line (if any) is False are NaN.
+    # In the volumes in notEvaluatedValueVolumes (gamma) negative voxels are not evaluated, samples interpolated from them are NaN.
+    # Returns [sample distances in mm (lines x samples), profiles (lines x volumes x samples)].
+    # If outputArrays (double array nodes indexed as [line][volume], None to skip) is given, the profiles are written
+    # into the arrays and shown in the chart
+    linePoints_RAS1 = numpy.ones((len(lines), 2, 4))
+    for lineIndex, line in enumerate(lines):
+      if hasattr(line, 'GetPosition1'):
+        line = self.getRulerEndPointsRas(line)
+      linePoints_RAS1[lineIndex,0,0:3] = line[0][0:3]
+      linePoints_RAS1[lineIndex,1,0:3] = line[1][0:3]
+
+    lineFractions = numpy.linspace(0.0, 1.0, numberOfLineSamples)
+    samplePoints_RAS1 = linePoints_RAS1[:,0:1,:] + lineFractions[numpy.newaxis,:,numpy.newaxis] * (linePoints_RAS1[:,1:2,:] - linePoints_RAS1[:,0:1,:])
+    lineLengthsMm = numpy.sqrt(numpy.square(linePoints_RAS1[:,1,0:3] - linePoints_RAS1[:,0,0:3]).sum(axis=1))
+    sampleDistancesMm = lineLengthsMm[:,numpy.newaxis] * lineFractions
+
+    if self.reuseProfileBuffer:
+      profiles = self.getProfileBuffer([len(lines), len(volumes), numberOfLineSamples])
+    else:
+      profiles = numpy.empty((len(lines), len(volumes), numberOfLineSamples))
+    for volumeIndex, inputVolume in enumerate(volumes):
+      sampleIjk = samplePoints_RAS1.reshape(-1,4).dot(self.getRasToIjkMatrix(inputVolume).T)[:,0:3]
+      maskNegativeValues = notEvaluatedValueVolumes is not None and inputVolume in notEvaluatedValueVolumes
+      profiles[:,volumeIndex,:] = self.sampleVolume(inputVolume,sampleIjk,maskNegativeValues).reshape(len(lines), numberOfLineSamples)
+    if sampleMasks is not None:
+      for lineIndex, sampleMask in enumerate(sampleMasks):
+        if sampleMask is not None:
+          profiles[lineIndex][:,~numpy.asarray(sampleMask, dtype=bool)] = numpy.nan
+
+    if outputArrays is not None:
+      for lineIndex, line in enumerate(lines):
+        for volumeIndex, inputVolume in enumerate(volumes):
+          outputArray = outputArrays[lineIndex][volumeIndex]
+          if outputArray is None:
+            continue
+          self.writeProfileToOutputArray(outputArray,sampleDistancesMm[lineIndex],profiles[lineIndex,volumeIndex])
+          name = inputVolume.GetName()
+          if len(lines) > 1:
+            name += ' - ' + (line.GetName() if hasattr(line, 'GetName') else 'line ' + str(lineIndex+1))
+          self.updateChart(outputArray,name)
+
+    return [sampleDistancesMm, profiles]
+
+  def getProfileBuffer(self,shape):
+    # Array of the given shape in a buffer that is kept between calls. The buffer is only reallocated when it needs
+    # to grow, so repeated updates (e.g. while a ruler is dragged) do not allocate new profile arrays
+    size = shape[0] * shape[1] * shape[2]
+    if self.profileBuffer is None or self.profileBuffer.size < size:
+      self.profileBuffer = numpy.empty(max(size, 2 * self.profileBuffer.size if self.profileBuffer is not None else 0))
+    return self.profileBuffer[:size].reshape(shape)
 
-    # Need to get the start/end point of the line in the IJK coordinate system
-    # as VTK filters cannot take into account direction cosines        
+  def writeProfileToOutputArray(self,outputArray,sampleDistancesMm,profile):
+    # Fill the output array in bulk through a NumPy view of it. NaN (masked) samples are left out
+    validSamples = ~numpy.isnan(profile)
+    a = outputArray.GetArray()
+    a.SetNumberOfTuples(int(validSamples.sum()))
+    outputArrayView = numpy_support.vtk_to_numpy(a).reshape(a.GetNumberOfTuples(), a.GetNumberOfComponents())
+    outputArrayView[:,0] = sampleDistancesMm[validSamples]
+    outputArrayView[:,1] = profile[validSamples]
+    outputArrayView[:,2:] = 0
+    a.Modified()
+
+  def computeProfileMetrics(self,sampleDistancesMm,profiles):
+    # Beam profile metrics of all profiles (lines x volumes x samples, as returned by computeProfiles) computed at once.
+    # Edges are interpolated between samples at percentages of the profile maximum: field edges and width at 50%,
+    # penumbra between 20% and 80%. Flatness is (max-min)/(max+min) and symmetry the largest difference between
+    # mirrored positions relative to the dose at the field center, both in the central 80% of the field width.
+    # Returns a dictionary of (lines x volumes) arrays keyed by profileMetricNames, NaN where a metric is undefined
+    numberOfLines, numberOfVolumes, numberOfSamples = profiles.shape
+    flatProfiles = profiles.reshape(-1, numberOfSamples)
+    missingSamples = numpy.isnan(flatProfiles)
+    # Missing (masked) samples never reach a level, edges next to them are undefined
+    filledProfiles = numpy.where(missingSamples, -numpy.inf, flatProfiles)
+    sampleStartsMm = numpy.repeat(sampleDistancesMm[:,0], numberOfVolumes)
+    sampleStepsMm = numpy.repeat((sampleDistancesMm[:,-1] - sampleDistancesMm[:,0]) / max(numberOfSamples-1, 1), numberOfVolumes)
+    maxima = filledProfiles.max(axis=1)
+    maxima[maxima <= 0] = numpy.nan
+
+    metrics = {}
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+      [left20, right20] = self.getProfileLevelCrossingIndices(filledProfiles, 0.2 * maxima)
+      [left50, right50] = self.getProfileLevelCrossingIndices(filledProfiles, 0.5 * maxima)
+      [left80, right80] = self.getProfileLevelCrossingIndices(filledProfiles, 0.8 * maxima)
+      centers = 0.5 * (left50 + right50)
+      halfCentralWidths = 0.4 * (right50 - left50)
+
+      sampleIndices = numpy.arange(numberOfSamples)
+      centralRegion = numpy.abs(sampleIndices - centers[:,numpy.newaxis]) <= halfCentralWidths[:,numpy.newaxis]
+      centralRegion &= ~missingSamples
+      centralMaxima = numpy.where(centralRegion, flatProfiles, -numpy.inf).max(axis=1)
+      centralMinima = numpy.where(centralRegion, flatProfiles, numpy.inf).min(axis=1)
+      flatness = 100.0 * (centralMaxima - centralMinima) / (centralMaxima + centralMinima)
+
+      validCenters = ~numpy.isnan(centers)
+      mirroredValues = self.interpolateProfiles(flatProfiles, numpy.where(validCenters, centers, 0)[:,numpy.newaxis] * 2 - sampleIndices)
+      centerValues = self.interpolateProfiles(flatProfiles, numpy.where(validCenters, centers, 0)[:,numpy.newaxis])[:,0]
+      mirroredDifferences = numpy.abs(flatProfiles - mirroredValues)
+      mirroredDifferences = numpy.where(centralRegion & ~numpy.isnan(mirroredDifferences), mirroredDifferences, -numpy.inf).max(axis=1)
+      symmetry = 100.0 * mirroredDifferences / centerValues
+
+      metricValues = [maxima, left50, right50, right50 - left50, centers, left80 - left20, right20 - right80, flatness, symmetry]
+      # Positions and lengths are converted from sample indices to millimeters
+      for metricIndex in [1, 2, 4]:
+        metricValues[metricIndex] = sampleStartsMm + metricValues[metricIndex] * sampleStepsMm
+      for metricIndex in [3, 5, 6]:
+        metricValues[metricIndex] = metricValues[metricIndex] * sampleStepsMm
+      for metricIndex in [7, 8]:
+        metricValues[metricIndex][~validCenters | numpy.isinf(metricValues[metricIndex])] = numpy.nan
+
+    for metricName, metricValue in zip(self.profileMetricNames, metricValues):
+      metrics[metricName] = metricValue.reshape(numberOfLines, numberOfVolumes)
+    return metrics
+
+  def getProfileLevelCrossingIndices(self,profiles,levels):
+    # Fractional sample indices where the profiles (one per row) first rise to and last fall from the levels,
+    # interpolated linearly between the neighboring samples. NaN if a profile does not cross its level on that side
+    numberOfProfiles, numberOfSamples = profiles.shape
+    profileIndices = numpy.arange(numberOfProfiles)
+    aboveLevel = profiles >= levels[:,numpy.newaxis]
+    reachesLevel = aboveLevel.any(axis=1)
+
+    firstAbove = numpy.argmax(aboveLevel, axis=1)
+    beforeFirstAbove = numpy.maximum(firstAbove - 1, 0)
+    lowerValues = profiles[profileIndices, beforeFirstAbove]
+    upperValues = profiles[profileIndices, firstAbove]
+    leftIndices = beforeFirstAbove + (levels - lowerValues) / (upperValues - lowerValues)
+    leftIndices[~reachesLevel | (firstAbove == 0)] = numpy.nan
+
+    lastAbove = numberOfSamples - 1 - numpy.argmax(aboveLevel[:,::-1], axis=1)
+    afterLastAbove = numpy.minimum(lastAbove + 1, numberOfSamples - 1)
+    upperValues = profiles[profileIndices, lastAbove]
+    lowerValues = profiles[profileIndices, afterLastAbove]
+    rightIndices = lastAbove + (upperValues - levels) / (upperValues - lowerValues)
+    rightIndices[~reachesLevel | (lastAbove == numberOfSamples - 1)] = numpy.nan
+    return [leftIndices, rightIndices]
+
+  def interpolateProfiles(self,profiles,sampleIndices):
+    # Linear interpolation of the profiles (one per row) at fractional sample indices (one row of indices per profile).
+    # Indices outside the profile give NaN
+    numberOfSamples = profiles.shape[1]
+    lowerIndices = numpy.clip(numpy.floor(sampleIndices), 0, numberOfSamples - 2).astype(numpy.intp)
+    upperWeights = sampleIndices - lowerIndices
+    profileIndices = numpy.arange(profiles.shape[0])[:,numpy.newaxis]
+    values = profiles[profileIndices, lowerIndices] * (1.0 - upperWeights) + profiles[profileIndices, lowerIndices + 1] * upperWeights
+    values[(sampleIndices < 0) | (sampleIndices > numberOfSamples - 1)] = numpy.nan
+    return values
+
+  def getProfileMetricsTable(self,metrics,lineIndex=0,referenceVolumeIndex=0,compareVolumeIndex=1):
+    # Metrics of a pair of profiles along a line, e.g. plan dose (reference) and calibrated film (compare).
+    # Rows are [metric name, reference, compare, compare - reference]
+    table = []
+    for metricName in self.profileMetricNames:
+      referenceValue = float(metrics[metricName][lineIndex, referenceVolumeIndex])
+      compareValue = float(metrics[metricName][lineIndex, compareVolumeIndex])
+      table.append([metricName, referenceValue, compareValue, compareValue - referenceValue])
+    return table
+
+  def getRasToIjkMatrix(self,inputVolume):
+    # RAS to IJK matrix of the volume (with its parent transform) as a 4x4 NumPy array.
+    # Need to get the line points in the IJK coordinate system, as the volume array has no direction cosines
     rasToIJK = vtk.vtkMatrix4x4()
     parentToIJK = vtk.vtkMatrix4x4()
     rasToParent = vtk.vtkMatrix4x4()
@@ -63,39 +213,60 @@ class LineProfileLogic:
       else:
         print ("Cannot handle non-linear transforms - ignoring transform of the input volume")
     vtk.vtkMatrix4x4.Multiply4x4(parentToIJK, rasToParent, rasToIJK)
-    
-    rulerStartPoint_IJK1 = [0,0,0,1]
-    rulerEndPoint_IJK1 = [0,0,0,1]
-    rasToIJK.MultiplyPoint(rulerStartPoint_RAS1,rulerStartPoint_IJK1)
-    rasToIJK.MultiplyPoint(rulerEndPoint_RAS1,rulerEndPoint_IJK1) 
-    
-    lineSource = vtk.vtkLineSource()
-    lineSource.SetPoint1(rulerStartPoint_IJK1[0],rulerStartPoint_IJK1[1],rulerStartPoint_IJK1[2])
-    lineSource.SetPoint2(rulerEndPoint_IJK1[0], rulerEndPoint_IJK1[1], rulerEndPoint_IJK1[2])
-    lineSource.SetResolution(numberOfLineSamples-1)
-
-    probeFilter=vtk.vtkProbeFilter()
-    probeFilter.SetInputConnection(lineSource.GetOutputPort())
-    if vtk.VTK_MAJOR_VERSION <= 5:
-      probeFilter.SetSource(inputVolume.GetImageData())
-    else:
-      probeFilter.SetSourceData(inputVolume.GetImageData())
-    probeFilter.Update()
+    return numpy.array([[rasToIJK.GetElement(row, column) for column in xrange(4)] for row in xrange(4)])
 
-    probedPoints=probeFilter.GetOutput()
+  def sampleVolume(self,inputVolume,sampleIjk,maskNegativeValues=False):
+    # Linear interpolation of the (first component of the) voxel values at continuous IJK coordinates, computed on a
+    # zero-copy view of the volume array. Samples outside the volume are 0, as with vtkProbeFilter. Along an axis
+    # of a single voxel (a slice volume) samples within half a voxel of the slice are interpolated in-plane.
+    # If maskNegativeValues is True, samples interpolated from negative voxels (e.g. gamma of pixels that are not
+    # evaluated) are NaN instead of a blend of them with the neighboring voxels.
+    imageData = inputVolume.GetImageData()
+    extent = imageData.GetExtent()
+    dimensions = imageData.GetDimensions()
+    scalars = imageData.GetPointData().GetScalars()
+    volumeArray = numpy_support.vtk_to_numpy(scalars).reshape(dimensions[2], dimensions[1], dimensions[0], scalars.GetNumberOfComponents())[...,0]
 
-    # Create arrays of data  
-    a = outputArray.GetArray()
-    a.SetNumberOfTuples(probedPoints.GetNumberOfPoints())
-    x = xrange(0, probedPoints.GetNumberOfPoints())
-    xStep=rulerLengthMm/(probedPoints.GetNumberOfPoints()-1)
-    probedPointScalars=probedPoints.GetPointData().GetScalars()
-    for i in range(len(x)):
-      a.SetComponent(i, 0, x[i]*xStep)
-      a.SetComponent(i, 1, probedPointScalars.GetTuple(i)[0])
-      a.SetComponent(i, 2, 0)
-      
-    probedPoints.GetPointData().GetScalars().Modified()
+    numberOfSamples = sampleIjk.shape[0]
+    insideVolume = numpy.ones(numberOfSamples, dtype=bool)
+    lowerIndices = []
+    upperWeights = []
+    for axis in xrange(3):
+      sampleIndices = sampleIjk[:,axis] - extent[2*axis]
+      if dimensions[axis] == 1:
+        insideVolume &= numpy.abs(sampleIndices) <= 0.5
+        lowerIndices.append(numpy.zeros(numberOfSamples, dtype=numpy.intp))
+        upperWeights.append(numpy.zeros(numberOfSamples))
+        continue
+      # Small tolerance (similar to that of vtkProbeFilter) so that samples on the boundary are inside
+      insideVolume &= (sampleIndices >= -0.002) & (sampleIndices <= dimensions[axis]-1+0.002)
+      sampleIndices = numpy.clip(sampleIndices, 0, dimensions[axis]-1)
+      axisLowerIndices = numpy.minimum(numpy.floor(sampleIndices).astype(numpy.intp), dimensions[axis]-2)
+      lowerIndices.append(axisLowerIndices)
+      upperWeights.append(sampleIndices - axisLowerIndices)
+
+    # Sum of the 8 surrounding voxels weighted by their trilinear weights (corners on single voxel axes get zero weight)
+    sampleValues = numpy.zeros(numberOfSamples)
+    touchesNegativeValue = numpy.zeros(numberOfSamples, dtype=bool)
+    for cornerOffsets in [[di,dj,dk] for dk in [0,1] for dj in [0,1] for di in [0,1]]:
+      cornerWeights = numpy.ones(numberOfSamples)
+      cornerIndices = []
+      for axis in xrange(3):
+        if cornerOffsets[axis]:
+          if dimensions[axis] == 1:
+            break
+          cornerWeights *= upperWeights[axis]
+        else:
+          cornerWeights *= 1.0 - upperWeights[axis]
+        cornerIndices.append(lowerIndices[axis] + cornerOffsets[axis])
+      else:
+        cornerValues = volumeArray[cornerIndices[2], cornerIndices[1], cornerIndices[0]]
+        sampleValues += cornerWeights * cornerValues
+        if maskNegativeValues:
+          touchesNegativeValue |= (cornerWeights > 0) & (cornerValues < 0)
+    sampleValues[touchesNegativeValue] = numpy.nan
+    sampleValues[~insideVolume] = 0.0
+    return sampleValues
 
   def updateChart(self,outputArray,name):
     # Get the first ChartView node
@@ -120,6 +291,11 @@ class LineProfileLogic:
     cvn.Modified()
 
   def computeRulerLength(self,inputRuler):
+    [rulerStartPoint_RAS1, rulerEndPoint_RAS1] = self.getRulerEndPointsRas(inputRuler)
+    return math.sqrt(vtk.vtkMath.Distance2BetweenPoints(rulerStartPoint_RAS1[0:3],rulerEndPoint_RAS1[0:3]))
+
+  def getRulerEndPointsRas(self,inputRuler):
+    # Homogeneous RAS coordinates of the start and end points of the ruler
     rulerStartPoint_Ruler = [0,0,0]
     rulerEndPoint_Ruler = [0,0,0]
     inputRuler.GetPosition1(rulerStartPoint_Ruler)
@@ -139,5 +315,5 @@ class LineProfileLogic:
     rulerEndPoint_RAS1 = [0,0,0,1]
     rulerToRAS.MultiplyPoint(rulerStartPoint_Ruler1,rulerStartPoint_RAS1)
     rulerToRAS.MultiplyPoint(rulerEndPoint_Ruler1,rulerEndPoint_RAS1)        
-    
-    return math.sqrt(vtk.vtkMath.Distance2BetweenPoints(rulerStartPoint_RAS1[0:3],rulerEndPoint_RAS1[0:3]))
+
+    return [rulerStartPoint_RAS1, rulerEndPoint_RAS1]
@@ -0,0 +1,95 @@
+import logging
+from collections import OrderedDict
+
+#
+# WorkflowStageLogic
+#
+class WorkflowStageLogic:
+  """ Bookkeeping of the stages of the film dosimetry workflow.
+      Each stage result is kept with the fingerprint of the inputs and parameters it was computed from.
+      Fingerprints of a stage include the fingerprints of its upstream stages, so a change only makes
+      the stages downstream of it out of date. Only uses Python, so it can be used without Slicer.
+  """
+
+  def __init__(self):
+    # Stage graph: upstream stages of each stage, in workflow order
+    self.upstreamStages = OrderedDict()
+    self.upstreamStages[CALIBRATION_STAGE] = []
+    self.upstreamStages[DOSE_CONVERSION_STAGE] = [CALIBRATION_STAGE]
+    self.upstreamStages[PLAN_DOSE_SLICE_STAGE] = []
+    self.upstreamStages[REGISTRATION_PREPARATION_STAGE] = [DOSE_CONVERSION_STAGE, PLAN_DOSE_SLICE_STAGE]
+    self.upstreamStages[REGISTRATION_STAGE] = [REGISTRATION_PREPARATION_STAGE]
+    self.upstreamStages[GAMMA_STAGE] = [REGISTRATION_STAGE]
+
+    # Fingerprints of the inputs and of the outputs of the last completed run of each stage
+    self.stageFingerprints = {}
+    self.stageOutputFingerprints = {}
+    # Number of times each stage was computed and reused (for logging and benchmarking)
+    self.stageComputeCounts = dict([(stage, 0) for stage in self.upstreamStages])
+    self.stageReuseCounts = dict([(stage, 0) for stage in self.upstreamStages])
+
+  #------------------------------------------------------------------------------
+  def getStageFingerprint(self, stage, stageInputs):
+    # Fingerprint of a stage from its own inputs and parameters, and the fingerprints of its upstream stages
+    # (None for upstream stages that have not been completed)
+    return tuple([stage, tuple(stageInputs)] + [self.stageFingerprints.get(upstreamStage) for upstreamStage in self.upstreamStages[stage]])
+
+  #------------------------------------------------------------------------------
+  def isStageUpToDate(self, stage, fingerprint, outputFingerprint=None):
+    # Stage does not need to be computed if it was completed with the same fingerprint and its outputs
+    # have not been changed or removed since
+    upToDate = stage in self.stageFingerprints and self.stageFingerprints[stage] == fingerprint \
+      and self.stageOutputFingerprints[stage] == outputFingerprint
+    if upToDate:
+      self.stageReuseCounts[stage] += 1
+      logging.debug(stage + " stage is up to date, its result is reused")
+    return upToDate
+
+  #------------------------------------------------------------------------------
+  def setStageCompleted(self, stage, fingerprint, outputFingerprint=None):
+    # Downstream stages computed from a previous result of this stage are out of date
+    if self.stageFingerprints.get(stage) != fingerprint:
+      self.invalidateDownstreamStages(stage)
+    self.stageFingerprints[stage] = fingerprint
+    self.stageOutputFingerprints[stage] = outputFingerprint
+    self.stageComputeCounts[stage] += 1
+
+  #------------------------------------------------------------------------------
+  def invalidateStage(self, stage):
+    # Stage and all stages downstream of it need to be computed again
+    self.invalidateDownstreamStages(stage)
+    self.stageFingerprints.pop(stage, None)
+    self.stageOutputFingerprints.pop(stage, None)
+
+  #------------------------------------------------------------------------------
+  def invalidateDownstreamStages(self, stage):
+    for downstreamStage in self.getDownstreamStages(stage):
+      self.stageFingerprints.pop(downstreamStage, None)
+      self.stageOutputFingerprints.pop(downstreamStage, None)
+
+  #------------------------------------------------------------------------------
+  def getDownstreamStages(self, stage):
+    # Stages that depend on the stage directly or through other stages, in workflow order
+    downstreamStages = []
+    for candidateStage in self.upstreamStages:
+      for upstreamStage in self.upstreamStages[candidateStage]:
+        if upstreamStage == stage or upstreamStage in downstreamStages:
+          downstreamStages.append(candidateStage)
+          break
+    return downstreamStages
+
+  #------------------------------------------------------------------------------
+  def clear(self):
+    self.stageFingerprints = {}
+    self.stageOutputFingerprints = {}
+
+
+#
+# Constants
+#
+CALIBRATION_STAGE = 'Calibration'
+DOSE_CONVERSION_STAGE = 'Dose conversion'
+PLAN_DOSE_SLICE_STAGE = 'Plan dose slice extraction'
+REGISTRATION_PREPARATION_STAGE = 'Registration preparation'
+REGISTRATION_STAGE = 'Registration'
+GAMMA_STAGE = 'Gamma'
@@ -1,2 +1,7 @@
 from FilmDosimetryAnalysisLogic import *
 from LineProfileLogic import *
+from GammaLogic import *
+from FilmDosimetryCoreLogic import *
+from WorkflowStageLogic import *
+from DiskCacheLogic import *
+from BatchProcessingLogic import *
@@ -0,0 +1,72 @@
+import os
+import sys
+import unittest
+import numpy
+import vtk, slicer
+from vtk.util import numpy_support
+
+# Logic modules are imported directly from the module source directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'FilmDosimetryAnalysisLogic'))
+from GammaLogic import *
+from LineProfileLogic import LineProfileLogic
+
+#
+# FilmDosimetryGammaLineProfileTest
+#
+class FilmDosimetryGammaLineProfileTest(unittest.TestCase):
+  """ Gamma line profiles across the analysis threshold edge. Pixels that are not evaluated have the gamma
+      NOT_EVALUATED_GAMMA, which must not be interpolated into the profile as if it was a gamma value.
+  """
+
+  def setUp(self):
+    # Field with a penumbra along the columns, the analysis threshold cuts through the penumbra
+    columns = numpy.arange(80)
+    profile = 2.0 / (1.0 + numpy.exp((columns - 40.0) / 3.0))
+    referenceDoseArray = numpy.tile(profile, (20, 1))
+    compareDoseArray = 1.02 * numpy.tile(numpy.roll(profile, 1), (20, 1))
+    gammaLogic = GammaLogic()
+    gammaLogic.numberOfThreads = 1
+    gammaLogic.analysisThresholdPercent = 30.0
+    self.gammaArray = gammaLogic.computeGamma(referenceDoseArray, compareDoseArray, [1.0, 1.0])
+    self.evaluatedPixelMask = gammaLogic.evaluatedPixelMask
+
+    # Gamma slice volume indexed as [k,j,i]
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(self.gammaArray.shape[1], self.gammaArray.shape[0], 1)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(self.gammaArray.ravel(), 1))
+    self.gammaVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+    self.gammaVolumeNode.SetAndObserveImageData(imageData)
+
+    # Samples along a row, between the voxels, across the threshold edge
+    sampleColumns = numpy.arange(0.0, 79.0, 0.13)
+    self.sampleIjk = numpy.array([sampleColumns, 10.25 * numpy.ones(len(sampleColumns)), numpy.zeros(len(sampleColumns))]).T
+
+  #------------------------------------------------------------------------------
+  def test_NotEvaluatedGammaIsNotInterpolated(self):
+    self.assertTrue(numpy.any(self.evaluatedPixelMask[10]))
+    self.assertFalse(numpy.all(self.evaluatedPixelMask[10]))
+    lineProfileLogic = LineProfileLogic()
+
+    # Interpolating the raw gamma array blends the sentinel with the gamma of the neighboring pixels
+    rawSamples = lineProfileLogic.sampleVolume(self.gammaVolumeNode, self.sampleIjk)
+    self.assertTrue(numpy.any((rawSamples > NOT_EVALUATED_GAMMA) & (rawSamples < 0)))
+
+    samples = lineProfileLogic.sampleVolume(self.gammaVolumeNode, self.sampleIjk, True)
+    validSamples = samples[~numpy.isnan(samples)]
+    self.assertGreater(len(validSamples), 0)
+    self.assertGreater(numpy.count_nonzero(numpy.isnan(samples)), 0)
+    # No values between the sentinel and 0, and the remaining samples are the interpolated gamma
+    self.assertTrue(numpy.all(validSamples >= 0))
+    numpy.testing.assert_allclose(validSamples, rawSamples[~numpy.isnan(samples)])
+
+  #------------------------------------------------------------------------------
+  def test_SamplesOnEvaluatedPixelsAreKept(self):
+    # Samples exactly on evaluated pixels next to pixels that are not evaluated are not masked
+    evaluatedColumns = numpy.nonzero(self.evaluatedPixelMask[10])[0]
+    sampleIjk = numpy.array([evaluatedColumns, 10.0 * numpy.ones(len(evaluatedColumns)), numpy.zeros(len(evaluatedColumns))], dtype=numpy.float64).T
+    samples = LineProfileLogic().sampleVolume(self.gammaVolumeNode, sampleIjk, True)
+    numpy.testing.assert_allclose(samples, self.gammaArray[10, evaluatedColumns], rtol=1e-6)
+
+
+if __name__ == '__main__':
+  unittest.main()
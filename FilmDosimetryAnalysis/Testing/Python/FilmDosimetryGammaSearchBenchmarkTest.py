@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import unittest
+import numpy
+
+# Gamma engine does not use Slicer, so it is imported directly from the module source directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'FilmDosimetryAnalysisLogic'))
+from GammaLogic import *
+
+#
+# FilmDosimetryGammaSearchBenchmarkTest
+#
+class FilmDosimetryGammaSearchBenchmarkTest(unittest.TestCase):
+  """ Benchmark of the accelerated (early termination) gamma search against the exhaustive search on
+      synthetic IMRT and SRS film fields. The film is the plan dose shifted by about 1 mm, scaled by 3%
+      and with 2% noise. Pass fraction and gamma of failing pixels must be the same in both modes.
+  """
+
+  def setUp(self):
+    self.criteria = [[3.0, 3.0, 2.0], [1.0, 1.0, 2.0], [3.0, 3.0, 4.0]] # [DTA (mm), dose difference (%), maximum gamma]
+
+  #------------------------------------------------------------------------------
+  def smoothStep(self, x, penumbraMm):
+    # Field edge profile rising from 0 to 1 around x=0
+    return 0.5 * (1.0 + numpy.tanh(x / penumbraMm))
+
+  #------------------------------------------------------------------------------
+  def createImrtField(self, shiftMm=(0.0, 0.0)):
+    # Modulated 12x12 cm field on a 200 mm grid at 0.5 mm. Returns [dose array, pixel spacing]
+    pixelSpacingMm = 0.5
+    coordinates = (numpy.arange(400) - 199.5) * pixelSpacingMm
+    y = coordinates[:,numpy.newaxis] + shiftMm[0]
+    x = coordinates[numpy.newaxis,:] + shiftMm[1]
+    field = self.smoothStep(60.0 - numpy.abs(x), 3.0) * self.smoothStep(60.0 - numpy.abs(y), 3.0)
+    modulation = 1.0 + 0.3 * numpy.sin(x / 9.0) * numpy.cos(y / 13.0) + 0.2 * numpy.sin((x + y) / 21.0)
+    return [2.0 * field * modulation + 0.02, [pixelSpacingMm, pixelSpacingMm]]
+
+  #------------------------------------------------------------------------------
+  def createSrsField(self, shiftMm=(0.0, 0.0)):
+    # 20 mm cone on a 60 mm grid at 0.2 mm. Returns [dose array, pixel spacing]
+    pixelSpacingMm = 0.2
+    coordinates = (numpy.arange(300) - 149.5) * pixelSpacingMm
+    y = coordinates[:,numpy.newaxis] + shiftMm[0]
+    x = coordinates[numpy.newaxis,:] + shiftMm[1]
+    radius = numpy.sqrt(x*x + y*y)
+    return [20.0 * self.smoothStep(10.0 - radius, 1.5) * (1.0 - 0.002 * radius*radius) + 0.1, [pixelSpacingMm, pixelSpacingMm]]
+
+  #------------------------------------------------------------------------------
+  def createFilmDose(self, createField):
+    # Plan dose measured by the film: shifted, scaled and noisy
+    [filmDoseArray, pixelSpacingMm] = createField((0.7, -0.8))
+    randomState = numpy.random.RandomState(1)
+    return filmDoseArray * 1.03 * (1.0 + 0.02 * randomState.standard_normal(filmDoseArray.shape))
+
+  #------------------------------------------------------------------------------
+  def computeGamma(self, referenceDoseArray, compareDoseArray, pixelSpacingMm, dtaDistanceToleranceMm, doseDifferenceTolerancePercent, maximumGamma, useEarlyTermination):
+    gammaLogic = GammaLogic()
+    gammaLogic.numberOfThreads = 1
+    gammaLogic.analysisThresholdPercent = 10.0
+    gammaLogic.dtaDistanceToleranceMm = dtaDistanceToleranceMm
+    gammaLogic.doseDifferenceTolerancePercent = doseDifferenceTolerancePercent
+    gammaLogic.maximumGamma = maximumGamma
+    gammaLogic.useEarlyTermination = useEarlyTermination
+    startTime = time.time()
+    gammaArray = gammaLogic.computeGamma(referenceDoseArray, compareDoseArray, pixelSpacingMm)
+    return [gammaArray, gammaLogic.evaluatedPixelMask, gammaLogic.passFractionPercent, time.time() - startTime]
+
+  #------------------------------------------------------------------------------
+  def assertAcceleratedSearchIsFaster(self, fieldName, createField):
+    [planDoseArray, pixelSpacingMm] = createField()
+    filmDoseArray = self.createFilmDose(createField)
+    speedups = []
+    for [dtaDistanceToleranceMm, doseDifferenceTolerancePercent, maximumGamma] in self.criteria:
+      [exhaustiveGammaArray, evaluatedPixelMask, exhaustivePassFractionPercent, exhaustiveTime] = self.computeGamma(
+        planDoseArray, filmDoseArray, pixelSpacingMm, dtaDistanceToleranceMm, doseDifferenceTolerancePercent, maximumGamma, False)
+      [acceleratedGammaArray, acceleratedEvaluatedPixelMask, acceleratedPassFractionPercent, acceleratedTime] = self.computeGamma(
+        planDoseArray, filmDoseArray, pixelSpacingMm, dtaDistanceToleranceMm, doseDifferenceTolerancePercent, maximumGamma, True)
+      print('%s field %g mm/%g%%, maximum gamma %g: pass fraction %.1f%%, exhaustive search %.3f s, accelerated search %.3f s (%.0fx)' % (
+        fieldName, dtaDistanceToleranceMm, doseDifferenceTolerancePercent, maximumGamma, exhaustivePassFractionPercent,
+        exhaustiveTime, acceleratedTime, exhaustiveTime / acceleratedTime))
+
+      # Same result: identical gamma of failing pixels, passing pixels pass in both modes
+      numpy.testing.assert_array_equal(acceleratedEvaluatedPixelMask, evaluatedPixelMask)
+      self.assertEqual(acceleratedPassFractionPercent, exhaustivePassFractionPercent)
+      failingPixelMask = evaluatedPixelMask & (exhaustiveGammaArray > 1.0)
+      numpy.testing.assert_array_equal(acceleratedGammaArray[failingPixelMask], exhaustiveGammaArray[failingPixelMask])
+      self.assertTrue(numpy.all(acceleratedGammaArray[evaluatedPixelMask & ~failingPixelMask] <= 1.0))
+      speedups.append(exhaustiveTime / acceleratedTime)
+
+    # Large search radius (maximum gamma 4) is where the exhaustive search is slowest
+    self.assertGreater(speedups[-1], 2.0)
+
+  #------------------------------------------------------------------------------
+  def test_AcceleratedSearchImrtField(self):
+    self.assertAcceleratedSearchIsFaster('IMRT', self.createImrtField)
+
+  #------------------------------------------------------------------------------
+  def test_AcceleratedSearchSrsField(self):
+    self.assertAcceleratedSearchIsFaster('SRS', self.createSrsField)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import math
+import unittest
+import numpy
+
+# Numeric core does not use Slicer, so it is imported directly from the module source directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'FilmDosimetryAnalysisLogic'))
+from FilmDosimetryCoreLogic import *
+
+#
+# FilmDosimetryPlanDoseSliceTest
+#
+class FilmDosimetryPlanDoseSliceTest(unittest.TestCase):
+  """ Extraction of the plan dose slice at the film position from plan doses aligned with the RAS axes
+      and from oblique plan doses, which are resampled on a grid aligned with the RAS axes.
+  """
+
+  def setUp(self):
+    self.coreLogic = FilmDosimetryCoreLogic()
+    self.dimensions = [40, 30, 20] # [I,J,K]
+    self.spacing = [2.0, 2.5, 3.0]
+    self.origin = [-40.0, -30.0, -25.0]
+
+  #------------------------------------------------------------------------------
+  def createIjkToRasMatrix(self, rotationDegrees):
+    # IJK to RAS matrix of the plan dose rotated around the S axis
+    angle = math.radians(rotationDegrees)
+    rotation = numpy.array([[math.cos(angle), -math.sin(angle), 0.0], [math.sin(angle), math.cos(angle), 0.0], [0.0, 0.0, 1.0]])
+    ijkToRasMatrix = numpy.eye(4)
+    ijkToRasMatrix[0:3,0:3] = rotation.dot(numpy.diag(self.spacing))
+    ijkToRasMatrix[0:3,3] = self.origin
+    return ijkToRasMatrix
+
+  #------------------------------------------------------------------------------
+  def getLinearDose(self, rasPoints):
+    # Dose linear in the RAS coordinates, so that linear interpolation is exact
+    return 10.0 + 0.05 * rasPoints[0] - 0.03 * rasPoints[1] + 0.02 * rasPoints[2]
+
+  #------------------------------------------------------------------------------
+  def createPlanDoseArray(self, ijkToRasMatrix):
+    k, j, i = numpy.mgrid[0:self.dimensions[2], 0:self.dimensions[1], 0:self.dimensions[0]]
+    ijkPoints = numpy.array([i.ravel(), j.ravel(), k.ravel(), numpy.ones(i.size)])
+    rasPoints = ijkToRasMatrix.dot(ijkPoints)
+    return self.getLinearDose(rasPoints).reshape(k.shape).astype(numpy.float32)
+
+  #------------------------------------------------------------------------------
+  def getSliceRasPoints(self, sliceArray3D, origin, spacing):
+    k, j, i = numpy.mgrid[0:sliceArray3D.shape[0], 0:sliceArray3D.shape[1], 0:sliceArray3D.shape[2]]
+    return numpy.array([origin[0] + i * spacing[0], origin[1] + j * spacing[1], origin[2] + k * spacing[2]])
+
+  #------------------------------------------------------------------------------
+  def test_ObliquePlanDoseIsResampled(self):
+    ijkToRasMatrix = self.createIjkToRasMatrix(20.0)
+    planDoseArray3D = self.createPlanDoseArray(ijkToRasMatrix)
+    for orientation, slicePositionMm in [[AXIAL, 4.0], [CORONAL, 10.0], [SAGITTAL, 0.0]]:
+      planDoseSlice = self.coreLogic.extractPlanDoseSlice(planDoseArray3D, ijkToRasMatrix, orientation, slicePositionMm)
+      self.assertIsNotNone(planDoseSlice)
+      [sliceArray3D, origin, spacing] = planDoseSlice
+      self.assertIsNotNone(self.coreLogic.getInPlaneSliceArray2D(sliceArray3D, orientation))
+      normalRasAxis = 3 - sum(self.coreLogic.getSlicePlaneRasAxes(orientation))
+      self.assertEqual(origin[normalRasAxis], slicePositionMm)
+
+      # Voxels inside the plan dose have the dose at their position, voxels outside are 0
+      rasPoints = self.getSliceRasPoints(sliceArray3D, origin, spacing)
+      ijkPoints = numpy.linalg.inv(ijkToRasMatrix).dot(numpy.vstack([rasPoints.reshape(3,-1), numpy.ones(sliceArray3D.size)]))[0:3]
+      insideMask = numpy.all((ijkPoints >= 0.0) & (ijkPoints <= numpy.array(self.dimensions)[:,numpy.newaxis] - 1.0), axis=0)
+      outsideMask = numpy.any((ijkPoints < -0.5) | (ijkPoints > numpy.array(self.dimensions)[:,numpy.newaxis] - 0.5), axis=0)
+      self.assertGreater(numpy.count_nonzero(insideMask), sliceArray3D.size // 4)
+      numpy.testing.assert_allclose(sliceArray3D.ravel()[insideMask], self.getLinearDose(rasPoints.reshape(3,-1))[insideMask], rtol=1e-4)
+      self.assertTrue(numpy.all(sliceArray3D.ravel()[outsideMask] == 0))
+
+  #------------------------------------------------------------------------------
+  def test_ResampledSliceMatchesAlignedSlice(self):
+    # Resampling a plan dose aligned with the RAS axes (here with flipped I axis) gives the same slice
+    ijkToRasMatrix = self.createIjkToRasMatrix(180.0)
+    ijkToRasMatrix[1,1] = -ijkToRasMatrix[1,1]
+    ijkToRasMatrix[numpy.abs(ijkToRasMatrix) < 1e-12] = 0.0
+    planDoseArray3D = self.createPlanDoseArray(ijkToRasMatrix)
+    for orientation, slicePositionMm in [[AXIAL, 4.0], [CORONAL, 10.0], [SAGITTAL, -50.0]]:
+      [alignedSliceArray3D, alignedOrigin, alignedSpacing] = self.coreLogic.extractPlanDoseSlice(planDoseArray3D, ijkToRasMatrix, orientation, slicePositionMm)
+      [resampledSliceArray3D, resampledOrigin, resampledSpacing] = self.coreLogic.resamplePlanDoseSlice(planDoseArray3D, ijkToRasMatrix, orientation, slicePositionMm)
+      self.assertEqual(resampledSliceArray3D.shape, alignedSliceArray3D.shape)
+      numpy.testing.assert_allclose(resampledOrigin, alignedOrigin)
+      numpy.testing.assert_allclose(resampledSpacing, alignedSpacing)
+      numpy.testing.assert_allclose(resampledSliceArray3D, alignedSliceArray3D, rtol=1e-5)
+
+  #------------------------------------------------------------------------------
+  def test_SlicePositionOutsideObliquePlanDose(self):
+    ijkToRasMatrix = self.createIjkToRasMatrix(20.0)
+    planDoseArray3D = self.createPlanDoseArray(ijkToRasMatrix)
+    self.assertIsNone(self.coreLogic.extractPlanDoseSlice(planDoseArray3D, ijkToRasMatrix, AXIAL, 100.0))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,104 @@
+import os
+import sys
+import unittest
+import numpy
+
+# Numeric core does not use Slicer, so it is imported directly from the module source directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'FilmDosimetryAnalysisLogic'))
+from FilmDosimetryCoreLogic import *
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+#
+# FilmDosimetryRegistrationPaddingTest
+#
+class FilmDosimetryRegistrationPaddingTest(unittest.TestCase):
+  """ Memory benchmark of padding the calibrated film and the plan dose slice for registration.
+      Padded volumes are made with a single copy each, compared to the numpy.tile, swapaxes, ravel and
+      VTK deep copy sequence used before, and the voxels are in the same order.
+  """
+
+  def setUp(self):
+    self.coreLogic = FilmDosimetryCoreLogic()
+    self.numberOfSlicesToPad = 5
+    # Calibrated film dose (float64) and plan dose slice (float32) of typical size
+    rows, columns = numpy.mgrid[0:1200, 0:1000]
+    self.filmDoseArray2D = numpy.exp(-((rows-600.0)**2 + (columns-500.0)**2) / (2*300.0**2))
+    self.planDoseSliceArray2D = self.filmDoseArray2D[::4,::4].astype(numpy.float32)
+
+  #------------------------------------------------------------------------------
+  def createPaddedOrientedSliceArrayUsingTile(self, sliceArray2D, numberOfSlices, orientation):
+    # Padding as it was done before the shared zero-copy routine: tile the flat slice, swap the axes
+    # into the slice orientation, ravel, then deep copy into the VTK array
+    rows, columns = sliceArray2D.shape
+    paddedArray = numpy.tile(sliceArray2D.ravel(), numberOfSlices)
+    paddedArray3D = paddedArray.reshape(numberOfSlices, rows, columns)
+    if orientation == CORONAL:
+      paddedArray3D = numpy.swapaxes(paddedArray3D, 0, 1)
+    elif orientation == SAGITTAL:
+      paddedArray3D = numpy.swapaxes(numpy.swapaxes(paddedArray3D, 0, 1), 1, 2)
+    raveledPaddedArray = numpy.ravel(paddedArray3D)
+    vtkScalarsArray = raveledPaddedArray.copy()
+    return vtkScalarsArray
+
+  #------------------------------------------------------------------------------
+  def measurePeakMemoryBytes(self, function):
+    tracemalloc.start()
+    try:
+      result = function()
+      peakMemoryBytes = tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+    return [result, peakMemoryBytes]
+
+  #------------------------------------------------------------------------------
+  def test_PaddingMakesOneCopyPerVolume(self):
+    if tracemalloc is None:
+      self.skipTest('tracemalloc is not available')
+
+    for orientation in [AXIAL, CORONAL, SAGITTAL]:
+      totalPaddedBytes = 0
+      totalPeakMemoryBytes = 0
+      totalPreviousPeakMemoryBytes = 0
+      numberOfCopies = 0.0 # Allocated memory in units of the size of the padded volume, summed over the volumes
+      previousNumberOfCopies = 0.0
+      for sliceArray2D in [self.filmDoseArray2D, self.planDoseSliceArray2D]:
+        paddedBytes = sliceArray2D.nbytes * self.numberOfSlicesToPad
+        [paddedArray3D, peakMemoryBytes] = self.measurePeakMemoryBytes(
+          lambda: self.coreLogic.createPaddedOrientedSliceArray(sliceArray2D, self.numberOfSlicesToPad, orientation))
+        [previousPaddedArray, previousPeakMemoryBytes] = self.measurePeakMemoryBytes(
+          lambda: self.createPaddedOrientedSliceArrayUsingTile(sliceArray2D, self.numberOfSlicesToPad, orientation))
+
+        # Same voxels in the same order, in a contiguous array that VTK can use without copy
+        self.assertTrue(paddedArray3D.flags['C_CONTIGUOUS'])
+        self.assertEqual(paddedArray3D.dtype, sliceArray2D.dtype)
+        numpy.testing.assert_array_equal(paddedArray3D.ravel(), previousPaddedArray)
+        # The padded array is the only allocation
+        self.assertLess(peakMemoryBytes, 1.01 * paddedBytes + 64*1024)
+
+        totalPaddedBytes += paddedBytes
+        totalPeakMemoryBytes += peakMemoryBytes
+        totalPreviousPeakMemoryBytes += previousPeakMemoryBytes
+        numberOfCopies += float(peakMemoryBytes) / paddedBytes
+        previousNumberOfCopies += float(previousPeakMemoryBytes) / paddedBytes
+        del paddedArray3D, previousPaddedArray
+
+      print(orientation + ': padded volumes %.1f MB, peak memory %.1f MB (%.1f copies), previously %.1f MB (%.1f copies)' % (
+        totalPaddedBytes / 1048576.0, totalPeakMemoryBytes / 1048576.0, numberOfCopies,
+        totalPreviousPeakMemoryBytes / 1048576.0, previousNumberOfCopies))
+      self.assertLess(numberOfCopies, 2.05)
+
+  #------------------------------------------------------------------------------
+  def test_OrientedSliceExtentMatchesArray(self):
+    for orientation in [AXIAL, CORONAL, SAGITTAL]:
+      paddedArray3D = self.coreLogic.createPaddedOrientedSliceArray(self.planDoseSliceArray2D, self.numberOfSlicesToPad, orientation)
+      extent = self.coreLogic.getOrientedSliceExtent(self.planDoseSliceArray2D.shape, self.numberOfSlicesToPad, orientation)
+      # Array is indexed as [k,j,i]
+      self.assertEqual(paddedArray3D.shape, (extent[5]-extent[4]+1, extent[3]-extent[2]+1, extent[1]-extent[0]+1))
+
+
+if __name__ == '__main__':
+  unittest.main()
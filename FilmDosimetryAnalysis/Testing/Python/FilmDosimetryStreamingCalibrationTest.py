@@ -0,0 +1,94 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+# Numeric core does not use Slicer, so it is imported directly from the module source directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'FilmDosimetryAnalysisLogic'))
+from FilmDosimetryCoreLogic import FilmDosimetryCoreLogic
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+#
+# FilmDosimetryStreamingCalibrationTest
+#
+class FilmDosimetryStreamingCalibrationTest(unittest.TestCase):
+  """ Peak memory of streaming calibration stays below the configured limit and does not grow with the film size.
+      Film scans are memory-mapped files, so only the working memory of the calibration is measured.
+  """
+
+  def setUp(self):
+    self.temporaryDirectoryPath = tempfile.mkdtemp()
+    self.coreLogic = FilmDosimetryCoreLogic()
+    self.coreLogic.calibrationCoefficients = [0.0, 50.0, 100.0, 2.5]
+    self.coreLogic.streamingCalibrationMaximumMemoryMb = 4
+    self.coreLogic.streamingCalibrationOutputDirectory = self.temporaryDirectoryPath
+    self.floodFieldValue = 40000.0
+
+  def tearDown(self):
+    shutil.rmtree(self.temporaryDirectoryPath, ignore_errors=True)
+
+  #------------------------------------------------------------------------------
+  def createFilm(self, numberOfRows, numberOfColumns):
+    # Memory-mapped 16-bit film scan with a dose gradient along the columns
+    filmArray = numpy.memmap(os.path.join(self.temporaryDirectoryPath, 'Film_' + str(numberOfRows) + '.raw'),
+      dtype=numpy.uint16, mode='w+', shape=(numberOfRows * numberOfColumns,))
+    rowPixelValues = numpy.linspace(self.floodFieldValue, self.floodFieldValue / 10.0, numberOfColumns).astype(numpy.uint16)
+    for row in range(numberOfRows):
+      filmArray[row*numberOfColumns:(row+1)*numberOfColumns] = rowPixelValues
+    filmArray.flush()
+    return filmArray
+
+  #------------------------------------------------------------------------------
+  def measureStreamingCalibrationPeakMemoryMb(self, filmSize):
+    filmArray = self.createFilm(filmSize, filmSize)
+    tracemalloc.start()
+    try:
+      doseArrayGy = self.coreLogic.calculateDoseFromPixelValueArraysInRowTiles(filmArray, self.floodFieldValue, filmSize, 'Film')
+      peakMemoryBytes = tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+
+    # Dose is computed for all pixels and matches the non-streaming conversion
+    self.assertEqual(len(doseArrayGy), filmSize * filmSize)
+    numpy.testing.assert_allclose(doseArrayGy[-filmSize:], self.coreLogic.calculateDoseFromPixelValueArrays(filmArray[:filmSize], self.floodFieldValue))
+    del doseArrayGy, filmArray
+    return peakMemoryBytes / (1024.0 * 1024.0)
+
+  #------------------------------------------------------------------------------
+  def assertPeakMemoryIsFlat(self):
+    # Lookup tables are created once per calibration, so they are created before measuring
+    self.coreLogic.calculateDoseFromPixelValueArrays(self.createFilm(1, 1000), self.floodFieldValue)
+
+    filmSizes = [1000, 2000, 3000]
+    peakMemoriesMb = [self.measureStreamingCalibrationPeakMemoryMb(filmSize) for filmSize in filmSizes]
+    for filmSize, peakMemoryMb in zip(filmSizes, peakMemoriesMb):
+      fullDoseArrayMb = filmSize * filmSize * 8 / (1024.0 * 1024.0)
+      print('Film ' + str(filmSize) + 'x' + str(filmSize) + ': peak memory %.1f MB (dose array %.1f MB)' % (peakMemoryMb, fullDoseArrayMb))
+      self.assertLess(peakMemoryMb, self.coreLogic.streamingCalibrationMaximumMemoryMb)
+
+    # 9 times more pixels, but the working memory of the tiles stays the same
+    self.assertLess(peakMemoriesMb[-1], 1.25 * peakMemoriesMb[0] + 0.5)
+
+  #------------------------------------------------------------------------------
+  def test_PeakMemoryIsFlatAsFilmSizeGrows(self):
+    if tracemalloc is None:
+      self.skipTest('tracemalloc is not available')
+    self.coreLogic.useDoseLookupTable = True
+    self.assertPeakMemoryIsFlat()
+
+  #------------------------------------------------------------------------------
+  def test_PeakMemoryIsFlatAsFilmSizeGrowsWithoutLookupTable(self):
+    if tracemalloc is None:
+      self.skipTest('tracemalloc is not available')
+    self.coreLogic.useDoseLookupTable = False
+    self.assertPeakMemoryIsFlat()
+
+
+if __name__ == '__main__':
+  unittest.main()